@@ -0,0 +1,4 @@
+"""Helpers shared by the tenant administration Lambda functions.
+
+The package is zipped next to each handler by scripts/package_functions.sh.
+"""
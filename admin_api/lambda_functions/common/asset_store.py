@@ -0,0 +1,284 @@
+"""Content-addressed store of starter assets shared by every tenant
+
+Starter files are stored once on EFS under their SHA-256, so a version's
+files are read and hashed once however many tenants start from it.
+
+Layout, one namespace per EFS access point user (``public``, ``solr``)::
+
+    /mnt/efs/.starter_store/<namespace>/objects/<ab>/<sha256>
+    /mnt/efs/.starter_store/<namespace>/manifests/<version>.json
+
+Only files nothing ever rewrites are handed to tenants as hard links:
+the segment files of a Solr index, which Lucene writes once and later
+deletes after a merge. Every other file, the whole ``public`` tree that
+Drupal writes into and Solr's configuration, is a private copy owned by
+the tenant, since a change through one link would change it for every
+tenant. Objects are read-only, so a process that does try to write into
+a linked file fails instead. An object's link count is its reference
+count: once no tenant and no live version manifest uses it, prune()
+removes it. Objects are stored before the manifest listing them is
+written, so prune() leaves alone objects stored or reused within
+PRUNE_GRACE seconds, and maybe_prune() runs it at most once per
+PRUNE_INTERVAL.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common.efs_io import (DEFAULT_WORKERS, TransferStats, copy_file, extract_archive,
+                           walk_tree, write_json)
+
+STORE_ROOT = '/mnt/efs/.starter_store'
+VERSION_ROOT = '/mnt/efs/version'
+HASH_BUFFER_BYTES = 1024 * 1024
+OBJECT_MODE = 0o444
+# Longest a manifest build may take between storing an object and listing it
+PRUNE_GRACE = 3600
+PRUNE_INTERVAL = 3600
+# Errors that mean a link cannot be made and the object has to be copied,
+# e.g. EFS caps the number of hard links to one file.
+_LINK_FALLBACK_ERRORS = (errno.EMLINK, errno.EXDEV, errno.EPERM)
+# Namespace whose index directories hold write-once files that may be linked
+LINKED_NAMESPACE = 'solr'
+INDEX_DIRECTORY_PREFIX = 'index'
+
+_manifests = {}
+
+
+def namespace_root(namespace):
+    """Directory holding the objects and manifests of one namespace"""
+    return os.path.join(STORE_ROOT, namespace)
+
+
+def object_path(namespace, digest):
+    """Location of the object with the given SHA-256 hex digest"""
+    return os.path.join(namespace_root(namespace), 'objects', digest[:2], digest)
+
+
+def manifest_path(namespace, version):
+    """Location of the manifest of ``version`` in ``namespace``"""
+    return os.path.join(namespace_root(namespace), 'manifests', f'{version}.json')
+
+
+def file_digest(path):
+    """SHA-256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as source:
+        for chunk in iter(lambda: source.read(HASH_BUFFER_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _store_object(namespace, path, move):
+    """Adds one file to the store and returns its manifest entry"""
+    status = os.stat(path)
+    digest = file_digest(path)
+    target = object_path(namespace, digest)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f'{target}.{uuid.uuid4().hex}.tmp'
+        if move:
+            os.replace(path, temp_path)
+        else:
+            copy_file(path, temp_path)
+        os.chmod(temp_path, OBJECT_MODE)
+        os.replace(temp_path, target)
+    else:
+        # Refreshes the ctime so prune() sees the object is in use again
+        os.chmod(target, OBJECT_MODE)
+    return [status.st_size, status.st_mtime_ns, digest, status.st_mode & 0o777]
+
+
+def build_manifest(namespace, version, source, workers=DEFAULT_WORKERS, move=False):
+    """Stores every file under ``source`` and writes the version's manifest
+
+    Parameters
+    ----------
+    namespace: str, required
+    version: str, required
+    source: str, required
+        Directory tree of starter files
+    move: bool
+        Move files into the store instead of copying them, for staging
+        directories that are thrown away afterwards
+
+    Returns
+    ------
+    dict: the manifest
+    """
+    start = time.monotonic()
+    directories, files, links = walk_tree(source, '')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = {relative: executor.submit(_store_object, namespace, path, move)
+                   for path, relative in files}
+        manifest = {
+            'version': version,
+            'directories': sorted(directories),
+            'files': {relative: future.result() for relative, future in entries.items()},
+            'links': {relative: os.readlink(path) for path, relative in links},
+        }
+    write_json(manifest_path(namespace, version), manifest)
+    _manifests[(namespace, version)] = manifest
+    print(f'Stored {len(files)} {namespace} files of version {version} '
+          f'in {time.monotonic() - start:.1f}s')
+    return manifest
+
+
+def load_manifest(namespace, version):
+    """Returns the stored manifest of ``version``, or None if there is none"""
+    key = (namespace, version)
+    if key not in _manifests:
+        try:
+            with open(manifest_path(namespace, version)) as source:
+                _manifests[key] = json.load(source)
+        except FileNotFoundError:
+            return None
+    return _manifests[key]
+
+
+def ensure_manifest(namespace, version, source, workers=DEFAULT_WORKERS):
+    """Returns the manifest of ``version``, storing its files on first use
+
+    ``source`` is either a directory of starter files or an archive, which
+    is extracted into a staging directory and moved into the store.
+    """
+    manifest = load_manifest(namespace, version)
+    if manifest is not None:
+        return manifest
+    if os.path.isdir(source):
+        return build_manifest(namespace, version, source, workers)
+    staging = os.path.join(namespace_root(namespace), 'staging', uuid.uuid4().hex)
+    try:
+        extract_archive(source, staging, workers)
+        return build_manifest(namespace, version, staging, workers, move=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def is_write_once(namespace, relative):
+    """Whether the file at ``relative`` is never changed once written
+
+    True for the files of Lucene index directories (``index`` or
+    ``index.<timestamp>``) in the Solr namespace.
+    """
+    if namespace != LINKED_NAMESPACE:
+        return False
+    return any(part.startswith(INDEX_DIRECTORY_PREFIX)
+               for part in relative.split('/')[:-1])
+
+
+def _link_file(namespace, entry, destination, link):
+    size, _, digest, mode = entry
+    source = object_path(namespace, digest)
+    if link:
+        try:
+            os.link(source, destination)
+            return size
+        except OSError as ex:
+            if ex.errno not in _LINK_FALLBACK_ERRORS:
+                raise
+    copy_file(source, destination)
+    os.chmod(destination, mode)
+    return size
+
+
+def link_tree(namespace, manifest, dest, workers=DEFAULT_WORKERS):
+    """Populates ``dest`` with the objects listed in ``manifest``
+
+    Write-once files are hard links to the objects, everything else is
+    copied so the tenant can change it.
+
+    Returns
+    ------
+    TransferStats, where bytes counts the logical size of the files
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    os.makedirs(dest, exist_ok=True)
+    for directory in manifest['directories']:
+        os.makedirs(os.path.join(dest, directory), exist_ok=True)
+    stats.directories = len(manifest['directories']) + 1
+
+    def link(item):
+        relative, entry = item
+        link = is_write_once(namespace, relative)
+        stats.add_file(_link_file(namespace, entry, os.path.join(dest, relative), link))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(link, item) for item in manifest['files'].items()]:
+            future.result()
+    for relative, target in manifest['links'].items():
+        os.symlink(target, os.path.join(dest, relative))
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def populate(namespace, version, source, dest, workers=DEFAULT_WORKERS):
+    """Puts the starter assets of ``version`` into a tenant directory"""
+    manifest = ensure_manifest(namespace, version, source, workers)
+    return link_tree(namespace, manifest, dest, workers)
+
+
+def prune(namespace, grace=PRUNE_GRACE, clock=time.time):
+    """Removes objects no tenant links to and no live version lists
+
+    Manifests of versions that are no longer in /mnt/efs/version are
+    dropped first, so their objects become collectable too. Objects
+    changed within ``grace`` seconds may belong to a manifest still being
+    built and are kept.
+
+    Returns
+    ------
+    int: number of objects removed
+    """
+    root = namespace_root(namespace)
+    manifests = os.path.join(root, 'manifests')
+    referenced = set()
+    if os.path.isdir(manifests):
+        for name in os.listdir(manifests):
+            version = name[:-len('.json')]
+            if not os.path.isdir(os.path.join(VERSION_ROOT, version)):
+                os.remove(os.path.join(manifests, name))
+                _manifests.pop((namespace, version), None)
+                continue
+            manifest = load_manifest(namespace, version) or {'files': {}}
+            referenced.update(entry[2] for entry in manifest['files'].values())
+    removed = 0
+    objects = os.path.join(root, 'objects')
+    if not os.path.isdir(objects):
+        return removed
+    cutoff = clock() - grace
+    for bucket in os.scandir(objects):
+        for item in os.scandir(bucket.path):
+            if item.name in referenced or item.name.endswith('.tmp'):
+                continue
+            status = item.stat(follow_symlinks=False)
+            if status.st_nlink == 1 and max(status.st_mtime, status.st_ctime) < cutoff:
+                os.remove(item.path)
+                removed += 1
+    return removed
+
+
+def maybe_prune(namespace, interval=PRUNE_INTERVAL, clock=time.time):
+    """Runs prune() unless it already ran within ``interval`` seconds
+
+    Returns
+    ------
+    int: number of objects removed, or None when the prune was skipped
+    """
+    stamp = os.path.join(namespace_root(namespace), '.pruned')
+    try:
+        if clock() - os.stat(stamp).st_mtime < interval:
+            return None
+    except FileNotFoundError:
+        if not os.path.isdir(namespace_root(namespace)):
+            return None
+    with open(stamp, 'w'):
+        pass
+    return prune(namespace)
@@ -0,0 +1,130 @@
+"""Outputs and resources of the shared base stack
+
+Tenant operations need the base stack's private subnets, ECS cluster,
+ECS security group and load balancer listener. They change only when
+the base stack is updated, so they are read once, indexed by key and
+kept in a TTL cache between invocations. A task launch that fails on a
+stale value drops the cache and tries once more with fresh values.
+"""
+
+from dataclasses import dataclass, field
+
+from botocore.exceptions import ClientError
+
+from common import runtime
+from common.cache import TTLCache
+
+LISTENER = 'PERLSAppLBListener443'
+# run_task errors that can be caused by a cluster, subnet or security
+# group that no longer exists
+_STALE_ERRORS = ('ClusterNotFoundException', 'InvalidParameterException')
+
+_topologies = TTLCache(ttl=runtime.setting('base_stack_ttl', default=900, cast=int), maxsize=8)
+
+
+@dataclass
+class Topology:
+    """Outputs and resources of one base stack, indexed by key"""
+    name: str
+    outputs: dict = field(default_factory=dict)
+    resources: dict = field(default_factory=dict)
+
+    def output(self, fragment):
+        """Value of the first output whose key contains ``fragment``"""
+        for key in sorted(self.outputs):
+            if fragment in key:
+                return self.outputs[key]
+        raise KeyError(f'No {fragment} output in base stack {self.name}')
+
+    @property
+    def private_subnets(self):
+        """Every PrivateSubnet output, in key order"""
+        return [self.outputs[key] for key in sorted(self.outputs) if 'PrivateSubnet' in key]
+
+    @property
+    def ecs_cluster(self):
+        """Name of the ECS cluster running the tenant services"""
+        return self.output('ECSCluster')
+
+    @property
+    def ecs_security_group(self):
+        """Security group of the tenant ECS tasks"""
+        return self.output('SGECS')
+
+    def physical_id(self, logical_id):
+        """Physical id of a base stack resource"""
+        try:
+            return self.resources[logical_id]
+        except KeyError:
+            raise KeyError(f'No {logical_id} resource in base stack {self.name}') from None
+
+    def listener_arn(self, logical_id=LISTENER):
+        """ARN of the application load balancer listener"""
+        return self.physical_id(logical_id)
+
+    def network_configuration(self):
+        """networkConfiguration for ecs.run_task in the tenant subnets"""
+        return {
+            'awsvpcConfiguration': {
+                'subnets': self.private_subnets,
+                'securityGroups': [self.ecs_security_group],
+                'assignPublicIp': 'ENABLED'
+            }
+        }
+
+
+def load_topology(cf_client, base_stack):
+    """Reads the outputs and resources of ``base_stack`` from CloudFormation"""
+    stack = cf_client.describe_stacks(StackName=base_stack)['Stacks'][0]
+    outputs = {output['OutputKey']: output['OutputValue'] for output in stack.get('Outputs', [])}
+    resources = {}
+    paginator = cf_client.get_paginator('list_stack_resources')
+    for page in paginator.paginate(StackName=base_stack):
+        for summary in page['StackResourceSummaries']:
+            resources[summary['LogicalResourceId']] = summary.get('PhysicalResourceId')
+    return Topology(base_stack, outputs, resources)
+
+
+def resolve(cf_client, base_stack):
+    """Returns the cached topology of ``base_stack``, loading it on a miss"""
+    return _topologies.get_or_load(base_stack, lambda: load_topology(cf_client, base_stack))
+
+
+def invalidate(base_stack=None):
+    """Forgets the topology of one base stack, or of all of them"""
+    if base_stack is None:
+        _topologies.invalidate()
+    else:
+        _topologies.invalidate(base_stack)
+
+
+def run_tenant_task(cf_client, ecs_client, base_stack, tenant, command):
+    """Runs ``command`` in a one-off copy of the tenant's PHP admin task
+
+    Returns
+    ------
+    dict: the run_task response
+    """
+    for attempt in range(2):
+        topology = resolve(cf_client, base_stack)
+        try:
+            return ecs_client.run_task(
+                cluster=topology.ecs_cluster,
+                launchType='FARGATE',
+                taskDefinition=tenant + '-php-admin-task',
+                count=1,
+                platformVersion='1.4.0',
+                networkConfiguration=topology.network_configuration(),
+                overrides={'containerOverrides': [
+                    {
+                        'name': tenant + '-php',
+                        'command': command
+                    }
+                ]}
+            )
+        except ClientError as ex:
+            if attempt or ex.response['Error']['Code'] not in _STALE_ERRORS:
+                raise
+            print(f'[WARN] run_task failed with cached {base_stack} outputs, reloading: {ex}')
+            invalidate(base_stack)
+    return None
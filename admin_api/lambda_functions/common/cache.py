@@ -0,0 +1,70 @@
+"""Small in-process caches that survive between warm Lambda invocations"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """A thread safe mapping whose entries expire and are evicted LRU first
+
+    Parameters
+    ----------
+    ttl: float, required
+        Seconds an entry stays valid, unless overridden per entry
+    maxsize: int
+        Number of entries kept before the least recently used is dropped
+    """
+
+    def __init__(self, ttl, maxsize=128, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the live value for ``key`` or ``default``"""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[1] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Stores ``value`` for ``ttl`` seconds, evicting old entries if full"""
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Returns the cached value, calling ``loader()`` to fill a miss"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key=_MISSING):
+        """Drops one entry, or every entry when no key is given"""
+        with self._lock:
+            if key is _MISSING:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        """Hit and miss counters plus the current size"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
@@ -0,0 +1,108 @@
+"""Runs Drupal cron for many tenants from one invocation
+
+Cron URLs are requested concurrently through one pooled HTTP session.
+Start times are spread over a jitter window so the tenants do not all hit
+the shared RDS instance in the same second, and every request has a
+timeout so one stuck site cannot hold up the rest of the fleet.
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+
+from common.runtime import pooled_session
+
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_JITTER = 5.0
+# Drupal answers a cron request with a wrong key with 403 Forbidden
+KEY_REJECTED_STATUS = 403
+
+
+def key_rejected(status):
+    """Whether a cron request failed because the site did not accept its key"""
+    return status == KEY_REJECTED_STATUS
+
+
+@dataclass
+class CronResult:
+    """Outcome of one tenant's cron request"""
+    tenant: str
+    status: int = None
+    seconds: float = 0.0
+    error: str = None
+
+    def as_dict(self):
+        """Result as a JSON serialisable dict, without empty fields"""
+        result = {'tenant': self.tenant, 'seconds': round(self.seconds, 3)}
+        if self.status is not None:
+            result['status'] = self.status
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+
+def cron_url(address, cron_key):
+    """URL that runs cron on the site served at ``address``"""
+    return f'https://{address}/cron/{cron_key}'
+
+
+def run_cron(session, tenant, url, timeout=DEFAULT_TIMEOUT):
+    """Requests one cron URL and reports the status and latency"""
+    result = CronResult(tenant)
+    start = time.monotonic()
+    try:
+        response = session.get(url, timeout=timeout)
+        result.status = response.status_code
+        response.raise_for_status()
+    except requests.exceptions.RequestException as ex:
+        # The URL embeds the cron key, so only the exception type is reported
+        result.error = type(ex).__name__
+    result.seconds = time.monotonic() - start
+    return result
+
+
+def dispatch(tenants, resolve_url, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+             jitter=DEFAULT_JITTER, session=None):
+    """Runs cron for every tenant concurrently
+
+    Parameters
+    ----------
+    tenants: list, required
+        Tenant names
+    resolve_url: callable, required
+        Returns the cron URL of a tenant; failures are reported per tenant
+    workers: int
+        Maximum number of requests in flight
+    timeout: float
+        Connect and read timeout of each request, in seconds
+    jitter: float
+        Window, in seconds, over which request start times are spread
+
+    Returns
+    ------
+    list of CronResult, in the order of ``tenants``
+    """
+    session = session or pooled_session(workers)
+    start = time.monotonic()
+    offsets = {tenant: random.uniform(0, jitter) for tenant in tenants}
+
+    def run(tenant):
+        delay = start + offsets[tenant] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            url = resolve_url(tenant)
+        except Exception as ex:  # pylint: disable=broad-except
+            return CronResult(tenant, error=f'{type(ex).__name__}: {ex}')
+        return run_cron(session, tenant, url, timeout)
+
+    # Submitting in start order keeps workers from sleeping on late tenants
+    # while earlier ones are still waiting for a free worker.
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {tenant: executor.submit(run, tenant)
+                   for tenant in sorted(tenants, key=offsets.get)}
+        return [futures[tenant].result() for tenant in tenants]
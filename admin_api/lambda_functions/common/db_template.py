@@ -0,0 +1,189 @@
+"""Tenant databases cloned from a pristine per-version template schema
+
+The first tenant created on a CMS version loads the starter dump into a
+``starter_<version>`` schema on the RDS instance. Every tenant database is
+then materialised from it with server-side ``CREATE TABLE ... LIKE`` and
+``INSERT ... SELECT`` statements, one table per pooled connection, so the
+SQL text never has to cross the network again.
+
+Only tables are copied that way. A template holding triggers, views,
+routines or events raises ``TemplateUnsupported``, and the dump is
+replayed instead so none of them is lost.
+"""
+
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+from mysql.connector import pooling
+
+from common.parallel_load import MAX_POOL_SIZE, load_parallel
+from common.provisioning import StageNotReady
+
+TEMPLATE_PREFIX = 'starter_'
+READY_TABLE = '_starter_ready'
+# Seconds to wait for another build; the stage is retried rather than
+# spending its own timeout waiting
+LOCK_TIMEOUT = 10
+# Schema objects a table copy does not clone, with the column naming their schema
+OTHER_OBJECTS = (('triggers', 'trigger_schema'), ('views', 'table_schema'),
+                 ('routines', 'routine_schema'), ('events', 'event_schema'))
+
+
+class TemplateUnsupported(ValueError):
+    """The template holds objects that cloning its tables would lose"""
+
+
+def template_name(version):
+    """Schema holding the pristine starter database of ``version``"""
+    return (TEMPLATE_PREFIX + re.sub(r'[^A-Za-z0-9_]', '_', version))[:64]
+
+
+def _source_info(sql_file):
+    stat = os.stat(sql_file)
+    return json.dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+
+def _is_ready(cursor, template, source):
+    cursor.execute('SELECT 1 FROM information_schema.tables '
+                   'WHERE table_schema = %s AND table_name = %s', (template, READY_TABLE))
+    if cursor.fetchone() is None:
+        return False
+    cursor.execute(f'SELECT source FROM `{template}`.`{READY_TABLE}`')
+    row = cursor.fetchone()
+    return row is not None and row[0] == source
+
+
+def template_tables(cursor, template):
+    """Base tables of a template schema, excluding its ready marker"""
+    cursor.execute("SELECT table_name FROM information_schema.tables "
+                   "WHERE table_schema = %s AND table_type = 'BASE TABLE' "
+                   "AND table_name != %s", (template, READY_TABLE))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def other_objects(cursor, template):
+    """Number of triggers, views, routines and events in a template schema"""
+    counts = {}
+    for table, column in OTHER_OBJECTS:
+        cursor.execute(f'SELECT COUNT(*) FROM information_schema.{table} WHERE {column} = %s',
+                       (template,))
+        count = cursor.fetchone()[0]
+        if count:
+            counts[table] = count
+    return counts
+
+
+def ensure_template(server_args, version, sql_file, statements, errors, concurrency):
+    """Builds the template schema of ``version`` unless it is already current
+
+    Builders are serialised with a named server lock, so tenants created
+    at the same time on a new version wait for one build instead of
+    loading the dump several times.
+
+    Parameters
+    ----------
+    server_args: dict, required
+        Keyword arguments for mysql.connector.connect, without database
+    version: str, required
+    sql_file: str, required
+        Starter dump the template is built from
+    statements: callable, required
+        Returns the statements of the dump when a build is needed
+    errors: exception class or tuple, required
+        Server errors that are logged and skipped while loading
+    concurrency: int, required
+        Table workers used to load the template
+
+    Returns
+    ------
+    str: name of the template schema
+
+    Raises
+    ------
+    StageNotReady when another build holds the lock, so the stage is retried
+    """
+    template = template_name(version)
+    source = _source_info(sql_file)
+    connection = mysql.connector.connect(**server_args)
+    cursor = connection.cursor()
+    try:
+        if _is_ready(cursor, template, source):
+            return template
+        cursor.execute('SELECT GET_LOCK(%s, %s)', (template, LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise StageNotReady(f'Template {template} is being built by another tenant')
+        try:
+            if _is_ready(cursor, template, source):
+                return template
+            print(f'Building template schema {template}')
+            cursor.execute(f'DROP DATABASE IF EXISTS `{template}`')
+            cursor.execute(f'CREATE DATABASE `{template}`')
+            stats, mismatches = load_parallel(dict(server_args, database=template),
+                                              statements(), errors, concurrency)
+            print(f'Template {template} loaded: {stats.summary()}')
+            if mismatches:
+                raise ValueError(f'Template {template} row counts do not match: {mismatches}')
+            cursor.execute(f'CREATE TABLE `{template}`.`{READY_TABLE}` (source TEXT)')
+            cursor.execute(f'INSERT INTO `{template}`.`{READY_TABLE}` VALUES (%s)', (source,))
+            connection.commit()
+        finally:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', (template,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+        connection.close()
+    return template
+
+
+def _copy_table(pool, template, target, table):
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET foreign_key_checks=0, unique_checks=0')
+        cursor.execute(f'CREATE TABLE `{target}`.`{table}` LIKE `{template}`.`{table}`')
+        cursor.execute(f'INSERT INTO `{target}`.`{table}` SELECT * FROM `{template}`.`{table}`')
+        rows = cursor.rowcount
+        connection.commit()
+        cursor.close()
+        return rows
+    finally:
+        connection.close()
+
+
+def clone_template(server_args, template, target, concurrency):
+    """Copies every table of ``template`` into the existing schema ``target``
+
+    Returns
+    ------
+    dict mapping each table to the number of rows copied
+
+    Raises
+    ------
+    TemplateUnsupported when the template has objects other than tables
+    """
+    start = time.monotonic()
+    pool = pooling.MySQLConnectionPool(pool_name='starter_clone',
+                                       pool_size=max(1, min(concurrency, MAX_POOL_SIZE)),
+                                       **server_args)
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        tables = template_tables(cursor, template)
+        others = other_objects(cursor, template)
+        cursor.close()
+    finally:
+        connection.close()
+    if others:
+        raise TemplateUnsupported(f'Template {template} has {others}, which are not cloned')
+
+    with ThreadPoolExecutor(max_workers=pool.pool_size) as executor:
+        futures = {table: executor.submit(_copy_table, pool, template, target, table)
+                   for table in tables}
+        copied = {table: future.result() for table, future in futures.items()}
+    print(f'Cloned {len(copied)} tables, {sum(copied.values())} rows from {template} '
+          f'into {target} in {time.monotonic() - start:.1f}s')
+    return copied
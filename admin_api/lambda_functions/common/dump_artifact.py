@@ -0,0 +1,209 @@
+"""Pre-split, compressed statement index for a starter database dump
+
+The first create_db run for a CMS version tokenizes CMS-Database.sql as
+usual and, while doing so, writes CMS-Database.sqlpack next to it. Later
+runs memory-map the pack and replay the statements without parsing.
+
+Pack layout::
+
+    MAGIC | block 0 | block 1 | ... | header | footer
+
+Blocks are zlib-compressed runs of statement text. The header is
+zlib-compressed JSON listing each block's file offset and, per statement,
+its block, byte offsets within the block, kind, table, standalone
+flag and, for INSERT statements, the number of rows it adds. The footer
+holds the header offset and length followed by MAGIC.
+"""
+
+import json
+import mmap
+import os
+import struct
+import uuid
+import zlib
+
+from common.sql_import import Statement, count_rows, read_statements
+
+MAGIC = b'PERLSQL1'
+FORMAT_VERSION = 2
+BLOCK_BYTES = 4 * 1024 * 1024
+COMPRESSION_LEVEL = 1
+_FOOTER = struct.Struct('<QI8s')
+
+
+def artifact_path(sql_file):
+    """Location of the pack compiled from ``sql_file``"""
+    return os.path.splitext(sql_file)[0] + '.sqlpack'
+
+
+def _source_info(sql_file):
+    stat = os.stat(sql_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_header(path):
+    """Returns the decoded header of a pack, or None if it is unusable"""
+    try:
+        with open(path, 'rb') as pack:
+            pack.seek(-_FOOTER.size, os.SEEK_END)
+            offset, length, magic = _FOOTER.unpack(pack.read(_FOOTER.size))
+            if magic != MAGIC:
+                return None
+            pack.seek(offset)
+            header = json.loads(zlib.decompress(pack.read(length)))
+    except (OSError, ValueError, zlib.error):
+        return None
+    return header if header.get('format') == FORMAT_VERSION else None
+
+
+def is_current(sql_file, path=None):
+    """True when a pack exists and was compiled from the current dump"""
+    header = read_header(path or artifact_path(sql_file))
+    return header is not None and header['source'] == _source_info(sql_file)
+
+
+def replay(path):
+    """Yields the statements stored in a pack
+
+    The file is memory-mapped and each block is decompressed once.
+    """
+    header = read_header(path)
+    if header is None:
+        raise ValueError(f'{path} is not a valid statement pack')
+    with open(path, 'rb') as pack, \
+            mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        statements = header['statements']
+        index = 0
+        for block_number, (offset, length) in enumerate(header['blocks']):
+            block = zlib.decompress(mapped[offset:offset + length])
+            while index < len(statements) and statements[index][0] == block_number:
+                _, start, end, kind, table, standalone, rows = statements[index]
+                index += 1
+                yield Statement(block[start:end].decode('utf8', errors='surrogateescape'),
+                                kind, table, standalone, end - start, rows)
+
+
+class _PackWriter:
+    """Accumulates statements into compressed blocks of a temporary file"""
+
+    def __init__(self, path, source):
+        self.path = path
+        # Sandboxes sharing EFS often have the same pid, so the name is random
+        self.temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        self.source = source
+        self.file = open(self.temp_path, 'wb')  # pylint: disable=consider-using-with
+        self.file.write(MAGIC)
+        self.blocks = []
+        self.statements = []
+        self.block = bytearray()
+
+    def add(self, statement):
+        """Appends one statement, flushing the current block when full"""
+        data = statement.sql.encode('utf8', errors='surrogateescape')
+        if statement.kind == 'insert' and statement.rows is None:
+            statement.rows = count_rows(statement.sql)
+        start = len(self.block)
+        self.block += data
+        self.statements.append([len(self.blocks), start, len(self.block), statement.kind,
+                                statement.table, statement.standalone, statement.rows])
+        if len(self.block) >= BLOCK_BYTES:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.block:
+            return
+        compressed = zlib.compress(bytes(self.block), COMPRESSION_LEVEL)
+        self.blocks.append([self.file.tell(), len(compressed)])
+        self.file.write(compressed)
+        self.block = bytearray()
+
+    def commit(self):
+        """Writes header and footer and moves the pack into place"""
+        self._flush_block()
+        header = zlib.compress(json.dumps({
+            'format': FORMAT_VERSION,
+            'source': self.source,
+            'blocks': self.blocks,
+            'statements': self.statements,
+        }).encode('utf8'))
+        offset = self.file.tell()
+        self.file.write(header)
+        self.file.write(_FOOTER.pack(offset, len(header), MAGIC))
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """Discards the partially written pack"""
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+def compile_statements(sql_file, path=None):
+    """Yields the statements of ``sql_file`` while writing them to a pack
+
+    The pack only replaces any existing one once every statement has been
+    consumed, so an interrupted import never leaves a truncated pack.
+    """
+    path = path or artifact_path(sql_file)
+    try:
+        writer = _PackWriter(path, _source_info(sql_file))
+    except OSError as ex:
+        print(f'Cannot write statement pack {path}: {ex}')
+        yield from read_statements(sql_file)
+        return
+    try:
+        for statement in read_statements(sql_file):
+            writer.add(statement)
+            yield statement
+    except BaseException:
+        writer.abort()
+        raise
+    try:
+        writer.commit()
+    except OSError as ex:
+        writer.abort()
+        print(f'Cannot write statement pack {path}: {ex}')
+    else:
+        print(f'Compiled {sql_file} into {path}')
+
+
+def compile_dump(sql_file):
+    """Compiles the pack for ``sql_file`` without loading it anywhere"""
+    for _ in compile_statements(sql_file):
+        pass
+    return artifact_path(sql_file)
+
+
+def _replay_or_parse(sql_file, path):
+    """Replays a pack, switching to the dump if the pack turns out corrupt
+
+    The statements already yielded from the pack are skipped in the dump,
+    which yields the same statements in the same order.
+    """
+    replayed = 0
+    try:
+        for statement in replay(path):
+            yield statement
+            replayed += 1
+    except (OSError, ValueError, zlib.error) as ex:
+        print(f'[WARN] Statement pack {path} is corrupt, removing it and reading '
+              f'{sql_file}: {ex}')
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        for number, statement in enumerate(read_statements(sql_file)):
+            if number >= replayed:
+                yield statement
+
+
+def load_statements(sql_file):
+    """Yields the statements of a starter dump, compiling it on first use"""
+    path = artifact_path(sql_file)
+    if is_current(sql_file, path):
+        print(f'Replaying statement pack {path}')
+        return _replay_or_parse(sql_file, path)
+    return compile_statements(sql_file, path)
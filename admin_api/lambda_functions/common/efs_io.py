@@ -0,0 +1,519 @@
+"""Bulk file operations tuned for EFS
+
+On EFS each file costs several network round trips, so throughput comes
+from keeping many files in flight at once rather than from a faster
+single stream. The helpers here overlap those round trips with a pool of
+writer threads and copy file contents with kernel-side copies where the
+platform allows it.
+"""
+
+import gzip
+import json
+import os
+import queue
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+DEFAULT_WORKERS = 16
+COPY_BUFFER_BYTES = 8 * 1024 * 1024
+STREAM_BUFFER_BYTES = 1024 * 1024
+# Archive members above this size are written by the reader thread itself
+# instead of being buffered in memory for a writer thread.
+LARGE_MEMBER_BYTES = 4 * 1024 * 1024
+QUEUE_BUDGET_BYTES = 64 * 1024 * 1024
+# Files unlinked by one task of parallel_rmtree
+REMOVE_BATCH = 64
+
+
+@dataclass
+class TransferStats:
+    """Counters for one copy or extraction run, safe to update from threads"""
+    files: int = 0
+    directories: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add_file(self, size):
+        """Records one written file of ``size`` bytes"""
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def summary(self):
+        """One line, human readable summary"""
+        rate = self.bytes / self.elapsed / 1048576 if self.elapsed else 0.0
+        files_rate = self.files / self.elapsed if self.elapsed else 0.0
+        return (f'{self.files} files, {self.directories} directories, '
+                f'{self.bytes / 1048576:.1f} MiB in {self.elapsed:.1f}s: '
+                f'{files_rate:.0f} files/s, {rate:.2f} MiB/s')
+
+    def as_dict(self):
+        """Counters as a JSON serialisable dict"""
+        return {'files': self.files, 'directories': self.directories,
+                'bytes': self.bytes, 'seconds': round(self.elapsed, 3)}
+
+
+def _kernel_copy(copy, offset, remaining):
+    # Calls copy(offset, size) until the range is copied. Returns the
+    # offset and bytes still to copy once it is done, fails, or makes no
+    # progress, so the caller can go on with the next method from there.
+    try:
+        while remaining > 0:
+            copied = copy(offset, remaining)
+            if copied == 0:
+                break
+            offset += copied
+            remaining -= copied
+    except OSError:
+        pass
+    return offset, remaining
+
+
+def copy_file_data(src_fd, dst_fd, count, offset=0):
+    """Copies ``count`` bytes from ``src_fd`` at ``offset`` to ``dst_fd``
+
+    Uses copy_file_range or sendfile so the data does not pass through
+    Python, and falls back to buffered reads and writes for whatever they
+    did not copy. The position of ``src_fd`` is never used, so one
+    descriptor can be shared by threads.
+
+    Raises
+    ------
+    OSError: when the source ends before ``count`` bytes were copied
+    """
+    remaining = count
+    if hasattr(os, 'copy_file_range'):
+        offset, remaining = _kernel_copy(
+            lambda at, size: os.copy_file_range(src_fd, dst_fd, size, at), offset, remaining)
+    if remaining > 0 and hasattr(os, 'sendfile'):
+        offset, remaining = _kernel_copy(
+            lambda at, size: os.sendfile(dst_fd, src_fd, at, min(size, COPY_BUFFER_BYTES)),
+            offset, remaining)
+    while remaining > 0:
+        chunk = os.pread(src_fd, min(remaining, COPY_BUFFER_BYTES), offset)
+        if not chunk:
+            raise OSError(f'Source ended after {count - remaining} of {count} bytes')
+        _write_all(dst_fd, chunk)
+        offset += len(chunk)
+        remaining -= len(chunk)
+
+
+def _create(path, mode):
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode & 0o777 or 0o644)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _write_bytes(path, data, mode):
+    fd = _create(path, mode)
+    try:
+        _write_all(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _member_path(dest, member):
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == '..' or name.startswith('../'):
+        raise ValueError(f'Refusing to extract {member.name} outside of {dest}')
+    return os.path.join(dest, name)
+
+
+def write_json(path, data):
+    """Writes ``data`` as JSON through a temporary file and a rename"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w') as target:
+        json.dump(data, target)
+    os.replace(temp_path, path)
+
+
+STARTER_MARKER = '.starter.json'
+
+
+def starter_marker(path, version):
+    """Contents of the completion marker at ``path`` if it was written for ``version``"""
+    try:
+        with open(path) as source:
+            marker = json.load(source)
+    except (OSError, ValueError):
+        return None
+    return marker if marker.get('version') == version else None
+
+
+def write_starter_marker(path, version, stats):
+    """Records that the starter content of ``version`` was copied completely"""
+    write_json(path, dict(stats.as_dict(), version=version))
+
+
+def clear_directory(dest):
+    """Removes everything inside ``dest`` but keeps the directory and its owner"""
+    if not os.path.isdir(dest):
+        return
+    with os.scandir(dest) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+
+def _ensure_parent(path, created):
+    """Creates the parent of ``path`` unless this run already did"""
+    parent = os.path.dirname(path)
+    if parent not in created:
+        os.makedirs(parent, exist_ok=True)
+        created.add(parent)
+
+
+class _ByteBudget:
+    """Bounds the amount of member data waiting in the writer queue"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """Blocks until ``size`` bytes fit in the budget"""
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        """Returns ``size`` bytes to the budget"""
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def _open_stream(archive):
+    """Opens a compressed tarball for sequential reading"""
+    raw = open(archive, 'rb', buffering=STREAM_BUFFER_BYTES)  # pylint: disable=consider-using-with
+    if archive.endswith('.zst'):
+        if zstandard is None:
+            raw.close()
+            raise RuntimeError('zstandard is required to extract ' + archive)
+        stream = zstandard.ZstdDecompressor().stream_reader(raw, read_size=STREAM_BUFFER_BYTES)
+    elif archive.endswith(('.gz', '.tgz')):
+        stream = gzip.GzipFile(fileobj=raw)
+    else:
+        stream = raw
+    return tarfile.open(fileobj=stream, mode='r|', bufsize=STREAM_BUFFER_BYTES)
+
+
+def _extract_links(links, dest):
+    for member in links:
+        path = _member_path(dest, member)
+        if os.path.lexists(path):
+            os.remove(path)
+        if member.issym():
+            os.symlink(member.linkname, path)
+        else:
+            os.link(_member_path(dest, tarfile.TarInfo(member.linkname)), path)
+
+
+def extract_uncompressed(archive, dest, workers=DEFAULT_WORKERS):
+    """Extracts an uncompressed tarball with kernel-side copies
+
+    Members are read straight from their offset in the archive, so each
+    writer thread copies independently without a shared decompressor.
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    with tarfile.open(archive, 'r:') as tar:
+        members = tar.getmembers()
+    links = []
+    created = {dest}
+    for member in members:
+        path = _member_path(dest, member)
+        if member.isdir():
+            os.makedirs(path, exist_ok=True)
+            created.add(path)
+            stats.directories += 1
+        elif member.issym() or member.islnk():
+            links.append(member)
+        elif member.isreg():
+            _ensure_parent(path, created)
+
+    def write(member):
+        dst = _create(_member_path(dest, member), member.mode)
+        try:
+            copy_file_data(src, dst, member.size, member.offset_data)
+        finally:
+            os.close(dst)
+        stats.add_file(member.size)
+
+    src = os.open(archive, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(write, member) for member in members
+                           if member.isreg()]:
+                future.result()
+    finally:
+        os.close(src)
+    _extract_links(links, dest)
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def extract_stream(archive, dest, workers=DEFAULT_WORKERS, budget_bytes=QUEUE_BUDGET_BYTES):
+    """Extracts a compressed tarball with one reader and many writers
+
+    The calling thread decompresses and hands small members through a
+    bounded queue to writer threads. Large members, such as Solr index
+    segments, are copied by the reader in big buffered chunks.
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    budget = _ByteBudget(budget_bytes)
+    pending = queue.Queue(maxsize=workers * 4)
+    errors = []
+
+    def writer():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            path, data, mode = item
+            try:
+                _write_bytes(path, data, mode)
+                stats.add_file(len(data))
+            except OSError as ex:
+                errors.append(ex)
+            finally:
+                budget.release(len(data))
+
+    threads = [threading.Thread(target=writer, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    links = []
+    created = {dest}
+    try:
+        with _open_stream(archive) as tar:
+            for member in tar:
+                if errors:
+                    break
+                path = _member_path(dest, member)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    created.add(path)
+                    stats.directories += 1
+                elif member.issym() or member.islnk():
+                    links.append(member)
+                elif member.isreg():
+                    _ensure_parent(path, created)
+                    source = tar.extractfile(member)
+                    if member.size > LARGE_MEMBER_BYTES:
+                        with os.fdopen(_create(path, member.mode), 'wb',
+                                       buffering=COPY_BUFFER_BYTES) as target:
+                            shutil.copyfileobj(source, target, COPY_BUFFER_BYTES)
+                        stats.add_file(member.size)
+                    else:
+                        data = source.read()
+                        budget.acquire(len(data))
+                        pending.put((path, data, member.mode))
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    _extract_links(links, dest)
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def extract_archive(archive, dest, workers=DEFAULT_WORKERS):
+    """Extracts a .tar, .tar.gz or .tar.zst archive into ``dest``"""
+    os.makedirs(dest, exist_ok=True)
+    if archive.endswith('.tar'):
+        return extract_uncompressed(archive, dest, workers)
+    return extract_stream(archive, dest, workers)
+
+
+def find_archive(directory, name):
+    """Picks the fastest variant of ``name`` available in ``directory``
+
+    Uncompressed archives are preferred, then zstd when the zstandard
+    module is installed, then gzip.
+    """
+    suffixes = ['.tar'] + (['.tar.zst'] if zstandard is not None else []) + ['.tar.gz']
+    for suffix in suffixes:
+        path = os.path.join(directory, name + suffix)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f'No {name} archive in {directory}')
+
+
+def walk_tree(src, dst):
+    """Lists the directories, files and symlinks under ``src`` in one pass
+
+    Every entry is returned with the path it would have under ``dst``.
+    """
+    directories = []
+    files = []
+    links = []
+    stack = [(src, dst)]
+    while stack:
+        source, target = stack.pop()
+        with os.scandir(source) as entries:
+            for entry in entries:
+                destination = os.path.join(target, entry.name)
+                if entry.is_symlink():
+                    links.append((entry.path, destination))
+                elif entry.is_dir():
+                    directories.append(destination)
+                    stack.append((entry.path, destination))
+                else:
+                    files.append((entry.path, destination))
+    return directories, files, links
+
+
+def copy_file(src, dst, preserve_stat=False):
+    """Copies one file with a kernel-side copy and returns its size"""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        status = os.fstat(src_fd)
+        dst_fd = _create(dst, status.st_mode)
+        try:
+            # The mode given to open() is masked by the umask and ignored
+            # when the file already exists
+            os.fchmod(dst_fd, stat.S_IMODE(status.st_mode))
+            copy_file_data(src_fd, dst_fd, status.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if preserve_stat:
+        shutil.copystat(src, dst)
+    return status.st_size
+
+
+def parallel_copytree(src, dst, workers=DEFAULT_WORKERS, preserve_stat=False):
+    """Copies a directory tree with a pool of file copying threads
+
+    Unlike shutil.copytree, directories are created up front, file data is
+    copied with copy_file_range/sendfile, and timestamps are only copied
+    when ``preserve_stat`` is set. Permission bits of files and directories
+    are always copied, whatever the umask.
+
+    Returns
+    ------
+    TransferStats
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    directories, files, links = walk_tree(src, dst)
+    os.makedirs(dst, exist_ok=True)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    stats.directories = len(directories) + 1
+
+    def copy(paths):
+        stats.add_file(copy_file(paths[0], paths[1], preserve_stat))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(copy, paths) for paths in files]:
+            future.result()
+    for source, destination in links:
+        os.symlink(os.readlink(source), destination)
+    # Deepest first and after the copy, so a read-only directory is filled
+    # before it loses its write bit
+    for directory in reversed(directories + [dst]):
+        source = os.path.normpath(os.path.join(src, os.path.relpath(directory, dst)))
+        os.chmod(directory, stat.S_IMODE(os.stat(source).st_mode))
+    stats.elapsed = time.monotonic() - start
+    return stats
+
+
+def _unlink_all(paths, stats):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        stats.add_file(0)
+
+
+def parallel_rmtree(path, workers=DEFAULT_WORKERS, deadline=None, batch=REMOVE_BATCH):
+    """Removes a directory tree with a pool of threads
+
+    Directories are listed and files unlinked in parallel, in batches of
+    ``batch`` files, then the emptied directories are removed deepest
+    first. Entries removed by someone else meanwhile are skipped, so two
+    purges of the same tree do not fail each other.
+
+    Parameters
+    ----------
+    deadline: float
+        time.monotonic() value after which no more work is started; the
+        tree is then left partly removed
+
+    Returns
+    ------
+    tuple of (TransferStats, bool whether the tree is gone)
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    directories = [path]
+
+    def expired():
+        return deadline is not None and time.monotonic() > deadline
+
+    def scan(directory):
+        subdirectories = []
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except FileNotFoundError:
+            pass
+        return subdirectories, [files[index:index + batch]
+                                for index in range(0, len(files), batch)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is None or expired():
+                    continue
+                subdirectories, batches = result
+                directories.extend(subdirectories)
+                pending.update(executor.submit(scan, directory) for directory in subdirectories)
+                pending.update(executor.submit(_unlink_all, paths, stats) for paths in batches)
+
+    complete = not expired()
+    if complete:
+        for directory in reversed(directories):
+            try:
+                os.rmdir(directory)
+            except FileNotFoundError:
+                continue
+            stats.directories += 1
+    stats.elapsed = time.monotonic() - start
+    return stats, complete
@@ -0,0 +1,353 @@
+"""Long running operations applied to many tenants with bounded concurrency
+
+A job is one record in the ``jobs`` table listing its tenants in the
+order they are worked on, with the state of each one. Every call to
+``advance`` polls the running tenants, pauses the job when too many have
+failed, and starts pending tenants until the concurrency window is full.
+It is called when a job is created and then from a one minute schedule,
+so a job survives any single Lambda invocation.
+
+Canary tenants come first and must all succeed before the rest of the
+fleet is started. Concurrent schedulers are kept apart with a short lease
+and a revision number checked on every save.
+"""
+
+import time
+import uuid
+
+from common.record_store import ConflictError, open_table
+from common.tenant_registry import now
+
+TABLE_NAME = 'jobs'
+KEY = 'job_id'
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+TASK_STATES = (PENDING, RUNNING, SUCCEEDED, FAILED, SKIPPED)
+
+JOB_RUNNING = 'running'
+JOB_PAUSED = 'paused'
+JOB_COMPLETED = 'completed'
+JOB_CANCELLED = 'cancelled'
+
+DEFAULT_CONCURRENCY = 5
+DEFAULT_MAX_FAILURE_RATE = 0.1
+DEFAULT_MIN_SAMPLES = 5
+DEFAULT_TASK_TIMEOUT = 3600
+DEFAULT_LEASE = 120
+
+
+def job_options(body):
+    """Checks the job settings of a bulk request before anything is changed
+
+    Returns
+    ------
+    dict of ``new_job`` keyword arguments
+
+    Raises
+    ------
+    ValueError when a setting is not of the right type
+    """
+    options = {}
+    for name, cast, default in (('concurrency', int, DEFAULT_CONCURRENCY),
+                                ('max_failure_rate', float, DEFAULT_MAX_FAILURE_RATE),
+                                ('min_samples', int, DEFAULT_MIN_SAMPLES),
+                                ('task_timeout', int, DEFAULT_TASK_TIMEOUT)):
+        try:
+            options[name] = cast(body.get(name, default))
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be a number") from None
+    canaries = body.get('canaries', ())
+    if not isinstance(canaries, (list, tuple)) or not all(
+            isinstance(canary, str) for canary in canaries):
+        raise ValueError("canaries must be a list of tenant names")
+    options['canaries'] = canaries
+    return options
+
+
+def new_job(kind, targets, params=None, concurrency=DEFAULT_CONCURRENCY, canaries=(),
+            max_failure_rate=DEFAULT_MAX_FAILURE_RATE, min_samples=DEFAULT_MIN_SAMPLES,
+            task_timeout=DEFAULT_TASK_TIMEOUT, skipped=None):
+    """Builds a job record
+
+    Parameters
+    ----------
+    kind: str, required
+        What the job does, e.g. ``upgrade``
+    targets: list, required
+        Tenant names to work on
+    params: dict
+        Job wide arguments handed to every task, e.g. the target version
+    concurrency: int
+        Maximum number of tenants worked on at the same time
+    canaries: list
+        Tenants started first; the rest wait until they all succeed
+    max_failure_rate: float
+        Failed share of finished tenants above which the job pauses
+    min_samples: int
+        Finished tenants needed before the failure rate is considered
+    task_timeout: int
+        Seconds after which a running tenant is counted as failed
+    skipped: dict
+        Tenants left out of the job, mapped to the reason
+
+    Returns
+    ------
+    dict: the job record
+    """
+    canaries = [target for target in dict.fromkeys(canaries) if target in targets]
+    order = canaries + sorted(target for target in set(targets) if target not in canaries)
+    tasks = {target: {'state': PENDING} for target in order}
+    for target, reason in (skipped or {}).items():
+        tasks[target] = {'state': SKIPPED, 'error': reason}
+    timestamp = now()
+    return {
+        KEY: uuid.uuid4().hex,
+        'kind': kind,
+        'status': JOB_RUNNING,
+        'params': params or {},
+        'concurrency': max(1, int(concurrency)),
+        'canaries': canaries,
+        'max_failure_rate': float(max_failure_rate),
+        'min_samples': max(1, int(min_samples)),
+        'task_timeout': int(task_timeout),
+        'order': order,
+        'tasks': tasks,
+        'revision': 0,
+        'created_at': timestamp,
+        'updated_at': timestamp,
+    }
+
+
+def _counts(job):
+    counts = dict.fromkeys(TASK_STATES, 0)
+    for task in job['tasks'].values():
+        counts[task['state']] += 1
+    return counts
+
+
+def _finish(task, state, error=None, clock=time.time):
+    task['state'] = state
+    task['finished'] = clock()
+    if error is not None:
+        task['error'] = error
+
+
+def advance(job, start_task, poll_task, clock=time.time):
+    """Moves a running job forward by one scheduling step
+
+    Parameters
+    ----------
+    job: dict, required
+        Job record, changed in place
+    start_task: callable, required
+        ``start_task(target, job)`` begins the work on one tenant; an
+        exception fails that tenant
+    poll_task: callable, required
+        ``poll_task(target, task, job)`` returns ``(state, error)`` with
+        state RUNNING, SUCCEEDED or FAILED
+
+    Returns
+    ------
+    dict: the job record
+    """
+    if job['status'] != JOB_RUNNING:
+        return job
+    tasks = job['tasks']
+    for target in job['order']:
+        task = tasks[target]
+        if task['state'] != RUNNING:
+            continue
+        try:
+            state, error = poll_task(target, task, job)
+        except Exception as ex:  # pylint: disable=broad-except
+            state, error = RUNNING, None
+            task['poll_error'] = f'{type(ex).__name__}: {ex}'
+        if state == RUNNING and clock() - task['started'] > job['task_timeout']:
+            state, error = FAILED, f'Timed out after {job["task_timeout"]}s'
+        if state != RUNNING:
+            _finish(task, state, error, clock)
+
+    # Failures present when an operator resumed the job do not count again
+    acknowledged = job.get('acknowledged') or {'failed': 0, 'finished': 0}
+    counts = _counts(job)
+    failed = counts[FAILED] - acknowledged['failed']
+    finished = counts[SUCCEEDED] + counts[FAILED] - acknowledged['finished']
+    canary_states = [tasks[target]['state'] for target in job['canaries']]
+    canary_failed = FAILED in canary_states and not job.get('acknowledged')
+    if canary_failed or (finished >= job['min_samples']
+                         and failed / finished > job['max_failure_rate']):
+        job['status'] = JOB_PAUSED
+        job['paused_reason'] = ('A canary tenant failed' if canary_failed else
+                                f'{failed} of {finished} tenants failed')
+        return job
+
+    canaries_done = all(state == SUCCEEDED for state in canary_states) or (
+        job.get('acknowledged') and all(state in (SUCCEEDED, FAILED) for state in canary_states))
+    slots = job['concurrency'] - counts[RUNNING]
+    for target in job['order']:
+        if slots <= 0:
+            break
+        task = tasks[target]
+        if task['state'] != PENDING:
+            continue
+        if not canaries_done and target not in job['canaries']:
+            break
+        task['state'] = RUNNING
+        task['started'] = clock()
+        task['started_at'] = now()
+        try:
+            start_task(target, job)
+        except Exception as ex:  # pylint: disable=broad-except
+            _finish(task, FAILED, f'{type(ex).__name__}: {ex}', clock)
+            continue
+        slots -= 1
+
+    counts = _counts(job)
+    if counts[PENDING] == 0 and counts[RUNNING] == 0:
+        job['status'] = JOB_COMPLETED
+    return job
+
+
+def finish_task(job, target, state, error=None, clock=time.time, **details):
+    """Records the outcome of a task run outside ``advance``, e.g. in a batch
+
+    The job completes once no task is pending or running.
+
+    Returns
+    ------
+    dict: the job record
+    """
+    task = job['tasks'][target]
+    task.update(details)
+    _finish(task, state, error, clock)
+    counts = _counts(job)
+    if job['status'] == JOB_RUNNING and counts[PENDING] == 0 and counts[RUNNING] == 0:
+        job['status'] = JOB_COMPLETED
+    return job
+
+
+def progress(job):
+    """Summary of a job for the progress endpoint"""
+    counts = _counts(job)
+    finished = counts[SUCCEEDED] + counts[FAILED]
+    total = len(job['tasks'])
+    summary = {
+        KEY: job[KEY],
+        'kind': job['kind'],
+        'status': job['status'],
+        'params': job['params'],
+        'counts': counts,
+        'total': total,
+        'percent_done': round(100 * (finished + counts[SKIPPED]) / total, 1) if total else 100.0,
+        'failure_rate': round(counts[FAILED] / finished, 3) if finished else 0.0,
+        'running': [target for target in job['order']
+                    if job['tasks'][target]['state'] == RUNNING],
+        'failed': {target: task.get('error') for target, task in job['tasks'].items()
+                   if task['state'] == FAILED},
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
+    if job.get('paused_reason'):
+        summary['paused_reason'] = job['paused_reason']
+    return summary
+
+
+class JobStore:
+    """Job records keyed by job id, saved with optimistic locking"""
+
+    def __init__(self, table=None):
+        self.table = table or open_table(TABLE_NAME, KEY)
+
+    def get(self, job_id):
+        """Returns the job ``job_id`` or None"""
+        return self.table.get(job_id)
+
+    def create(self, job):
+        """Stores a new job"""
+        self.table.put_if(job, 'revision', None)
+        return job
+
+    def save(self, job):
+        """Stores a changed job unless another writer saved it first
+
+        Raises
+        ------
+        ConflictError when the stored revision is no longer the one read
+        """
+        revision = job['revision']
+        job['revision'] = revision + 1
+        job['updated_at'] = now()
+        try:
+            self.table.put_if(job, 'revision', revision)
+        except ConflictError:
+            job['revision'] = revision
+            raise
+        return job
+
+    def active(self, kind=None):
+        """Returns every running job, optionally of one kind only"""
+        return [job for job in self.table.scan()
+                if job['status'] == JOB_RUNNING and (kind is None or job['kind'] == kind)]
+
+    def step(self, job, start_task, poll_task, lease=DEFAULT_LEASE, clock=time.time):
+        """Advances a job and saves it
+
+        The job is leased first, so only one scheduler works on it at a
+        time. A pause or cancel saved while the step ran is kept.
+
+        Returns
+        ------
+        dict: the job as stored
+        """
+        if job.get('lease_until', 0) > clock():
+            return job
+        job['lease_until'] = clock() + lease
+        try:
+            self.save(job)
+        except ConflictError:
+            return self.get(job[KEY])
+        advance(job, start_task, poll_task, clock)
+        job['lease_until'] = 0
+        try:
+            return self.save(job)
+        except ConflictError:
+            stored = self.get(job[KEY])
+            stored['tasks'] = job['tasks']
+            stored['lease_until'] = 0
+            if stored['status'] == JOB_RUNNING:
+                stored['status'] = job['status']
+                if job.get('paused_reason'):
+                    stored['paused_reason'] = job['paused_reason']
+            return self.save(stored)
+
+    def set_status(self, job_id, status, reason=None, attempts=5):
+        """Pauses, resumes or cancels a job
+
+        Returns
+        ------
+        dict: the saved job, or None if there is no such job
+        """
+        for _ in range(attempts):
+            job = self.get(job_id)
+            if job is None:
+                return None
+            if job['status'] in (JOB_COMPLETED, JOB_CANCELLED):
+                return job
+            if job['status'] == JOB_PAUSED and status == JOB_RUNNING:
+                counts = _counts(job)
+                job['acknowledged'] = {'failed': counts[FAILED],
+                                       'finished': counts[SUCCEEDED] + counts[FAILED]}
+            job['status'] = status
+            if reason:
+                job['paused_reason'] = reason
+            else:
+                job.pop('paused_reason', None)
+            try:
+                return self.save(job)
+            except ConflictError:
+                continue
+        raise ConflictError(job_id)
@@ -0,0 +1,263 @@
+"""Client for the Veracity LRS admin API
+
+Every call goes through one keep-alive ``requests.Session`` with a
+connection pool, so provisioning and deleting a tenant reuse the TLS
+connection instead of opening one per request. Requests have a timeout
+and are retried with exponential backoff and jitter when the LRS answers
+429 or a 5xx status, honouring ``Retry-After``. A POST is only retried
+when the LRS rejected it without acting on it (429 or 503, or the
+connection timed out), so retries never create a record twice.
+Any other error status is raised as ``LRSError`` instead of being
+ignored.
+
+``scripts/fake_lrs.py`` serves the same endpoints locally, with injected
+rate limiting, to exercise the client without a Veracity instance.
+"""
+
+import random
+import time
+from dataclasses import dataclass
+
+import requests
+
+from common import runtime
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 0.5
+DEFAULT_PAGE_SIZE = 100
+MAX_BACKOFF = 20.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses returned before the LRS acted on a request
+REJECTED_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class LRSError(Exception):
+    """The LRS answered with an error status, or could not be reached"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass(frozen=True)
+class LRSUser:
+    """A Veracity user account"""
+    uuid: str
+    email: str
+    username: str = None
+
+    @classmethod
+    def from_json(cls, data):
+        """User from a record of the admin API"""
+        return cls(data['uuid'], data.get('email'), data.get('username'))
+
+
+@dataclass(frozen=True)
+class LRSInstance:
+    """One LRS, named after its tenant"""
+    id: str
+    name: str
+    active: bool = True
+
+    @classmethod
+    def from_json(cls, data):
+        """LRS instance from a record of the admin API"""
+        return cls(data['_id'], data['lrsName'], data.get('active', True))
+
+
+@dataclass(frozen=True)
+class AccessKey:
+    """An xAPI access key of one LRS"""
+    username: str
+    name: str = None
+    enabled: bool = True
+
+    @classmethod
+    def from_json(cls, data):
+        """Access key from a record of the admin API"""
+        return cls(data['username'], data.get('name'), data.get('enabled', True))
+
+
+class LRSClient:
+    """Veracity admin API calls over a pooled session with bounded retries
+
+    Parameters
+    ----------
+    admin_url: str, required
+        Admin API root ending in ``/``, e.g. ``https://lrs.example/admin/api/``
+    api_key: str, required
+    base_url: str
+        LRS root ending in ``/``, needed for access keys only
+    session: requests.Session
+        The shared pooled session of the execution environment by default
+    """
+
+    def __init__(self, admin_url, api_key, base_url=None, session=None,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 sleep=time.sleep):
+        self.admin_url = admin_url
+        self.base_url = base_url
+        self.session = session or runtime.http()
+        self.headers = {"Content-Type": "application/json", "x-veracity-api-key": api_key}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.retried = 0
+
+    @classmethod
+    def from_base_url(cls, base_url, api_key, **kwargs):
+        """Client for an LRS whose admin API lives under ``admin/api/``"""
+        return cls(f'{base_url}admin/api/', api_key, base_url=base_url, **kwargs)
+
+    def _delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(MAX_BACKOFF, float(retry_after))
+        return min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def request(self, method, url, expected=(), **kwargs):
+        """Sends one request, retrying transient failures
+
+        Parameters
+        ----------
+        expected: tuple
+            Error statuses returned to the caller instead of raised
+
+        Raises
+        ------
+        LRSError when the LRS answers with an unexpected error status or
+        cannot be reached within the retries
+        """
+        retryable = method in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = self.session.request(method, url, headers=self.headers,
+                                                timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                # Only a connect timeout guarantees the LRS never saw the request
+                unsent = isinstance(ex, requests.exceptions.ConnectTimeout)
+                if last or not (retryable or unsent):
+                    raise LRSError(f'{method} {url}: {type(ex).__name__}') from ex
+                self.retried += 1
+                self.sleep(self._delay(attempt))
+                continue
+            status = response.status_code
+            if status < 400 or status in expected:
+                return response
+            if not last and status in RETRY_STATUSES and (
+                    retryable or status in REJECTED_STATUSES):
+                self.retried += 1
+                self.sleep(self._delay(attempt, response))
+                continue
+            raise LRSError(f'{method} {url} returned {status}: {response.text[:200]}', status)
+        raise LRSError(f'{method} {url}: no attempt left')
+
+    def find_user(self, email):
+        """Returns the user registered with ``email`` or None"""
+        response = self.request('GET', f'{self.admin_url}user',
+                                params={'search': f'{{"email": "{email}"}}'})
+        users = response.json()
+        return LRSUser.from_json(users[0]) if users else None
+
+    def create_user(self, email, password, accepts_tos):
+        """Creates a verified user with a public account"""
+        response = self.request('POST', f'{self.admin_url}user', json={
+            "username": email,
+            "email": email,
+            "publicAccount": True,
+            "password": password,
+            "acceptsTOS": accepts_tos,
+            "verifiedEmail": True
+        })
+        return LRSUser.from_json(response.json())
+
+    def iter_lrs(self, page_size=DEFAULT_PAGE_SIZE):
+        """Yields every LRS, fetching one page of ``page_size`` at a time
+
+        Stop iterating to stop fetching pages. An LRS seen on an earlier
+        page is not yielded again, and a page with nothing new ends the
+        listing, so an API ignoring ``skip`` cannot loop forever.
+        """
+        seen = set()
+        skip = 0
+        while True:
+            response = self.request('GET', f'{self.admin_url}lrs',
+                                    params={'limit': page_size, 'skip': skip})
+            page = [LRSInstance.from_json(lrs) for lrs in response.json()]
+            fresh = [instance for instance in page if instance.id not in seen]
+            yield from fresh
+            if len(page) < page_size or not fresh:
+                return
+            seen.update(instance.id for instance in fresh)
+            skip += page_size
+
+    def list_lrs(self):
+        """Returns every LRS"""
+        return list(self.iter_lrs())
+
+    def find_lrs(self, name):
+        """Returns the LRS instances named ``name``
+
+        Asks the API to filter by name first. When the answer shows the
+        filter was ignored, falls back to paging through the whole
+        listing, as it is not ordered by name.
+        """
+        response = self.request('GET', f'{self.admin_url}lrs', params={
+            'search': f'{{"lrsName": "{name}"}}', 'limit': DEFAULT_PAGE_SIZE})
+        found = [LRSInstance.from_json(lrs) for lrs in response.json()]
+        if all(instance.name == name for instance in found):
+            return found
+        return [instance for instance in self.iter_lrs() if instance.name == name]
+
+    def create_lrs(self, name, owner, permissions):
+        """Creates an LRS owned by ``owner`` with per-user ``permissions``
+
+        Returns
+        ------
+        LRSInstance, or None when the API does not return the new record
+        """
+        response = self.request('POST', f'{self.admin_url}lrs', json={
+            "owner": owner,
+            "lrsName": name,
+            "active": True,
+            "strict": False,
+            "compatibilityLevel": 0,
+            "verboseLogs": True,
+            "permissions": permissions
+        })
+        created = response.json() if response.content else None
+        return LRSInstance.from_json(created) if created and '_id' in created else None
+
+    def delete_lrs(self, lrs_id):
+        """Deletes an LRS by id; returns False when it did not exist"""
+        response = self.request('DELETE', f'{self.admin_url}lrs/{lrs_id}', expected=(404,))
+        return response.status_code != 404
+
+    def _keys_url(self, lrs_name):
+        if self.base_url is None:
+            raise ValueError('Access keys need the base_url of the LRS')
+        return f'{self.base_url}api/{lrs_name}/xapi-access-keys'
+
+    def access_keys(self, lrs_name):
+        """Returns the xAPI access keys of LRS ``lrs_name``"""
+        response = self.request('GET', self._keys_url(lrs_name))
+        return [AccessKey.from_json(key) for key in response.json()]
+
+    def create_access_key(self, lrs_name, username, password):
+        """Creates a read and write xAPI access key with basic auth"""
+        self.request('POST', self._keys_url(lrs_name), json={
+            "name": username,
+            "read": True,
+            "write": True,
+            "jwt": False,
+            "enabled": True,
+            "advancedQueries": True,
+            "limitedRead": False,
+            "username": username,
+            "password": password
+        })
+        return AccessKey(username, username)
@@ -0,0 +1,243 @@
+"""Loads a starter dump with one connection per table worker
+
+Once the schema statements have run, the INSERTs of different tables are
+independent. They are grouped by table and loaded through a bounded
+mysql.connector pool, largest tables first, and the resulting row counts
+are checked against the counts recorded for each INSERT. Triggers are
+created after all the data, as a mysqldump replay does, so they never
+fire during the load.
+"""
+
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mysql.connector import pooling
+
+from common.sql_import import ImportStats, count_rows, import_statements
+
+# mysql.connector refuses pools larger than this.
+MAX_POOL_SIZE = 32
+# Per-session statements are only honoured by the connection that runs
+# them, so they are replayed on every worker connection.
+SESSION_KINDS = ('set',)
+# Table locks are per-connection and would serialise the workers again.
+SKIPPED_KINDS = ('lock', 'unlock')
+# mysqldump writes triggers as /*!50003 CREATE*/ /*!50017 DEFINER=...*/ /*!50003 TRIGGER
+_TRIGGER = re.compile(r'\s*(?:/\*!\d*\s*)?CREATE\b(?:\s|\*/|/\*!\d*|DEFINER\s*=\s*\S+)*TRIGGER\b',
+                      re.IGNORECASE)
+
+
+def is_trigger(statement):
+    """Whether ``statement`` creates a trigger"""
+    return statement.kind == 'create' and _TRIGGER.match(statement.sql) is not None
+
+
+class LoadPlan:
+    """A dump split into serial schema statements, per-table data and triggers
+
+    Each trigger keeps the SET statements mysqldump wraps it in, which
+    select the sql_mode and character set it is created with.
+    """
+
+    def __init__(self, statements):
+        self.session = []
+        self.schema = []
+        self.tables = {}
+        self.triggers = []
+        after_trigger = False
+        for statement in statements:
+            if statement.kind == 'insert' and statement.table and not statement.standalone:
+                self.tables.setdefault(statement.table, []).append(statement)
+                continue
+            if statement.kind in SKIPPED_KINDS:
+                continue
+            if is_trigger(statement):
+                wrapper = []
+                while self.schema and self.schema[-1].kind in SESSION_KINDS and (
+                        not self.session or self.schema[-1] is not self.session[-1]):
+                    wrapper.insert(0, self.schema.pop())
+                self.triggers.extend(wrapper + [statement])
+                after_trigger = True
+                continue
+            if after_trigger and statement.kind in SESSION_KINDS:
+                self.triggers.append(statement)
+                continue
+            after_trigger = False
+            if statement.kind in SESSION_KINDS and not self.tables:
+                self.session.append(statement)
+            self.schema.append(statement)
+
+    def expected_rows(self):
+        """Rows each table should hold, for tables where every INSERT is countable"""
+        expected = {}
+        for table, inserts in self.tables.items():
+            rows = 0
+            for statement in inserts:
+                if statement.rows is None:
+                    statement.rows = count_rows(statement.sql)
+                if statement.rows is None:
+                    break
+                rows += statement.rows
+            else:
+                expected[table] = rows
+        return expected
+
+    def created_tables(self):
+        """Tables the dump leaves behind, which excludes the stand-in
+        tables mysqldump creates for views and drops again"""
+        created = set()
+        for statement in self.schema:
+            if statement.kind == 'create' and statement.table:
+                created.add(statement.table)
+            elif statement.kind == 'drop' and statement.table:
+                created.discard(statement.table)
+        return created
+
+    def tables_by_size(self):
+        """Table names, largest amount of data first"""
+        return sorted(self.tables,
+                      key=lambda table: sum(s.size for s in self.tables[table]),
+                      reverse=True)
+
+
+def _load_table(pool, plan, table, errors):
+    connection = pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        for statement in plan.session:
+            cursor.execute(statement.sql)
+        cursor.close()
+        return import_statements(connection, plan.tables[table], errors)
+    finally:
+        connection.close()
+
+
+def count_table_rows(connection, tables):
+    """Returns the current row count of each table"""
+    cursor = connection.cursor()
+    counts = {}
+    for table in tables:
+        cursor.execute(f'SELECT COUNT(*) FROM `{table}`')
+        counts[table] = cursor.fetchone()[0]
+    cursor.close()
+    return counts
+
+
+def verify_row_counts(connection, expected):
+    """Compares table sizes with the expected counts
+
+    Returns
+    ------
+    dict mapping each mismatched table to ``(expected, actual)``
+    """
+    actual = count_table_rows(connection, expected)
+    return {table: (rows, actual[table])
+            for table, rows in expected.items() if actual[table] != rows}
+
+
+def compare_with_dump(connection, database, statements):
+    """Tables of ``database`` that lack rows the dump would insert, and data beyond it
+
+    A table is incomplete when the dump creates it and it is missing, or
+    holds fewer rows than the dump inserts. More rows, or tables the dump
+    does not create, mean the CMS has been writing to the database since
+    it was loaded. Tables with INSERTs whose rows cannot be counted are
+    only incomplete when empty, otherwise they are unknown.
+
+    Returns
+    ------
+    tuple of (dict mapping each incomplete table to ``(expected, actual)``,
+    with actual None when the table does not exist, dict mapping each
+    table with more data than the dump to ``(expected, actual)``, and
+    dict mapping each unknown table to its row count)
+    """
+    plan = LoadPlan(statements)
+    counted = plan.expected_rows()
+    created = plan.created_tables()
+    cursor = connection.cursor()
+    cursor.execute('SELECT table_name FROM information_schema.tables '
+                   "WHERE table_schema = %s AND table_type = 'BASE TABLE'", (database,))
+    present = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    actual = count_table_rows(connection, sorted(present))
+    incomplete, grown, unknown = {}, {}, {}
+    for table in sorted(created | present):
+        rows = actual.get(table)
+        # None when the dump inserts rows that cannot be counted
+        expected = counted.get(table, None if table in plan.tables else 0)
+        if table not in created:
+            grown[table] = (0, rows)
+        elif rows is None or (expected is None and rows == 0):
+            incomplete[table] = (expected, rows)
+        elif expected is None:
+            unknown[table] = rows
+        elif rows < expected:
+            incomplete[table] = (expected, rows)
+        elif rows > expected:
+            grown[table] = (expected, rows)
+    return incomplete, grown, unknown
+
+
+def load_parallel(connect_args, statements, errors, concurrency):
+    """Loads a dump with up to ``concurrency`` table workers
+
+    Parameters
+    ----------
+    connect_args: dict, required
+        Keyword arguments for mysql.connector.connect, including database
+    statements: iterable of Statement, required
+    errors: exception class or tuple, required
+        Server errors that are logged and skipped instead of aborting
+    concurrency: int, required
+        Number of table workers and pooled connections
+
+    Returns
+    ------
+    tuple of (ImportStats, dict of row count mismatches)
+    """
+    start = time.monotonic()
+    plan = LoadPlan(statements)
+    pool = pooling.MySQLConnectionPool(pool_name='starter_load',
+                                       pool_size=max(1, min(concurrency, MAX_POOL_SIZE)),
+                                       **connect_args)
+    stats = ImportStats()
+
+    connection = pool.get_connection()
+    try:
+        schema_stats = import_statements(connection, plan.schema, errors)
+    finally:
+        connection.close()
+    print(f'Schema loaded: {schema_stats.summary()}')
+    results = [schema_stats]
+
+    with ThreadPoolExecutor(max_workers=pool.pool_size) as executor:
+        futures = {table: executor.submit(_load_table, pool, plan, table, errors)
+                   for table in plan.tables_by_size()}
+        for table, future in futures.items():
+            table_stats = future.result()
+            print(f'Table {table} loaded: {table_stats.summary()}')
+            results.append(table_stats)
+
+    for result in results:
+        stats.statements += result.statements
+        stats.bytes += result.bytes
+        stats.batches += result.batches
+        stats.failed += result.failed
+
+    connection = pool.get_connection()
+    try:
+        if plan.triggers:
+            trigger_stats = import_statements(connection, plan.session + plan.triggers, errors)
+            print(f'Triggers created: {trigger_stats.summary()}')
+            stats.statements += trigger_stats.statements
+            stats.bytes += trigger_stats.bytes
+            stats.batches += trigger_stats.batches
+            stats.failed += trigger_stats.failed
+        mismatches = verify_row_counts(connection, plan.expected_rows())
+    finally:
+        connection.close()
+    for table, (expected, actual) in mismatches.items():
+        print(f'[WARN] Table {table} has {actual} rows, expected {expected}')
+    stats.elapsed = time.monotonic() - start
+    return stats, mismatches
@@ -0,0 +1,227 @@
+"""Listener rule priorities for tenant stacks
+
+Every tenant stack adds a host-header rule with the same priority to the
+application and the Solr load balancer listeners, and a priority can be
+used only once per listener, so the rules of the application listener
+tell which priorities are taken on both. Instead of reading every rule
+of the listener to take the highest priority plus one, the used
+priorities are kept as a bitmap in one record of the ``priorities``
+table, with the priority each tenant owns. Allocating reads that
+record, takes the lowest free bit and writes the record back
+conditionally on its revision, so two concurrent creates can never get
+the same priority and gaps left by deleted tenants are filled first.
+
+A released priority stays quarantined for a while, because the rule of
+the deleted stack lives on until CloudFormation has removed it. When
+the record is missing, or a create failed in a way that suggests the
+bitmap drifted from the listeners, it is rebuilt from a paginated scan
+of every rule of the application listener.
+"""
+
+import base64
+import random
+import time
+
+from common.record_store import ConflictError, open_table
+from common.tenant_registry import now
+
+TABLE_NAME = 'priorities'
+KEY = 'pool'
+POOL = 'listener_rules'
+# Highest priority an application load balancer accepts
+MAX_PRIORITY = 50000
+DEFAULT_QUARANTINE = 3600
+# Conditional writes tried before giving up under contention
+ATTEMPTS = 25
+
+
+class PrioritiesExhausted(Exception):
+    """Every listener rule priority is taken"""
+
+
+def listener_priorities(elb_client, listener_arns):
+    """Priority of every rule of the listeners, mapped to the tenant it serves
+
+    Follows NextMarker through every page. The tenant is the first label
+    of the rule's host header, or None for rules that are not a tenant's.
+    """
+    used = {}
+    for listener_arn in listener_arns:
+        arguments = {'ListenerArn': listener_arn, 'PageSize': 400}
+        while True:
+            page = elb_client.describe_rules(**arguments)
+            for rule in page['Rules']:
+                if not str(rule.get('Priority', '')).isdigit():
+                    continue
+                hosts = [value for condition in rule.get('Conditions', [])
+                         if condition.get('Field') == 'host-header'
+                         for value in (condition.get('HostHeaderConfig', {}).get('Values')
+                                       or condition.get('Values', []))]
+                tenant = hosts[0].split('.')[0] if hosts else None
+                used.setdefault(int(rule['Priority']), tenant)
+            if not page.get('NextMarker'):
+                break
+            arguments['Marker'] = page['NextMarker']
+    return used
+
+
+def _decode(record):
+    return bytearray(base64.b64decode(record['bitmap']))
+
+
+def _encode(bitmap):
+    return base64.b64encode(bytes(bitmap)).decode()
+
+
+def _is_set(bitmap, priority):
+    return bitmap[priority >> 3] & (1 << (priority & 7))
+
+
+def _set(bitmap, priority):
+    bitmap[priority >> 3] |= 1 << (priority & 7)
+
+
+def _clear(bitmap, priority):
+    bitmap[priority >> 3] &= ~(1 << (priority & 7)) & 0xFF
+
+
+class PriorityAllocator:
+    """Hands out listener rule priorities, one per tenant"""
+
+    def __init__(self, table=None, pool=POOL, max_priority=MAX_PRIORITY,
+                 quarantine=DEFAULT_QUARANTINE, clock=time.time):
+        self.table = table or open_table(TABLE_NAME, KEY)
+        self.pool = pool
+        self.max_priority = max_priority
+        self.quarantine = quarantine
+        self.clock = clock
+
+    def _empty(self):
+        return {KEY: self.pool, 'bitmap': _encode(bytearray(self.max_priority // 8 + 1)),
+                'owners': {}, 'released': {}, 'revision': None}
+
+    def _save(self, record):
+        expected = record['revision']
+        record = dict(record, revision=(expected or 0) + 1, updated_at=now())
+        self.table.put_if(record, 'revision', expected)
+        return record
+
+    def _change(self, change):
+        """Applies ``change(record)`` and saves it, retrying on conflicts"""
+        for attempt in range(ATTEMPTS):
+            record = self.table.get(self.pool) or self._empty()
+            result = change(record)
+            try:
+                self._save(record)
+            except ConflictError:
+                time.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+                continue
+            return result
+        raise ConflictError(self.pool)
+
+    def priority_of(self, tenant):
+        """Priority owned by ``tenant``, or None"""
+        record = self.table.get(self.pool)
+        return record['owners'].get(tenant) if record else None
+
+    def _first_free(self, bitmap, released):
+        cutoff = self.clock() - self.quarantine
+        for index, byte in enumerate(bitmap):
+            if byte == 0xFF:
+                continue
+            for priority in range(max(index * 8, 1), min(index * 8 + 8, self.max_priority + 1)):
+                if _is_set(bitmap, priority) or released.get(str(priority), cutoff) > cutoff:
+                    continue
+                return priority
+        raise PrioritiesExhausted(f'No free listener rule priority up to {self.max_priority}')
+
+    def allocate(self, tenant, scan, rebuild=False):
+        """Returns the priority of ``tenant``, allocating the lowest free one
+
+        Parameters
+        ----------
+        scan: callable, required
+            Returns every priority used on the listeners, as
+            ``listener_priorities`` does; only called to rebuild
+        rebuild: bool
+            Rebuild the bitmap from ``scan`` first, e.g. after a create
+            failed on a priority that was already taken
+        """
+        return self.allocate_all([tenant], scan, rebuild)[tenant]
+
+    def allocate_all(self, tenants, scan, rebuild=False):
+        """Allocates a priority to every tenant of ``tenants`` in one write
+
+        Tenants that already own a priority keep it.
+
+        Returns
+        ------
+        dict of tenant to priority
+        """
+        if rebuild or self.table.get(self.pool) is None:
+            self.rebuild(scan())
+
+        def take(record):
+            bitmap = _decode(record)
+            allocated = {}
+            for tenant in tenants:
+                if tenant not in record['owners']:
+                    priority = self._first_free(bitmap, record['released'])
+                    _set(bitmap, priority)
+                    record['owners'][tenant] = priority
+                    record['released'].pop(str(priority), None)
+                allocated[tenant] = record['owners'][tenant]
+            record['bitmap'] = _encode(bitmap)
+            return allocated
+        return self._change(take)
+
+    def release(self, *tenants):
+        """Frees the priorities of ``tenants`` once their quarantine is over"""
+        # An empty record would hide that the bitmap still has to be built
+        if not tenants or self.table.get(self.pool) is None:
+            return []
+
+        def free(record):
+            bitmap = _decode(record)
+            cutoff = self.clock() - self.quarantine
+            record['released'] = {priority: released
+                                  for priority, released in record['released'].items()
+                                  if released >= cutoff}
+            freed = []
+            for tenant in tenants:
+                priority = record['owners'].pop(tenant, None)
+                if priority is None:
+                    continue
+                _clear(bitmap, priority)
+                record['released'][str(priority)] = self.clock()
+                freed.append(priority)
+            record['bitmap'] = _encode(bitmap)
+            return freed
+        return self._change(free)
+
+    def rebuild(self, used):
+        """Replaces the bitmap with the priorities actually used on the listeners
+
+        Parameters
+        ----------
+        used: dict, required
+            Priority mapped to the tenant whose rule holds it, or None
+        """
+        def replace(record):
+            owners = {tenant: priority for priority, tenant in sorted(used.items()) if tenant}
+            # Priorities handed out to stacks that have no rule yet stay taken,
+            # unless another rule turned out to hold them
+            for tenant, priority in record['owners'].items():
+                if tenant not in owners and priority not in used:
+                    owners[tenant] = priority
+            bitmap = bytearray(self.max_priority // 8 + 1)
+            for priority in set(used) | set(owners.values()):
+                if 0 < priority <= self.max_priority:
+                    _set(bitmap, priority)
+            record['bitmap'] = _encode(bitmap)
+            record['owners'] = owners
+            record['rebuilt_at'] = now()
+            return len(used)
+        rules = self._change(replace)
+        print(f'Rebuilt listener rule priorities from {rules} rules')
+        return rules
@@ -0,0 +1,440 @@
+"""Tenant provisioning as a graph of dependent stages
+
+``PIPELINE`` lists every stage of creating a tenant, the Lambda function
+that runs it and the stages it needs first. Stages that do not depend on
+each other run in parallel: the database import, the LRS and the stack
+start together, the public files and the Solr index are copied as soon
+as the tenant's EFS directory exists, and the CMS deploy waits only for
+the database, the files, the index and the stack.
+
+The graph runs in AWS as the Step Functions state machine built by
+``state_machine`` (``scripts/provisioning_definition.py`` prints it for
+the CloudFormation template) and locally through ``run_pipeline``. Each
+stage records its start, end and duration in the ``provisioning`` table,
+so ``critical_path`` can tell which chain of stages bounds the total.
+
+Those records double as checkpoints. A stage that already succeeded for
+a tenant is skipped when provisioning is retried, and every stage
+handler tolerates the leftovers of an attempt that failed halfway, so a
+retry resumes at the first incomplete stage instead of starting over.
+"""
+
+import functools
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from common.record_store import open_table
+from common.tenant_registry import now
+
+TABLE_NAME = 'provisioning'
+KEY = 'stage_id'
+
+# Fields finish() stores about the outcome of an attempt
+OUTCOME_FIELDS = ('finished_at', 'seconds', 'error')
+
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Payload handed to a stage function
+API_EVENT = 'event'
+TENANT_DATA = 'tenant_data'
+# How the state machine retries a stage that raised StageNotReady
+NOT_READY_INTERVAL = 30
+NOT_READY_ATTEMPTS = 60
+
+
+@dataclass(frozen=True)
+class Stage:
+    """One step of provisioning a tenant"""
+    name: str
+    function: str
+    requires: tuple = ()
+    payload: str = API_EVENT
+
+
+PIPELINE = (
+    Stage('db', 'create_db', payload=TENANT_DATA),
+    Stage('lrs', 'create_lrs', payload=TENANT_DATA),
+    Stage('stack', 'create_stack'),
+    Stage('files', 'create_files_directories', requires=('stack',)),
+    Stage('solr', 'create_solr_fs', requires=('stack',)),
+    Stage('deploy', 'admin_function', requires=('db', 'stack', 'files', 'solr')),
+)
+
+
+class StageFailed(Exception):
+    """A stage function returned an error response instead of raising"""
+
+
+class StageNotReady(Exception):
+    """A stage has to wait for something, e.g. a stack deletion, and is retried later"""
+
+
+def tenant_of(event):
+    """Tenant name from either kind of stage payload"""
+    data = event if 'TENANT' in event else json.loads(event['body'])
+    return data['TENANT'].lower()
+
+
+class ProvisioningLog:
+    """Start, end and outcome of every provisioning stage of every tenant"""
+
+    def __init__(self, table=None):
+        self.table = table or open_table(TABLE_NAME, KEY)
+
+    @staticmethod
+    def _key(tenant, stage_name):
+        return f'{tenant}/{stage_name}'
+
+    def get(self, tenant, stage_name):
+        """Returns the record of one stage of ``tenant`` or None"""
+        return self.table.get(self._key(tenant, stage_name))
+
+    def start(self, tenant, stage_name):
+        """Records that stage ``stage_name`` of ``tenant`` has started
+
+        Notes of an earlier attempt are kept, its outcome is not.
+        """
+        previous = self.get(tenant, stage_name) or {}
+        for field in OUTCOME_FIELDS:
+            previous.pop(field, None)
+        record = dict(previous, **{
+            KEY: self._key(tenant, stage_name),
+            'tenant': tenant,
+            'stage': stage_name,
+            'status': RUNNING,
+            'attempts': previous.get('attempts', 0) + 1,
+            'started': time.time(),
+            'started_at': now(),
+        })
+        self.table.put(record)
+        return record
+
+    def finish(self, tenant, stage_name, status, error=None):
+        """Records the outcome of stage ``stage_name`` of ``tenant`` and its duration"""
+        record = self.get(tenant, stage_name) or {'started': time.time()}
+        fields = {'status': status, 'finished_at': now(),
+                  'seconds': round(time.time() - record['started'], 3)}
+        if error is not None:
+            fields['error'] = error
+        return self.table.update(self._key(tenant, stage_name), fields)
+
+    def note(self, tenant, stage_name, **fields):
+        """Keeps facts a running stage learnt, e.g. the id of what it created"""
+        return self.table.update(self._key(tenant, stage_name), fields)
+
+    def stages(self, tenant, pipeline=PIPELINE):
+        """Returns the records of every stage of ``tenant`` that has run"""
+        records = {step.name: self.get(tenant, step.name) for step in pipeline}
+        return {name: record for name, record in records.items() if record}
+
+    def succeeded(self, tenant, stage_name):
+        """Whether stage ``stage_name`` of ``tenant`` has completed"""
+        record = self.get(tenant, stage_name)
+        return record is not None and record['status'] == SUCCEEDED
+
+    def incomplete(self, tenant, pipeline=PIPELINE):
+        """Names of the stages of ``tenant`` that have not succeeded, in order"""
+        return [step.name for step in pipeline if not self.succeeded(tenant, step.name)]
+
+    def forget(self, tenant, pipeline=PIPELINE):
+        """Removes every stage record of ``tenant``"""
+        for step in pipeline:
+            self.table.delete(self._key(tenant, step.name))
+
+
+def stage(name):
+    """Records the duration and outcome of a stage handler
+
+    The handler is not called again once its stage has succeeded for the
+    tenant, which makes a retried provisioning resume where it stopped.
+    A response with a ``statusCode`` of 400 or more counts as a failure
+    and is raised as ``StageFailed``, so the state machine stops the
+    stages that depend on it.
+    """
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            tenant = tenant_of(event)
+            log = ProvisioningLog()
+            if log.succeeded(tenant, name):
+                print(f'Stage {name} of {tenant} already succeeded, skipping it')
+                return {'statusCode': 200, 'skipped': True}
+            log.start(tenant, name)
+            try:
+                result = handler(event, context)
+                if isinstance(result, dict) and result.get('statusCode', 200) >= 400:
+                    raise StageFailed(f'{name} returned {result["statusCode"]}: '
+                                      f'{result.get("body")}')
+            except Exception as ex:
+                log.finish(tenant, name, FAILED, f'{type(ex).__name__}: {ex}')
+                raise
+            log.finish(tenant, name, SUCCEEDED)
+            return result
+        return wrapper
+    return decorate
+
+
+def _validate(pipeline):
+    names = [step.name for step in pipeline]
+    for step in pipeline:
+        for required in step.requires:
+            if required not in names:
+                raise ValueError(f'{step.name} requires unknown stage {required}')
+    order = []
+    remaining = list(pipeline)
+    while remaining:
+        ready = [step for step in remaining if set(step.requires) <= set(order)]
+        if not ready:
+            raise ValueError(f'Cycle between {[step.name for step in remaining]}')
+        order.extend(step.name for step in ready)
+        remaining = [step for step in remaining if step not in ready]
+    return order
+
+
+def run_pipeline(pipeline, run_stage, workers=None, clock=time.monotonic):
+    """Runs every stage in-process as soon as the stages it needs succeed
+
+    Parameters
+    ----------
+    pipeline: tuple of Stage, required
+    run_stage: callable, required
+        ``run_stage(stage)`` runs one stage and raises when it fails
+    workers: int
+        Stages run at the same time, all of them by default
+
+    Returns
+    ------
+    dict of stage name to ``{'status', 'started', 'seconds', 'error'}``,
+    with ``started`` relative to the start of the run
+    """
+    _validate(pipeline)
+    origin = clock()
+    timings = {}
+    pending = list(pipeline)
+    running = {}
+
+    def timed(step):
+        started = clock()
+        try:
+            run_stage(step)
+        except Exception as ex:  # pylint: disable=broad-except
+            return step, started, f'{type(ex).__name__}: {ex}'
+        return step, started, None
+
+    with ThreadPoolExecutor(max_workers=workers or len(pipeline)) as executor:
+        while pending or running:
+            for step in list(pending):
+                states = [timings.get(name, {}).get('status') for name in step.requires]
+                if any(state in (FAILED, SKIPPED) for state in states):
+                    timings[step.name] = {'status': SKIPPED, 'started': None, 'seconds': 0.0,
+                                          'error': None}
+                    pending.remove(step)
+                elif all(state == SUCCEEDED for state in states):
+                    running[executor.submit(timed, step)] = step
+                    pending.remove(step)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, started, error = future.result()
+                del running[future]
+                timings[step.name] = {
+                    'status': FAILED if error else SUCCEEDED,
+                    'started': round(started - origin, 3),
+                    'seconds': round(clock() - started, 3),
+                    'error': error,
+                }
+    return timings
+
+
+def critical_path(pipeline, seconds):
+    """Chain of stages with the longest total duration
+
+    Parameters
+    ----------
+    pipeline: tuple of Stage, required
+    seconds: dict, required
+        Duration of each stage
+
+    Returns
+    ------
+    tuple of (list of stage names, total seconds)
+    """
+    stages = {step.name: step for step in pipeline}
+    best = {}
+    for name in _validate(pipeline):
+        previous = max((best[required] for required in stages[name].requires),
+                       key=lambda path: path[1], default=([], 0.0))
+        best[name] = (previous[0] + [name], previous[1] + (seconds.get(name) or 0.0))
+    return max(best.values(), key=lambda path: path[1], default=([], 0.0))
+
+
+def _error_field(name):
+    # Field of the state holding why a stage did not succeed
+    return f'{name}_error'
+
+
+def _task(step):
+    payload = 'States.StringToJson($.body)' if step.payload == TENANT_DATA else '$'
+    return {
+        'Type': 'Task',
+        'Resource': 'arn:aws:states:::lambda:invoke',
+        'Parameters': {'FunctionName': step.function, 'Payload.$': payload},
+        'ResultPath': None,
+        'Retry': [{
+            'ErrorEquals': ['Lambda.ServiceException', 'Lambda.TooManyRequestsException',
+                            'Lambda.SdkClientException'],
+            'IntervalSeconds': 2,
+            'MaxAttempts': 3,
+            'BackoffRate': 2.0,
+        }, {
+            # Polls with the state machine's own waits instead of in the function
+            'ErrorEquals': [StageNotReady.__name__],
+            'IntervalSeconds': NOT_READY_INTERVAL,
+            'MaxAttempts': NOT_READY_ATTEMPTS,
+            'BackoffRate': 1.0,
+        }],
+        # A failed stage only stops the stages that need it, as in run_pipeline
+        'Catch': [{
+            'ErrorEquals': ['States.ALL'],
+            'ResultPath': '$.' + _error_field(step.name),
+            'Next': f'{step.name} failed',
+        }],
+    }
+
+
+def _failed_condition(names):
+    conditions = [{'Variable': '$.' + _error_field(name), 'IsPresent': True} for name in names]
+    return conditions[0] if len(conditions) == 1 else {'Or': conditions}
+
+
+def _stage(step):
+    """States of one stage, as (first state, states, states that go on to the next)"""
+    states = {step.name: _task(step), f'{step.name} failed': {'Type': 'Pass'}}
+    exits = [step.name, f'{step.name} failed']
+    if not step.requires:
+        return step.name, states, exits
+    check = f'Check {step.name}'
+    skip = f'Skip {step.name}'
+    states[check] = {
+        'Type': 'Choice',
+        'Choices': [dict(_failed_condition(step.requires), Next=skip)],
+        'Default': step.name,
+    }
+    states[skip] = {
+        'Type': 'Pass',
+        'Result': {'Error': 'Skipped', 'Cause': 'A stage it needs did not succeed'},
+        'ResultPath': '$.' + _error_field(step.name),
+    }
+    return check, states, exits + [skip]
+
+
+def _parallel(name, branches):
+    # Every branch returns its input with the errors of its stages added,
+    # so merging them passes them on to the stages that follow
+    merged = '$[0]'
+    for index in range(1, len(branches)):
+        merged = f'States.JsonMerge({merged}, $[{index}], false)'
+    state = {
+        'Type': 'Parallel',
+        'Branches': branches,
+        'ResultSelector': {'state.$': merged},
+        'OutputPath': '$.state',
+    }
+    return name, {name: state}, [name]
+
+
+def _components(stages):
+    """Groups of stages connected by a requirement, in pipeline order"""
+    groups = []
+    for step in stages:
+        linked = [group for group in groups
+                  if any(step.name in other.requires or other.name in step.requires
+                         for other in group)]
+        merged = [step] + [other for group in linked for other in group]
+        groups = [group for group in groups if group not in linked] + [merged]
+    order = [step.name for step in stages]
+    return sorted((sorted(group, key=lambda step: order.index(step.name)) for group in groups),
+                  key=lambda group: order.index(group[0].name))
+
+
+def _parallel_name(stages):
+    # State names must be unique in the whole state machine
+    return 'Run ' + ', '.join(step.name for step in stages)
+
+
+def _sequence(stages):
+    """Runs ``stages`` in dependency order, as a list of (first state, states, exits)"""
+    names = {step.name for step in stages}
+    groups = _components(stages)
+    if len(groups) > 1:
+        return [_parallel(_parallel_name(stages), [_branch(group) for group in groups])]
+    sinks = [step for step in stages
+             if not any(step.name in other.requires for other in stages)]
+    if len(stages) > 1 and len(sinks) == 1:
+        rest = [step for step in stages if step is not sinks[0]]
+        return _sequence(rest) + [_stage(sinks[0])]
+    sources = [step for step in stages if not names & set(step.requires)]
+    if len(sources) == 1:
+        rest = [step for step in stages if step is not sources[0]]
+        return [_stage(sources[0])] + (_sequence(rest) if rest else [])
+    # Not series-parallel: run one dependency level after the other
+    levels = []
+    done = set()
+    while len(done) < len(stages):
+        level = [step for step in stages
+                 if step.name not in done and names & set(step.requires) <= done]
+        levels.append(level)
+        done.update(step.name for step in level)
+    return [part for level in levels
+            for part in (_sequence([level[0]]) if len(level) == 1 else [
+                _parallel(_parallel_name(level), [_branch([step]) for step in level])])]
+
+
+def _link(parts, last=None):
+    """Chains the parts of a sequence; the last one goes to ``last`` or ends"""
+    states = {}
+    for index, (_, part_states, exits) in enumerate(parts):
+        following = parts[index + 1][0] if index + 1 < len(parts) else last
+        for name in exits:
+            if following is None:
+                part_states[name]['End'] = True
+            else:
+                part_states[name]['Next'] = following
+        states.update(part_states)
+    return {'StartAt': parts[0][0], 'States': states}
+
+
+def _branch(stages):
+    return _link(_sequence(stages))
+
+
+def state_machine(pipeline=PIPELINE):
+    """Step Functions definition running ``pipeline``
+
+    Its input is ``{"httpMethod": "POST", "body": <create request JSON>}``.
+    Like ``run_pipeline``, a failed stage skips the stages that need it
+    and lets every other stage run; the execution fails at the end.
+    """
+    _validate(pipeline)
+    definition = _link(_sequence(list(pipeline)), last='Check stages')
+    definition['States'].update({
+        'Check stages': {
+            'Type': 'Choice',
+            'Choices': [dict(_failed_condition([step.name for step in pipeline]),
+                             Next='Provisioning failed')],
+            'Default': 'Provisioned',
+        },
+        'Provisioning failed': {
+            'Type': 'Fail',
+            'Error': 'StageFailed',
+            'Cause': 'A provisioning stage failed, see the provisioning table',
+        },
+        'Provisioned': {'Type': 'Succeed'},
+    })
+    return dict({'Comment': 'Provisions a PERLS tenant'}, **definition)
@@ -0,0 +1,252 @@
+"""Key-value record tables backed by DynamoDB, or SQLite for local runs
+
+``open_table`` returns a DynamoDB table unless the ``record_store``
+setting points at an SQLite file (``sqlite:///path/to/file.db``), which
+keeps the same interface for development and tests without AWS.
+"""
+
+import json
+import sqlite3
+import threading
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+from decouple import config
+
+from common import runtime
+
+
+class ConflictError(Exception):
+    """A conditional write found the record changed by someone else"""
+
+
+def _to_plain(value):
+    """Converts the Decimals DynamoDB returns back into ints and floats"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: _to_plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_plain(item) for item in value]
+    return value
+
+
+def _to_dynamo(item):
+    """Converts floats into the Decimals DynamoDB requires"""
+    return json.loads(json.dumps(item), parse_float=Decimal)
+
+
+class DynamoTable:
+    """Records stored in a DynamoDB table with a single string hash key"""
+
+    def __init__(self, table_name, key):
+        self.key = key
+        self.table = runtime.resource('dynamodb').Table(table_name)
+
+    def get(self, key):
+        """Returns the record stored under ``key`` or None"""
+        item = self.table.get_item(Key={self.key: key}, ConsistentRead=True).get('Item')
+        return _to_plain(item) if item is not None else None
+
+    def put(self, item):
+        """Stores a whole record, replacing any previous one"""
+        self.table.put_item(Item=_to_dynamo(item))
+
+    def put_if(self, item, field, expected):
+        """Stores ``item`` only if the stored ``field`` still equals ``expected``
+
+        ``expected`` None means the record must not exist yet.
+
+        Raises
+        ------
+        ConflictError when the condition does not hold
+        """
+        if expected is None:
+            condition = {'ConditionExpression': 'attribute_not_exists(#k)',
+                         'ExpressionAttributeNames': {'#k': self.key}}
+        else:
+            condition = {'ConditionExpression': '#f = :expected',
+                         'ExpressionAttributeNames': {'#f': field},
+                         'ExpressionAttributeValues': _to_dynamo({':expected': expected})}
+        try:
+            self.table.put_item(Item=_to_dynamo(item), **condition)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                raise ConflictError(item[self.key]) from ex
+            raise
+
+    def update(self, key, fields):
+        """Sets ``fields`` on the record stored under ``key`` and returns it"""
+        names = {f'#f{index}': name for index, name in enumerate(fields)}
+        values = {f':v{index}': value for index, value in enumerate(fields.values())}
+        expression = ', '.join(f'#f{index} = :v{index}' for index in range(len(fields)))
+        response = self.table.update_item(
+            Key={self.key: key},
+            UpdateExpression='SET ' + expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=_to_dynamo(values),
+            ReturnValues='ALL_NEW')
+        return _to_plain(response['Attributes'])
+
+    def update_if(self, key, fields, field, expected):
+        """Sets ``fields`` only if the stored ``field`` still equals ``expected``
+
+        ``field`` may be a dotted path into a map, e.g. ``pending.token``.
+
+        Raises
+        ------
+        ConflictError when the condition does not hold
+        """
+        names = {f'#f{index}': name for index, name in enumerate(fields)}
+        values = {f':v{index}': value for index, value in enumerate(fields.values())}
+        expression = ', '.join(f'#f{index} = :v{index}' for index in range(len(fields)))
+        path = {f'#e{index}': name for index, name in enumerate(field.split('.'))}
+        try:
+            response = self.table.update_item(
+                Key={self.key: key},
+                UpdateExpression='SET ' + expression,
+                ConditionExpression='.'.join(path) + ' = :expected',
+                ExpressionAttributeNames=dict(names, **path),
+                ExpressionAttributeValues=_to_dynamo(dict(values, **{':expected': expected})),
+                ReturnValues='ALL_NEW')
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                raise ConflictError(key) from ex
+            raise
+        return _to_plain(response['Attributes'])
+
+    def delete(self, key):
+        """Removes the record stored under ``key``"""
+        self.table.delete_item(Key={self.key: key})
+
+    def scan(self):
+        """Yields every record, following scan pagination"""
+        arguments = {}
+        while True:
+            page = self.table.scan(**arguments)
+            for item in page.get('Items', []):
+                yield _to_plain(item)
+            if 'LastEvaluatedKey' not in page:
+                return
+            arguments['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def _lookup(item, path):
+    # Value at a dotted path, None when any part of it is missing
+    for name in path.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(name)
+    return item
+
+
+class SqliteTable:
+    """Records stored as JSON documents in a local SQLite file"""
+
+    def __init__(self, path, table_name, key):
+        self.path = path
+        self.table_name = table_name
+        self.key = key
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" '
+                               '(key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _connect_for_update(self):
+        # Takes the write lock before reading, so read-modify-write calls
+        # from other processes or table objects cannot interleave
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def get(self, key):
+        """Returns the record stored under ``key`` or None"""
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT data FROM "{self.table_name}" WHERE key = ?',
+                                     (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, item):
+        """Stores a whole record, replacing any previous one"""
+        with self._lock, self._connect() as connection:
+            connection.execute(f'INSERT OR REPLACE INTO "{self.table_name}" VALUES (?, ?)',
+                               (item[self.key], json.dumps(item)))
+
+    def put_if(self, item, field, expected):
+        """Stores ``item`` only if the stored ``field`` still equals ``expected``
+
+        ``expected`` None means the record must not exist yet.
+
+        Raises
+        ------
+        ConflictError when the condition does not hold
+        """
+        with self._lock, self._connect_for_update() as connection:
+            row = connection.execute(f'SELECT data FROM "{self.table_name}" WHERE key = ?',
+                                     (item[self.key],)).fetchone()
+            if expected is None:
+                matches = row is None
+            else:
+                matches = row is not None and json.loads(row[0]).get(field) == expected
+            if not matches:
+                raise ConflictError(item[self.key])
+            connection.execute(f'INSERT OR REPLACE INTO "{self.table_name}" VALUES (?, ?)',
+                               (item[self.key], json.dumps(item)))
+
+    def update(self, key, fields):
+        """Sets ``fields`` on the record stored under ``key`` and returns it"""
+        with self._lock, self._connect_for_update() as connection:
+            row = connection.execute(f'SELECT data FROM "{self.table_name}" WHERE key = ?',
+                                     (key,)).fetchone()
+            item = json.loads(row[0]) if row else {self.key: key}
+            item.update(fields)
+            connection.execute(f'INSERT OR REPLACE INTO "{self.table_name}" VALUES (?, ?)',
+                               (key, json.dumps(item)))
+        return item
+
+    def update_if(self, key, fields, field, expected):
+        """Sets ``fields`` only if the stored ``field`` still equals ``expected``
+
+        ``field`` may be a dotted path into a map, e.g. ``pending.token``.
+
+        Raises
+        ------
+        ConflictError when the condition does not hold
+        """
+        with self._lock, self._connect_for_update() as connection:
+            row = connection.execute(f'SELECT data FROM "{self.table_name}" WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None or _lookup(json.loads(row[0]), field) != expected:
+                raise ConflictError(key)
+            item = json.loads(row[0])
+            item.update(fields)
+            connection.execute(f'INSERT OR REPLACE INTO "{self.table_name}" VALUES (?, ?)',
+                               (key, json.dumps(item)))
+        return item
+
+    def delete(self, key):
+        """Removes the record stored under ``key``"""
+        with self._lock, self._connect() as connection:
+            connection.execute(f'DELETE FROM "{self.table_name}" WHERE key = ?', (key,))
+
+    def scan(self):
+        """Yields every record"""
+        with self._connect() as connection:
+            rows = connection.execute(f'SELECT data FROM "{self.table_name}"').fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+
+
+def open_table(name, key):
+    """Opens the record table ``name`` in the configured store
+
+    The DynamoDB table name defaults to ``perls_<name>`` and can be
+    overridden with the ``<name>_table`` setting.
+    """
+    store = config('record_store', default='dynamodb')
+    if store.startswith('sqlite://'):
+        return SqliteTable(store[len('sqlite://'):], name, key)
+    return DynamoTable(config(f'{name}_table', default=f'perls_{name}'), key)
@@ -0,0 +1,127 @@
+"""Objects kept for the lifetime of a Lambda execution environment
+
+Building a boto3 session and its clients costs credential and endpoint
+resolution on every call, so handlers ask this module for them instead
+and only the first invocation in an environment pays for it. The same
+goes for the pooled HTTP session and configuration values.
+
+``instrumented`` wraps a handler to log its latency as one JSON line per
+invocation, flagged cold or warm, which CloudWatch Logs Insights can
+aggregate per function.
+"""
+
+import functools
+import json
+import threading
+import time
+from collections import deque
+
+import boto3
+import requests
+from decouple import config
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = 16
+LATENCY_SAMPLES = 1000
+_MISSING = object()
+
+_loaded_at = time.perf_counter()
+_lock = threading.RLock()
+_objects = {}
+_settings = {}
+_latencies = deque(maxlen=LATENCY_SAMPLES)
+_invocations = [0]
+
+
+def _once(key, factory):
+    """Builds an object on first use and returns the same one afterwards"""
+    if key not in _objects:
+        with _lock:
+            if key not in _objects:
+                _objects[key] = factory()
+    return _objects[key]
+
+
+def session():
+    """The boto3 session of this execution environment"""
+    return _once('session', boto3.Session)
+
+
+def client(service):
+    """Cached boto3 client for ``service``"""
+    return _once(('client', service), lambda: session().client(service))
+
+
+def resource(service):
+    """Cached boto3 resource for ``service``"""
+    return _once(('resource', service), lambda: session().resource(service))
+
+
+def pooled_session(pool_size=HTTP_POOL_SIZE):
+    """New requests.Session keeping up to ``pool_size`` connections per host"""
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+
+def http():
+    """Shared pooled requests.Session, sized by ``http_pool_size``"""
+    return _once('http', lambda: pooled_session(setting('http_pool_size', HTTP_POOL_SIZE, int)))
+
+
+def setting(name, default=_MISSING, cast=None):
+    """Configuration value read once per execution environment"""
+    if name not in _settings:
+        arguments = {} if default is _MISSING else {'default': default}
+        if cast is not None:
+            arguments['cast'] = cast
+        _settings[name] = config(name, **arguments)
+    return _settings[name]
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of ``samples``, or None when there are none"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def latency_stats():
+    """Warm invocation latency of this environment, in milliseconds"""
+    samples = list(_latencies)
+    return {'invocations': _invocations[0], 'samples': len(samples),
+            'p50_ms': percentile(samples, 0.50), 'p99_ms': percentile(samples, 0.99)}
+
+
+def instrumented(handler):
+    """Logs the latency of every invocation of ``handler``
+
+    The first invocation in an environment is reported as cold, with the
+    time spent between loading this module and the call, which covers
+    the handler module's own imports.
+    """
+    name = handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        with _lock:
+            _invocations[0] += 1
+            cold = _invocations[0] == 1
+        start = time.perf_counter()
+        try:
+            return handler(event, context)
+        finally:
+            elapsed = round((time.perf_counter() - start) * 1000, 3)
+            metric = {'metric': 'handler_latency', 'function': name, 'cold': cold,
+                      'duration_ms': elapsed}
+            if cold:
+                metric['init_ms'] = round((start - _loaded_at) * 1000, 3)
+            else:
+                _latencies.append(elapsed)
+                metric.update(latency_stats())
+            print(json.dumps(metric))
+
+    return wrapper
@@ -0,0 +1,126 @@
+"""Secrets Manager reads batched per call and cached between invocations
+
+Secrets that rarely change, the RDS admin login and the tenants' cron
+keys, are kept in an in-process TTL cache so warm invocations do not ask
+Secrets Manager again. A caller that finds a cached value rejected, e.g.
+a cron key of a recreated tenant, invalidates it and reads it again. Everything else is always read fresh, but several
+secrets needed by one handler are fetched with one BatchGetSecretValue
+call. Clients without that API, or roles without its permission, fall
+back to one GetSecretValue call per secret.
+"""
+
+from botocore.exceptions import ClientError
+from decouple import config
+
+from common.cache import TTLCache
+
+BATCH_SIZE = 20
+CACHED_SECRETS = ('rds_admin_login',)
+CACHED_SUFFIXES = ('_cron_key',)
+
+_cache = TTLCache(ttl=config('secret_cache_ttl', default=900, cast=int),
+                  maxsize=config('secret_cache_size', default=512, cast=int))
+_batch_supported = True
+
+
+def is_cacheable(name):
+    """Whether secret ``name`` is safe to keep between invocations"""
+    return name in CACHED_SECRETS or name.endswith(CACHED_SUFFIXES)
+
+
+def _entry(response):
+    return {'ARN': response['ARN'], 'Name': response['Name'],
+            'SecretString': response.get('SecretString')}
+
+
+def _fetch_one(client, name):
+    return _entry(client.get_secret_value(SecretId=name))
+
+
+def _fetch_batch(client, names, found, failed):
+    """Fetches ``names`` with BatchGetSecretValue, or one by one without it"""
+    global _batch_supported  # pylint: disable=global-statement
+    for index in range(0, len(names), BATCH_SIZE):
+        chunk = names[index:index + BATCH_SIZE]
+        try:
+            response = client.batch_get_secret_value(SecretIdList=chunk)
+        except (AttributeError, ClientError) as ex:
+            if isinstance(ex, ClientError) and ex.response['Error']['Code'] not in (
+                    'AccessDeniedException', 'UnknownOperationException'):
+                raise
+            _batch_supported = False
+            _fetch_each(client, names[index:], found, failed)
+            return
+        for secret in response.get('SecretValues', []):
+            found[secret['Name']] = _entry(secret)
+        for error in response.get('Errors', []):
+            failed[error['SecretId']] = ClientError(
+                {'Error': {'Code': error['ErrorCode'], 'Message': error['Message']}},
+                'BatchGetSecretValue')
+
+
+def _fetch_each(client, names, found, failed):
+    for name in names:
+        try:
+            found[name] = _fetch_one(client, name)
+        except ClientError as ex:
+            failed[name] = ex
+
+
+def get_secrets(client, names, missing_ok=False):
+    """Returns the secrets ``names`` keyed by name
+
+    Parameters
+    ----------
+    client: Secrets Manager client, required
+    names: list of str, required
+    missing_ok: bool
+        Leave secrets that cannot be read out of the result instead of
+        raising the error of the first one
+
+    Returns
+    ------
+    dict mapping each name to a dict with ``ARN``, ``Name`` and ``SecretString``
+    """
+    found = {}
+    failed = {}
+    pending = []
+    for name in dict.fromkeys(names):
+        cached = _cache.get(name) if is_cacheable(name) else None
+        if cached is not None:
+            found[name] = cached
+        else:
+            pending.append(name)
+    if len(pending) > 1 and _batch_supported:
+        _fetch_batch(client, pending, found, failed)
+    else:
+        _fetch_each(client, pending, found, failed)
+    for name in pending:
+        if name in found and is_cacheable(name):
+            _cache.set(name, found[name])
+    if failed and not missing_ok:
+        raise next(iter(failed.values()))
+    return found
+
+
+def get_secret(client, name):
+    """Returns one secret as a dict with ``ARN``, ``Name`` and ``SecretString``"""
+    return get_secrets(client, [name])[name]
+
+
+def secret_string(client, name):
+    """Returns the value of one secret"""
+    return get_secret(client, name)['SecretString']
+
+
+def invalidate(name=None):
+    """Forgets a cached secret, or all of them when no name is given"""
+    if name is None:
+        _cache.invalidate()
+    else:
+        _cache.invalidate(name)
+
+
+def cache_stats():
+    """Hit and miss counters of the secret cache"""
+    return _cache.stats()
@@ -0,0 +1,347 @@
+"""Streaming import of mysqldump style SQL files
+
+The dump is read in binary lines and split into statements by a small
+tokenizer that understands quoted strings, comments and DELIMITER
+changes. Statements are sent to the server in multi-statement batches
+so a large starter database needs a few hundred round trips instead of
+one per statement.
+"""
+
+import re
+import time
+from dataclasses import dataclass
+
+DEFAULT_DELIMITER = b';'
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+READ_BUFFER_BYTES = 1024 * 1024
+
+# Characters that change the tokenizer state outside of a string/comment.
+_SPECIAL = re.compile(rb"['\"`#]|--\s|/\*")
+_STRING_END = {
+    b"'": re.compile(rb"[\\']"),
+    b'"': re.compile(rb'[\\"]'),
+    b'`': re.compile(rb'`'),
+}
+_DELIMITER_COMMAND = re.compile(rb'\s*DELIMITER\s+(\S+)', re.IGNORECASE)
+_STATEMENT_HEAD = re.compile(
+    r'\s*(?:/\*!\d*\s*)?(?P<kind>[A-Za-z]+)'
+    r'(?:\s+(?:IGNORE\s+)?(?:INTO|TABLES?)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?'
+    r'`?(?P<table>[A-Za-z0-9_$]+)`?)?')
+_VALUES = re.compile(r'\bVALUES\s*(?=\()', re.IGNORECASE)
+_ROW_TOKENS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`|[()]", re.DOTALL)
+
+
+@dataclass
+class Statement:
+    """A single SQL statement read from a dump
+
+    Attributes
+    ----------
+    sql: str
+        Statement text without its trailing delimiter
+    kind: str
+        Lower case leading keyword, e.g. ``insert`` or ``create``
+    table: str
+        Table the statement targets, if it targets one
+    standalone: bool
+        True when the statement was written under a custom DELIMITER and
+        must not be combined with other statements
+    size: int
+        Length of the statement in bytes as read from the dump
+    rows: int
+        Number of rows an INSERT ... VALUES statement adds, when known
+    """
+    sql: str
+    kind: str
+    table: str = None
+    standalone: bool = False
+    size: int = 0
+    rows: int = None
+
+    @classmethod
+    def parse(cls, sql, standalone=False, size=None):
+        """Builds a statement, classifying it by its leading keyword"""
+        match = _STATEMENT_HEAD.match(sql)
+        kind = match.group('kind').lower() if match else ''
+        table = match.group('table') if match else None
+        return cls(sql, kind, table, standalone, len(sql) if size is None else size)
+
+
+def count_rows(sql):
+    """Counts the value tuples of an INSERT ... VALUES statement
+
+    Returns None for statements whose row count cannot be read from the
+    text, such as INSERT ... SELECT or ON DUPLICATE KEY UPDATE.
+    """
+    values = _VALUES.search(sql)
+    if values is None or 'ON DUPLICATE KEY' in sql[-4096:].upper():
+        return None
+    rows = 0
+    depth = 0
+    for token in _ROW_TOKENS.finditer(sql, values.end()):
+        char = token.group()
+        if char == '(':
+            if depth == 0:
+                rows += 1
+            depth += 1
+        elif char == ')':
+            depth -= 1
+    return rows
+
+
+@dataclass
+class ImportStats:
+    """Counters for one import run"""
+    statements: int = 0
+    bytes: int = 0
+    batches: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def statements_per_second(self):
+        """Statement throughput of the run"""
+        return self.statements / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        """Byte throughput of the run"""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        """One line, human readable summary"""
+        return (f'{self.statements} statements ({self.failed} failed) in '
+                f'{self.batches} batches, {self.bytes / 1048576:.1f} MiB in '
+                f'{self.elapsed:.1f}s: {self.statements_per_second:.0f} stmt/s, '
+                f'{self.bytes_per_second / 1048576:.2f} MiB/s')
+
+
+def iter_statements(lines):
+    """Splits a stream of dump lines into statements
+
+    Parameters
+    ----------
+    lines: iterable of bytes, required
+        Lines of the dump, e.g. a file opened in binary mode
+
+    Yields
+    ------
+    Statement
+    """
+    delimiter = DEFAULT_DELIMITER
+    pieces = []
+    quote = None
+    in_block_comment = False
+    keep_comment = False
+
+    for line in lines:
+        if not pieces and quote is None and not in_block_comment:
+            command = _DELIMITER_COMMAND.match(line)
+            if command:
+                delimiter = command.group(1)
+                continue
+
+        pos = 0
+        end = len(line)
+        split = line.find(delimiter)
+        while pos < end:
+            if quote is not None:
+                match = _STRING_END[quote].search(line, pos)
+                if match is None:
+                    pieces.append(line[pos:])
+                    pos = end
+                elif match.group() == b'\\':
+                    # Keep the escape and whatever it escapes, even a newline.
+                    pieces.append(line[pos:match.end() + 1])
+                    pos = match.end() + 1
+                else:
+                    pieces.append(line[pos:match.end()])
+                    pos = match.end()
+                    quote = None
+                continue
+
+            if in_block_comment:
+                close = line.find(b'*/', pos)
+                stop = end if close < 0 else close + 2
+                if keep_comment:
+                    pieces.append(line[pos:stop])
+                pos = stop
+                in_block_comment = close < 0
+                continue
+
+            # The delimiter position is cached so long lines are scanned once.
+            if 0 <= split < pos:
+                split = line.find(delimiter, pos)
+            match = _SPECIAL.search(line, pos)
+            if split >= 0 and (match is None or split < match.start()):
+                pieces.append(line[pos:split])
+                statement = _finish(pieces, delimiter)
+                if statement is not None:
+                    yield statement
+                pieces = []
+                pos = split + len(delimiter)
+                continue
+            if match is None:
+                # Whitespace between statements is not kept, so ``pieces``
+                # stays empty until the next statement really starts.
+                if pieces or not line[pos:].isspace():
+                    pieces.append(line[pos:])
+                pos = end
+                continue
+
+            token = match.group()
+            if token == b'#' or token.startswith(b'--'):
+                # Line comments are dropped, the newline is kept.
+                pieces.append(line[pos:match.start()])
+                if pieces:
+                    pieces.append(b'\n')
+                pos = end
+            elif token == b'/*':
+                if match.start() > pos:
+                    pieces.append(line[pos:match.start()])
+                pos = match.end()
+                in_block_comment = True
+                # Only /*! ... */ comments are executable and worth keeping,
+                # other comments are replaced by the whitespace they stand for.
+                keep_comment = line.startswith(b'!', pos)
+                if keep_comment:
+                    pieces.append(b'/*')
+                elif pieces:
+                    pieces.append(b' ')
+            else:
+                pieces.append(line[pos:match.end()])
+                pos = match.end()
+                quote = token
+
+    statement = _finish(pieces, delimiter)
+    if statement is not None:
+        yield statement
+
+
+def _finish(pieces, delimiter):
+    sql = b''.join(pieces).strip()
+    if not sql:
+        return None
+    text = sql.decode('utf8', errors='surrogateescape')
+    return Statement.parse(text, delimiter != DEFAULT_DELIMITER, len(sql))
+
+
+def read_statements(sql_file):
+    """Yields the statements of a dump file on disk"""
+    with open(sql_file, 'rb', buffering=READ_BUFFER_BYTES) as dump:
+        yield from iter_statements(dump)
+
+
+def iter_batches(statements, batch_bytes=DEFAULT_BATCH_BYTES):
+    """Groups statements into lists small enough to send in one packet
+
+    Statements flagged ``standalone`` are always sent alone.
+    """
+    batch = []
+    size = 0
+    for statement in statements:
+        length = statement.size
+        if statement.standalone or (batch and size + length > batch_bytes):
+            if batch:
+                yield batch
+            batch = []
+            size = 0
+        batch.append(statement)
+        size += length
+        if statement.standalone:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def bulk_load_session(cursor):
+    """Relaxes per-row checks on a connection for the duration of a load"""
+    cursor.execute('SET autocommit=0, unique_checks=0, foreign_key_checks=0')
+
+
+def restore_session(cursor):
+    """Reverts the settings applied by bulk_load_session"""
+    cursor.execute('SET unique_checks=1, foreign_key_checks=1, autocommit=1')
+
+
+def execute_batch(cursor, batch, errors, stats):
+    """Runs a batch as one multi-statement call
+
+    A failing statement is reported and skipped, and the statements after
+    it are retried as a new batch, matching the one-by-one behaviour of the
+    original importer.
+    """
+    while batch:
+        sql = ';\n'.join(statement.sql for statement in batch)
+        stats.batches += 1
+        try:
+            _execute_multi(cursor, sql)
+        except errors as ex:
+            stats.failed += 1
+            print(f"[WARN] MySQLError during execute statement Args: '{ex.args}'")
+            batch = batch[getattr(ex, 'statements_done', 0) + 1:]
+            continue
+        break
+
+
+def _execute_multi(cursor, sql):
+    """Executes ``sql`` and drains every result, counting statements as it goes
+
+    mysql-connector 9.2 dropped the ``multi`` argument and reports results
+    through ``nextset()`` instead, so both styles are supported.
+    """
+    done = 0
+    try:
+        results = cursor.execute(sql, multi=True)
+    except TypeError:
+        cursor.execute(sql)
+        done = 1
+        try:
+            while cursor.nextset():
+                done += 1
+        except Exception as ex:  # pylint: disable=broad-except
+            ex.statements_done = done
+            raise
+        return done
+    try:
+        for result in results:
+            if result.with_rows:
+                result.fetchall()
+            done += 1
+    except Exception as ex:  # pylint: disable=broad-except
+        ex.statements_done = done
+        raise
+    return done
+
+
+def import_statements(connection, statements, errors, batch_bytes=DEFAULT_BATCH_BYTES):
+    """Loads statements over ``connection`` in batches and commits once
+
+    Parameters
+    ----------
+    connection: mysql.connector connection, required
+    statements: iterable of Statement, required
+    errors: exception class or tuple, required
+        Server errors that are logged and skipped instead of aborting
+    batch_bytes: int
+        Upper bound for the size of a multi-statement batch
+
+    Returns
+    ------
+    ImportStats
+    """
+    stats = ImportStats()
+    start = time.monotonic()
+    cursor = connection.cursor()
+    bulk_load_session(cursor)
+    for batch in iter_batches(statements, batch_bytes):
+        stats.statements += len(batch)
+        stats.bytes += sum(statement.size for statement in batch)
+        execute_batch(cursor, batch, errors, stats)
+    connection.commit()
+    restore_session(cursor)
+    cursor.close()
+    stats.elapsed = time.monotonic() - start
+    return stats
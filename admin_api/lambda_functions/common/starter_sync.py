@@ -0,0 +1,146 @@
+"""Incremental refresh of a tenant's starter files between CMS versions
+
+Each version's starter ``public`` tree is described once by a manifest of
+size, mtime and SHA-256 per file, cached on EFS. Upgrading a tenant then
+copies only the files whose content differs between the two manifests.
+"""
+
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common.asset_store import file_digest, load_manifest
+from common.efs_io import DEFAULT_WORKERS, TransferStats, copy_file, walk_tree, write_json
+
+VERSION_ROOT = '/mnt/efs/version'
+MANIFEST_ROOT = '/mnt/efs/.starter_manifests'
+
+_manifests = {}
+_diffs = {}
+
+
+def starter_public(version):
+    """Starter public files directory of ``version``"""
+    return os.path.join(VERSION_ROOT, version, 'starter', 'public')
+
+
+def _describe(path):
+    status = os.stat(path)
+    return [status.st_size, status.st_mtime_ns, file_digest(path), status.st_mode & 0o777]
+
+
+def scan_manifest(version, workers=DEFAULT_WORKERS):
+    """Hashes the starter public files of ``version`` into a manifest"""
+    _, files, _ = walk_tree(starter_public(version), '')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = {relative: executor.submit(_describe, path) for path, relative in files}
+        return {'version': version,
+                'files': {relative: future.result() for relative, future in entries.items()}}
+
+
+def version_manifest(version, workers=DEFAULT_WORKERS):
+    """Returns the manifest of ``version``, scanning it on first use
+
+    A manifest already written by the shared starter store is reused.
+    """
+    if version in _manifests:
+        return _manifests[version]
+    path = os.path.join(MANIFEST_ROOT, f'{version}.json')
+    manifest = load_manifest('public', version)
+    if manifest is None:
+        try:
+            with open(path) as source:
+                manifest = json.load(source)
+        except FileNotFoundError:
+            manifest = scan_manifest(version, workers)
+            write_json(path, manifest)
+    _manifests[version] = manifest
+    return manifest
+
+
+def diff_manifests(old, new):
+    """Compares two manifests
+
+    Returns
+    ------
+    dict with ``added``, ``changed`` and ``removed`` lists of relative paths
+    """
+    old_files = old['files']
+    new_files = new['files']
+    added = sorted(path for path in new_files if path not in old_files)
+    changed = sorted(path for path, entry in new_files.items()
+                     if path in old_files and (old_files[path][0] != entry[0]
+                                               or old_files[path][2] != entry[2]))
+    removed = sorted(path for path in old_files if path not in new_files)
+    return {'added': added, 'changed': changed, 'removed': removed}
+
+
+def version_diff(old_version, new_version, workers=DEFAULT_WORKERS):
+    """Returns the cached diff between the starter files of two versions"""
+    key = (old_version, new_version)
+    if key not in _diffs:
+        path = os.path.join(MANIFEST_ROOT, 'diffs', f'{old_version}..{new_version}.json')
+        try:
+            with open(path) as source:
+                _diffs[key] = json.load(source)
+        except FileNotFoundError:
+            diff = diff_manifests(version_manifest(old_version, workers),
+                                  version_manifest(new_version, workers))
+            write_json(path, diff)
+            _diffs[key] = diff
+    return _diffs[key]
+
+
+def _replace_file(source, destination):
+    """Copies ``source`` over ``destination`` without writing through it
+
+    The copy is renamed into place, so the site never serves a half
+    written file and a read-only destination is replaced as well.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temp_path = f'{destination}.{uuid.uuid4().hex}.tmp'
+    size = copy_file(source, temp_path)
+    os.replace(temp_path, destination)
+    return size
+
+
+def sync_tenant(tenant_public, old_version, new_version, workers=DEFAULT_WORKERS):
+    """Brings a tenant's starter files from ``old_version`` to ``new_version``
+
+    Added files are copied. Changed files are copied unless the tenant's
+    copy no longer has the size the old starter file had, which means the
+    site changed it. Files removed from the starter set are left alone
+    because content may still reference them.
+
+    Returns
+    ------
+    tuple of (TransferStats, dict of skipped and removed paths)
+    """
+    start = time.monotonic()
+    stats = TransferStats()
+    diff = version_diff(old_version, new_version, workers)
+    old_files = version_manifest(old_version, workers)['files']
+    source_root = starter_public(new_version)
+    skipped = []
+    copies = list(diff['added'])
+    for relative in diff['changed']:
+        try:
+            current_size = os.stat(os.path.join(tenant_public, relative)).st_size
+        except FileNotFoundError:
+            current_size = None
+        if current_size not in (None, old_files[relative][0]):
+            skipped.append(relative)
+        else:
+            copies.append(relative)
+
+    def copy(relative):
+        stats.add_file(_replace_file(os.path.join(source_root, relative),
+                                     os.path.join(tenant_public, relative)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(copy, relative) for relative in copies]:
+            future.result()
+    stats.elapsed = time.monotonic() - start
+    return stats, {'skipped': skipped, 'removed': diff['removed']}
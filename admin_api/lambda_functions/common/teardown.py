@@ -0,0 +1,324 @@
+"""Deletes the resources of tenants concurrently
+
+A tenant owns an LRS, five secrets, an EFS directory, a CloudFormation
+stack and a MySQL database and user. None of their deletions depends on
+another, so ``run_steps`` runs them on a thread pool, times each one and
+carries on past failures, reporting every resource as deleted, missing
+or failed.
+
+The EFS directory is not removed in the request. It is renamed into a
+trash directory on the same file system, which is instant, and purged
+afterwards by ``purge_trash`` with a parallel tree walker.
+
+Many tenants are deleted with ``run_batches``: each kind of resource is
+one batch sharing its connection or listing across every tenant, and the
+batches run side by side.
+"""
+
+import functools
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from common.efs_io import DEFAULT_WORKERS as EFS_WORKERS, parallel_rmtree
+
+EFS_ROOT = '/mnt/efs'
+TRASH_DIR = '.trash'
+SECRET_SUFFIXES = ('_db_password', '_user_password', '_lrs_key_password', '_cron_key',
+                   '_smtp_password')
+ACCESS_HOSTS = '10.0.0.0/255.255.0.0'
+DEFAULT_WORKERS = 8
+# Trash trees purged at the same time
+PURGE_TREES = 4
+
+DELETED = 'deleted'
+MISSING = 'missing'
+FAILED = 'failed'
+
+
+class Missing(Exception):
+    """The resource to delete does not exist"""
+
+
+@dataclass
+class StepResult:
+    """Outcome of deleting one resource"""
+    resource: str
+    status: str
+    seconds: float
+    detail: object = None
+    error: str = None
+
+    def as_dict(self):
+        """Result as a JSON serialisable dict"""
+        result = {'status': self.status, 'seconds': round(self.seconds, 3)}
+        if self.detail is not None:
+            result['detail'] = self.detail
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+
+def run_steps(steps, workers=DEFAULT_WORKERS):
+    """Runs independent deletion steps concurrently
+
+    Parameters
+    ----------
+    steps: dict, required
+        Resource name mapped to a callable deleting it; the callable
+        raises ``Missing`` when there was nothing to delete
+
+    Returns
+    ------
+    dict of resource name to StepResult, in the order of ``steps``
+    """
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(steps)))) as executor:
+        futures = {resource: executor.submit(_timed, resource, step)
+                   for resource, step in steps.items()}
+    return {resource: future.result() for resource, future in futures.items()}
+
+
+def _timed(resource, step):
+    start = time.monotonic()
+    try:
+        detail = step()
+    except Missing as ex:
+        return StepResult(resource, MISSING, time.monotonic() - start, str(ex) or None)
+    except Exception as ex:  # pylint: disable=broad-except
+        return StepResult(resource, FAILED, time.monotonic() - start,
+                          error=f'{type(ex).__name__}: {ex}')
+    return StepResult(resource, DELETED, time.monotonic() - start, detail)
+
+
+def run_each(resource, tenants, step, workers=DEFAULT_WORKERS):
+    """Deletes one kind of resource of many tenants, timing each tenant
+
+    Parameters
+    ----------
+    step: callable, required
+        ``step(tenant)`` deletes the resource of one tenant
+    workers: int
+        Tenants worked on at the same time; 1 runs them one after the
+        other, e.g. on a connection that is not thread safe
+
+    Returns
+    ------
+    dict of tenant to StepResult
+    """
+    if workers <= 1:
+        return {tenant: _timed(resource, functools.partial(step, tenant)) for tenant in tenants}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tenants)))) as executor:
+        futures = {tenant: executor.submit(_timed, resource, functools.partial(step, tenant))
+                   for tenant in tenants}
+    return {tenant: future.result() for tenant, future in futures.items()}
+
+
+def run_batches(tenants, batches):
+    """Runs one deletion batch per kind of resource, all batches at once
+
+    Parameters
+    ----------
+    batches: dict, required
+        Resource name mapped to a callable taking the list of tenants and
+        returning a dict of tenant to StepResult, usually from
+        ``run_each``; when it raises, the resource fails for every tenant
+
+    Returns
+    ------
+    tuple of (dict of tenant to a dict of resource name to StepResult,
+    dict of resource name to the seconds its whole batch took)
+    """
+    def run(resource, batch):
+        start = time.monotonic()
+        try:
+            results = batch(tenants)
+        except Exception as ex:  # pylint: disable=broad-except
+            error = f'{type(ex).__name__}: {ex}'
+            results = {tenant: StepResult(resource, FAILED, 0.0, error=error)
+                       for tenant in tenants}
+        return results, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, len(batches))) as executor:
+        futures = {resource: executor.submit(run, resource, batch)
+                   for resource, batch in batches.items()}
+    by_tenant = {tenant: {} for tenant in tenants}
+    seconds = {}
+    for resource, future in futures.items():
+        results, seconds[resource] = future.result()
+        for tenant in tenants:
+            by_tenant[tenant][resource] = results[tenant]
+    return by_tenant, {resource: round(value, 3) for resource, value in seconds.items()}
+
+
+def report(results):
+    """Summary of ``run_steps`` results for logs and responses"""
+    return {
+        'failed': sorted(resource for resource, result in results.items()
+                         if result.status == FAILED),
+        'resources': {resource: result.as_dict() for resource, result in results.items()},
+    }
+
+
+def secret_names(tenant):
+    """Names of the secrets created for ``tenant``"""
+    return [tenant + suffix for suffix in SECRET_SUFFIXES]
+
+
+def delete_secrets(secrets_client, names, workers=DEFAULT_WORKERS, force=False):
+    """Deletes secrets concurrently; there is no batch delete API
+
+    Parameters
+    ----------
+    force: bool
+        Skips the recovery window, so secrets of the same names can be
+        created again right away
+
+    Returns
+    ------
+    dict with the names deleted and the names that did not exist
+    """
+    def delete(name):
+        try:
+            secrets_client.delete_secret(SecretId=name, ForceDeleteWithoutRecovery=force)
+        except secrets_client.exceptions.ResourceNotFoundException:
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names)))) as executor:
+        deleted = dict(zip(names, executor.map(delete, names)))
+    if not any(deleted.values()):
+        raise Missing('No secrets found')
+    return {'deleted': [name for name in names if deleted[name]],
+            'missing': [name for name in names if not deleted[name]]}
+
+
+def lrs_index(lrs, names):
+    """Ids of the LRS instances named in ``names``, keyed by name
+
+    The listing is read page by page, keeping only the wanted names. It
+    is read to the end, since it is not ordered by name and a name can be
+    used by more than one LRS.
+
+    Parameters
+    ----------
+    lrs: LRSClient, required
+    """
+    wanted = set(names)
+    index = {}
+    for instance in lrs.iter_lrs():
+        if instance.name in wanted:
+            index.setdefault(instance.name, []).append(instance.id)
+    return index
+
+
+def delete_lrs(lrs, lrs_ids):
+    """Deletes LRS instances by id"""
+    if not lrs_ids:
+        raise Missing('No LRS found')
+    deleted = [lrs_id for lrs_id in lrs_ids if lrs.delete_lrs(lrs_id)]
+    if not deleted:
+        raise Missing('No LRS found')
+    return {'deleted': deleted}
+
+
+def delete_tenant_lrs(lrs, tenant, lrs_id=None):
+    """Deletes the LRS of ``tenant``
+
+    Uses the id stored when the LRS was provisioned, and looks the LRS up
+    by name only for tenants without one or when that id is gone.
+    """
+    if lrs_id and lrs.delete_lrs(lrs_id):
+        return {'deleted': [lrs_id]}
+    return delete_lrs(lrs, [instance.id for instance in lrs.find_lrs(tenant)])
+
+
+def drop_database(connection, tenant, db_name):
+    """Drops the database and MySQL user of a tenant"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM information_schema.schemata WHERE schema_name = %s",
+                       (db_name,))
+        exists = cursor.fetchone()[0]
+        cursor.execute("DROP DATABASE IF EXISTS {}".format(db_name))
+        cursor.execute("DROP USER IF EXISTS %s@%s", (tenant, ACCESS_HOSTS))
+    finally:
+        cursor.close()
+    if not exists:
+        raise Missing(f'No database {db_name}')
+    return {'database': db_name}
+
+
+def delete_stack(cf_client, tenant, allocator=None):
+    """Starts the deletion of the tenant's CloudFormation stack
+
+    Parameters
+    ----------
+    allocator: PriorityAllocator
+        Gets the tenant's listener rule priority back, whether or not
+        the stack still existed
+    """
+    try:
+        cf_client.describe_stacks(StackName=tenant)
+    except cf_client.exceptions.ClientError as ex:
+        if allocator is not None:
+            allocator.release(tenant)
+        raise Missing(f'No stack {tenant}') from ex
+    cf_client.delete_stack(StackName=tenant)
+    detail = {'stack': tenant}
+    if allocator is not None:
+        detail['released_priorities'] = allocator.release(tenant)
+    return detail
+
+
+def trash_root(root=EFS_ROOT):
+    """Directory tenant trees are moved into before they are purged"""
+    return os.path.join(root, TRASH_DIR)
+
+
+def move_to_trash(tenant, root=EFS_ROOT):
+    """Renames the tenant's EFS directory into the trash
+
+    Returns
+    ------
+    dict with the path the tree now has in the trash
+    """
+    if not tenant or tenant.isspace() or os.sep in tenant or tenant.startswith('.'):
+        raise ValueError(f'Refusing to remove the EFS directory of tenant {tenant!r}')
+    source = os.path.join(root, tenant)
+    if not os.path.isdir(source):
+        raise Missing(f'No directory {source}')
+    trash = trash_root(root)
+    os.makedirs(trash, exist_ok=True)
+    destination = os.path.join(trash, f'{tenant}-{uuid.uuid4().hex}')
+    os.rename(source, destination)
+    return {'trash': destination}
+
+
+def purge_trash(root=EFS_ROOT, workers=EFS_WORKERS, deadline=None, trees=PURGE_TREES):
+    """Removes the trees waiting in the trash until done or ``deadline``
+
+    Parameters
+    ----------
+    workers: int
+        Threads removing each tree
+    trees: int
+        Trees removed at the same time
+
+    Returns
+    ------
+    tuple of (dict of tree name to removal stats, bool whether the trash is empty)
+    """
+    trash = trash_root(root)
+    if not os.path.isdir(trash):
+        return {}, True
+    names = sorted(os.listdir(trash))
+
+    def purge(name):
+        stats, complete = parallel_rmtree(os.path.join(trash, name), workers, deadline)
+        return name, dict(stats.as_dict(), complete=complete)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(trees, len(names)))) as executor:
+        purged = dict(executor.map(purge, names))
+    return purged, all(stats['complete'] for stats in purged.values())
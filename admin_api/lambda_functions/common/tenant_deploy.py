@@ -0,0 +1,221 @@
+"""Runs the CMS deploy task once a tenant stack has settled
+
+Creating or updating a tenant stack takes minutes. Rather than holding
+a Lambda open on a CloudFormation waiter, admin_function records the
+deploy it wants as ``pending_deploy`` on the tenant's registry record
+and returns. CloudFormation status change events then settle the
+record: when the stack reaches a terminal state the pending deploy is
+claimed with a conditional write, so it runs exactly once, and the
+drush or ``create_cms.sh`` task is started. An update that changes
+the version first has ``sync_files`` refresh the starter files of the
+tenant, and that function starts the deploy once it is done, so a
+rolled back update never touches the files. A periodic sweep catches
+missed events and gives up on stacks that never settle.
+"""
+
+import json
+
+import time
+import uuid
+
+from common.base_stack import run_tenant_task
+from common.provisioning import FAILED, SUCCEEDED, ProvisioningLog
+from common.record_store import ConflictError
+from common.secret_store import secret_string
+from common.tenant_registry import KEY, now, record_from_stack
+
+CREATE = 'create'
+UPDATE = 'update'
+SUCCESS_STATES = {CREATE: 'CREATE_COMPLETE', UPDATE: 'UPDATE_COMPLETE'}
+DEFAULT_STACK_TIMEOUT = 5400
+# Longer than the sync_files timeout, so a sync that died is not waited on forever
+SYNC_TIMEOUT = 900
+
+
+def is_terminal(status):
+    """Whether CloudFormation is done changing a stack in ``status``"""
+    return bool(status) and not status.endswith('_IN_PROGRESS')
+
+
+def deploy_command(tenant, pending, secrets_client):
+    """Command of the ECS task that finishes a create or an update"""
+    if pending['action'] != CREATE:
+        return ["drush", "deploy"]
+    return ["sh", "/var/www/html/admin_api/create_cms.sh",
+            "-u", tenant + "_admin",
+            "-e", pending['email'],
+            "-n", pending['full_name'],
+            "-c", secret_string(secrets_client, tenant + "_cron_key")]
+
+
+def request_deploy(registry, tenant, action, tenant_data):
+    """Records the deploy to run when the stack of ``tenant`` settles
+
+    Returns
+    ------
+    dict: the updated registry record
+    """
+    pending = {'action': action, 'token': uuid.uuid4().hex,
+               'requested': int(time.time()), 'requested_at': now()}
+    if action == CREATE:
+        pending['email'] = tenant_data['EMAIL']
+        pending['full_name'] = tenant_data['FULL_NAME']
+    elif tenant_data.get('FROM_VERSION'):
+        pending['from_version'] = tenant_data['FROM_VERSION']
+        pending['to_version'] = tenant_data['VERSION']
+    return registry.update(tenant, pending_deploy=pending, deploy_error=None)
+
+
+def _claim(registry, record, fields):
+    """Clears the pending deploy of ``record`` unless someone else did
+
+    Returns
+    ------
+    dict: the stored record, or None when another caller claimed it
+    """
+    fields = dict(fields, pending_deploy=None, updated_at=now())
+    try:
+        return registry.table.update_if(record[KEY], fields, 'pending_deploy.token',
+                                        record['pending_deploy']['token'])
+    except ConflictError:
+        return None
+
+
+def needs_sync(pending):
+    """Whether the starter files must be synced before the deploy of ``pending``"""
+    return (pending['action'] == UPDATE and 'synced_at' not in pending
+            and 'from_version' in pending and pending['from_version'] != pending['to_version'])
+
+
+def _start_sync(registry, record, lambda_client, clock):
+    # Hands the pending deploy to sync_files, which settles it when done
+    pending = record['pending_deploy']
+    started = dict(pending, token=uuid.uuid4().hex, sync_started=int(clock()))
+    fields = {'pending_deploy': started, 'updated_at': now()}
+    try:
+        registry.table.update_if(record[KEY], fields, 'pending_deploy.token', pending['token'])
+    except ConflictError:
+        return 'claimed elsewhere'
+    lambda_client.invoke(
+        FunctionName='sync_files',
+        InvocationType='Event',
+        Payload=json.dumps({'tenant': record[KEY], 'from_version': pending['from_version'],
+                            'to_version': pending['to_version'], 'token': started['token']}))
+    return 'syncing starter files before the deploy'
+
+
+def finish_sync(registry, tenant, token, error, clients, base_stack):
+    """Starts the deploy that waited for the starter file sync ``token``
+
+    Returns
+    ------
+    str: what was done, for the log
+    """
+    record = registry.get(tenant)
+    pending = (record or {}).get('pending_deploy')
+    if not pending or pending['token'] != token:
+        return 'claimed elsewhere'
+    synced = dict(pending, synced_at=now(), sync_error=error)
+    fields = {'pending_deploy': synced, 'updated_at': now()}
+    try:
+        record = registry.table.update_if(tenant, fields, 'pending_deploy.token', token)
+    except ConflictError:
+        return 'claimed elsewhere'
+    return settle(registry, record, record['stack_status'], clients, base_stack)
+
+
+def _finish_stage(tenant, pending, status, error=None):
+    # Creates time the deploy stage of provisioning, from the request
+    # until the stack has settled and the deploy task was started
+    if pending['action'] == CREATE:
+        ProvisioningLog().finish(tenant, 'deploy', status, error)
+
+
+def settle(registry, record, status, clients, base_stack, clock=time.time):
+    """Finishes the pending deploy of a tenant whose stack reached ``status``
+
+    Parameters
+    ----------
+    registry: TenantRegistry, required
+    record: dict, required
+        Registry record with the new stack status already stored
+    status: str, required
+        Terminal stack status
+    clients: dict, required
+        ``cloudformation``, ``ecs``, ``lambda`` and ``secretsmanager`` clients
+    base_stack: str, required
+        Name of the base stack the tenant runs in
+    clock: callable, optional
+        Current time in seconds, to give up on a starter file sync
+
+    Returns
+    ------
+    str: what was done, for the log
+    """
+    tenant = record[KEY]
+    pending = record.get('pending_deploy')
+    if not pending:
+        return 'nothing pending'
+    if status != SUCCESS_STATES[pending['action']]:
+        if _claim(registry, record, {'deploy_error': f'Stack is {status}'}) is None:
+            return 'claimed elsewhere'
+        _finish_stage(tenant, pending, FAILED, f'Stack is {status}')
+        return f'{pending["action"]} not deployed, stack is {status}'
+    if needs_sync(pending):
+        if 'sync_started' not in pending:
+            return _start_sync(registry, record, clients['lambda'], clock)
+        if clock() - pending['sync_started'] <= SYNC_TIMEOUT:
+            return 'waiting for the starter file sync'
+        print(f'[WARN] The starter file sync of {tenant} did not report back, deploying anyway')
+        record = dict(record, pending_deploy=dict(pending, synced_at=now(), sync_error='Timed out'))
+    if _claim(registry, record, {'sync_error': record['pending_deploy'].get('sync_error')}) is None:
+        return 'claimed elsewhere'
+    try:
+        command = deploy_command(tenant, pending, clients['secretsmanager'])
+        run_tenant_task(clients['cloudformation'], clients['ecs'], base_stack, tenant, command)
+    except Exception as ex:
+        error = f'{type(ex).__name__}: {ex}'
+        registry.update(tenant, deploy_error=error)
+        _finish_stage(tenant, pending, FAILED, error)
+        raise
+    # Stored once the task is running, so upgrades are not counted as done earlier
+    registry.update(tenant, deployed_at=now())
+    _finish_stage(tenant, pending, SUCCEEDED)
+    return f'{pending["action"]} deploy started'
+
+
+def sweep(registry, clients, base_stack, stack_timeout=DEFAULT_STACK_TIMEOUT, clock=time.time):
+    """Settles pending deploys whose status event was missed or never came
+
+    Returns
+    ------
+    dict of tenant name to what was done
+    """
+    cf_client = clients['cloudformation']
+    outcomes = {}
+    for record in registry.tenants():
+        pending = record.get('pending_deploy')
+        if not pending:
+            continue
+        tenant = record[KEY]
+        try:
+            stack = cf_client.describe_stacks(StackName=tenant)['Stacks'][0]
+        except cf_client.exceptions.ClientError as ex:
+            stack = {}
+            print(f'[WARN] Could not read the stack of {tenant}: {ex}')
+        status = stack.get('StackStatus')
+        if is_terminal(status):
+            if status != record.get('stack_status'):
+                version = (record_from_stack(stack) or record).get('version')
+                record = registry.update(tenant, stack_status=status, version=version)
+            outcomes[tenant] = settle(registry, record, status, clients, base_stack, clock)
+        elif clock() - pending['requested'] > stack_timeout:
+            error = f'Stack did not settle within {stack_timeout}s, last status {status}'
+            print(f'[WARN] {tenant}: {error}')
+            claimed = _claim(registry, record, {'deploy_error': error})
+            if claimed:
+                _finish_stage(tenant, pending, FAILED, error)
+            outcomes[tenant] = error if claimed else 'claimed elsewhere'
+        else:
+            outcomes[tenant] = f'waiting, stack is {status}'
+    return outcomes
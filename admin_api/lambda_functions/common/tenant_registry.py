@@ -0,0 +1,129 @@
+"""Registry of tenants and the facts the admin API keeps looking up
+
+Provisioning and updates write each tenant's version, brand, address and
+stack status here, so status, listing, cron and delete calls read one
+record by key instead of scanning CloudFormation stack parameters.
+
+Tenants created before the registry existed are found through
+describe_stacks once and backfilled.
+"""
+
+from datetime import datetime, timezone
+
+from common.record_store import open_table
+
+TABLE_NAME = 'tenants'
+KEY = 'name'
+
+
+def now():
+    """Current time as an ISO 8601 UTC timestamp"""
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def record_from_stack(stack):
+    """Builds a registry record from a describe_stacks entry
+
+    Returns
+    ------
+    dict, or None when the stack is not a tenant stack
+    """
+    tags = {tag['Key']: tag['Value'] for tag in stack.get('Tags', [])}
+    if 'Tenant' not in tags:
+        return None
+    parameters = {parameter['ParameterKey']: parameter.get('ParameterValue')
+                  for parameter in stack.get('Parameters', [])}
+    created = stack.get('CreationTime')
+    updated = stack.get('LastUpdatedTime') or created
+    return {
+        'name': tags['Tenant'],
+        'version': parameters.get('VERSION'),
+        'brand': parameters.get('BRAND'),
+        'address': parameters.get('ADDRESS'),
+        'stack_status': stack['StackStatus'],
+        'created_at': created.isoformat() if created else now(),
+        'updated_at': updated.isoformat() if updated else now(),
+    }
+
+
+class TenantRegistry:
+    """Tenant records keyed by tenant name"""
+
+    def __init__(self, table=None):
+        self.table = table or open_table(TABLE_NAME, KEY)
+
+    def get(self, name):
+        """Returns the record of tenant ``name`` or None"""
+        return self.table.get(name)
+
+    def register(self, name, **fields):
+        """Stores a new tenant record, replacing any stale one"""
+        timestamp = now()
+        record = dict(fields, name=name, created_at=timestamp, updated_at=timestamp)
+        self.table.put(record)
+        return record
+
+    def update(self, name, **fields):
+        """Changes some fields of a tenant record and returns the record"""
+        return self.table.update(name, dict(fields, updated_at=now()))
+
+    def remove(self, name):
+        """Forgets tenant ``name``"""
+        self.table.delete(name)
+
+    def tenants(self):
+        """Returns every tenant record, sorted by name"""
+        return sorted(self.table.scan(), key=lambda record: record[KEY])
+
+    def lookup(self, name, cf_client):
+        """Returns the record of tenant ``name``, backfilling it if needed
+
+        Raises
+        ------
+        KeyError when neither the registry nor CloudFormation know the tenant
+        """
+        record = self.get(name)
+        if record is not None:
+            return record
+        try:
+            stacks = cf_client.describe_stacks(StackName=name)['Stacks']
+        except cf_client.exceptions.ClientError as ex:
+            raise KeyError(name) from ex
+        record = record_from_stack(stacks[0]) if stacks else None
+        if record is None:
+            raise KeyError(name)
+        self.table.put(record)
+        return record
+
+    def refresh_status(self, record, cf_client):
+        """Re-reads the stack status of a tenant whose stack is still changing
+
+        Settled records are returned as they are, so only tenants in the
+        middle of a create, update or rollback cost a CloudFormation call.
+        """
+        if not record.get('stack_status', '').endswith('_IN_PROGRESS'):
+            return record
+        stack = cf_client.describe_stacks(StackName=record[KEY])['Stacks'][0]
+        if stack['StackStatus'] == record['stack_status']:
+            return record
+        # A rollback also restores the previous VERSION parameter
+        fresh = record_from_stack(stack) or {}
+        return self.update(record[KEY], stack_status=stack['StackStatus'],
+                           version=fresh.get('version', record.get('version')))
+
+    def backfill(self, cf_client):
+        """Adds every tenant stack missing from the registry
+
+        Returns
+        ------
+        list of all tenant records, sorted by name
+        """
+        records = {record[KEY]: record for record in self.table.scan()}
+        paginator = cf_client.get_paginator('describe_stacks')
+        for page in paginator.paginate():
+            for stack in page['Stacks']:
+                record = record_from_stack(stack)
+                if record is not None and record[KEY] not in records:
+                    self.table.put(record)
+                    records[record[KEY]] = record
+        return sorted(records.values(), key=lambda record: record[KEY])
@@ -0,0 +1,81 @@
+"""Checks and secrets of a tenant create request
+
+POST /tenant (create_passwords) creates one tenant from a request and
+POST /bulk-create (bulk_create) many, so both validate the request,
+generate the tenant's secrets and start its provisioning the same way.
+"""
+
+import json
+import random
+import re
+import string
+import time
+
+TENANT_PATTERN = '^[a-zA-Z0-9]+$'
+EMAIL_PATTERN = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+MAX_TENANT_LENGTH = 50
+MAX_EMAIL_LENGTH = 75
+PASSWORD_LENGTH = 20
+# Fields the provisioning stages read from the request
+REQUIRED_FIELDS = ('TENANT', 'EMAIL', 'VERSION', 'BRAND', 'SMTPHOST', 'SMTPPORT', 'SMTPUSERNAME',
+                   'SMTPPASSWORD', 'SMTPFROM')
+
+
+def invalid(tenant, email):
+    """Why a tenant name and contact address cannot be used, or None"""
+    if not re.match(TENANT_PATTERN, tenant) or len(tenant) > MAX_TENANT_LENGTH:
+        return "Invalid tenant name"
+    if not re.match(EMAIL_PATTERN, email) or len(email) > MAX_EMAIL_LENGTH:
+        return "Invalid email address"
+    return None
+
+
+def _password(alphabet):
+    return ''.join(random.choices(alphabet, k=PASSWORD_LENGTH))
+
+
+def tenant_secrets(tenant, smtp_password):
+    """Secrets a new tenant needs
+
+    Returns
+    ------
+    list of (name, value, replace) tuples; only the SMTP password given
+    in the request replaces a value stored by an earlier attempt
+    """
+    letters = string.ascii_uppercase + string.ascii_lowercase + string.digits
+    return [
+        (tenant + "_db_password", _password(letters), False),
+        (tenant + "_user_password", _password(letters), False),
+        (tenant + "_lrs_key_password", _password(letters), False),
+        (tenant + "_cron_key", _password(string.ascii_lowercase + string.digits), False),
+        (tenant + "_smtp_password", smtp_password, True),
+    ]
+
+
+def ensure_secret(secrets_client, name, value, replace=False):
+    """Creates a secret, keeping the value an earlier attempt stored unless ``replace``"""
+    try:
+        secrets_client.create_secret(Name=name, SecretString=value)
+    except secrets_client.exceptions.ResourceExistsException:
+        if replace:
+            secrets_client.put_secret_value(SecretId=name, SecretString=value)
+        print("Secret " + name + " already exists")
+
+
+def start_provisioning(sfn_client, state_machine_arn, tenant, body):
+    """Starts the provisioning state machine for ``tenant``
+
+    Parameters
+    ----------
+    body: str, required
+        The create request as JSON, handed to every stage
+
+    Returns
+    ------
+    dict: the start_execution response
+    """
+    return sfn_client.start_execution(
+        stateMachineArn=state_machine_arn,
+        name=tenant + '-' + str(int(time.time())),
+        input=json.dumps({"httpMethod": "POST", "body": body})
+    )
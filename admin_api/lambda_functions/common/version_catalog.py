@@ -0,0 +1,209 @@
+"""Catalog of the CMS versions in the release bucket
+
+Listing versions and checking that a version exists used to cost an S3
+listing on every request. The catalog keeps one record per version in
+the ``versions`` table, describing what provisioning and upgrades need
+from it, in the layout the stages read after it is mirrored to EFS::
+
+    <version>/code/scripts/tenant.yml        tenant stack template
+    <version>/starter/CMS-Database.sql       starter database
+    <version>/starter/solr.tar[.zst|.gz]     Solr configuration and index
+    <version>/starter/public/...             public files
+
+Reads go to an in-process cache first and to the table after it
+expires. The whole catalog is rebuilt from S3 once it is older than
+``version_catalog_ttl`` seconds, and the versions touched by an S3
+upload or delete are rescanned as soon as its event arrives. A version
+missing from the catalog is looked up in S3 before it is reported
+missing, so one uploaded between two refreshes can be used right away.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+
+from decouple import config
+
+from common import runtime
+from common.cache import TTLCache
+from common.record_store import open_table
+from common.tenant_registry import now
+
+TABLE_NAME = 'versions'
+KEY = 'version'
+# Record holding when the catalog was last rebuilt
+BUILD_KEY = '#catalog'
+TEMPLATE_KEY = 'code/scripts/tenant.yml'
+STARTER_SQL = 'starter/CMS-Database.sql'
+SOLR_ARCHIVES = tuple(f'starter/solr{suffix}' for suffix in ('.tar', '.tar.zst', '.tar.gz'))
+PUBLIC_PREFIX = 'starter/public/'
+SCAN_WORKERS = 8
+
+_cache = TTLCache(ttl=config('version_cache_ttl', default=300, cast=int), maxsize=8)
+
+
+def _pages(s3_client, **arguments):
+    yield from s3_client.get_paginator('list_objects_v2').paginate(**arguments)
+
+
+def list_versions(s3_client, bucket):
+    """Names of every version, following the pagination of CommonPrefixes"""
+    return [prefix['Prefix'].strip('/')
+            for page in _pages(s3_client, Bucket=bucket, Delimiter='/')
+            for prefix in page.get('CommonPrefixes', [])]
+
+
+def _object(objects, key):
+    size = objects.get(key)
+    return {'key': key, 'bytes': size} if size is not None else None
+
+
+def scan_version(s3_client, bucket, version):
+    """Describes the template and starter assets of ``version``
+
+    Returns
+    ------
+    dict: the catalog record, or None when nothing is stored under the version
+    """
+    root = f'{version}/'
+    template = [item for item in s3_client.list_objects_v2(
+        Bucket=bucket, Prefix=root + TEMPLATE_KEY, MaxKeys=1).get('Contents', [])
+                if item['Key'] == root + TEMPLATE_KEY]
+    objects = {}
+    public_files = public_bytes = 0
+    for page in _pages(s3_client, Bucket=bucket, Prefix=root + 'starter/'):
+        for item in page.get('Contents', []):
+            relative = item['Key'][len(root):]
+            if relative.startswith(PUBLIC_PREFIX):
+                public_files += 1
+                public_bytes += item['Size']
+            else:
+                objects[relative] = item['Size']
+    if not template and not objects and not public_files:
+        # Anything else under the prefix still makes it a version
+        if not s3_client.list_objects_v2(Bucket=bucket, Prefix=root, MaxKeys=1)['KeyCount']:
+            return None
+    solr = next((_object(objects, key) for key in SOLR_ARCHIVES if key in objects), None)
+    record = {
+        KEY: version,
+        'template_url': f'https://{bucket}.s3.amazonaws.com/{root}{TEMPLATE_KEY}',
+        'template': bool(template),
+        'sql': _object(objects, STARTER_SQL),
+        'solr': solr,
+        'public': {'files': public_files, 'bytes': public_bytes},
+        'scanned_at': now(),
+    }
+    record['missing'] = [name for name, present in (
+        ('template', record['template']), ('sql', record['sql']), ('solr', solr),
+        ('public', public_files)) if not present]
+    return record
+
+
+def changed_versions(event):
+    """Versions whose objects an S3 event notification is about
+
+    Takes EventBridge ``Object Created`` and ``Object Deleted`` events as
+    well as S3 notifications with ``Records``.
+    """
+    if event.get('source') == 'aws.s3':
+        keys = [event.get('detail', {}).get('object', {}).get('key', '')]
+    else:
+        keys = [record.get('s3', {}).get('object', {}).get('key', '')
+                for record in event.get('Records', [])]
+    return sorted({unquote_plus(key).split('/')[0] for key in keys if '/' in key})
+
+
+class VersionCatalog:
+    """Versions of the release bucket, cached in process and in the versions table"""
+
+    def __init__(self, s3_client=None, bucket=None, table=None, ttl=None, clock=time.time):
+        self.s3_client = s3_client or runtime.client('s3')
+        self.bucket = bucket or runtime.setting('s3_bucket')
+        self.table = table or open_table(TABLE_NAME, KEY)
+        self.ttl = ttl if ttl is not None else runtime.setting(
+            'version_catalog_ttl', default=3600, cast=int)
+        self.clock = clock
+
+    def _load(self):
+        records = {record[KEY]: record for record in self.table.scan()}
+        built = records.pop(BUILD_KEY, None)
+        if built is None or self.clock() - built['built'] > self.ttl:
+            return self.rebuild(stored=records)
+        return records
+
+    def versions(self):
+        """Every version mapped to its catalog record"""
+        return _cache.get_or_load(self.bucket, self._load)
+
+    def get(self, version):
+        """Catalog record of ``version``, rescanning S3 when it is not known"""
+        record = self.versions().get(version)
+        if record is None and version and '/' not in version:
+            record = self.refresh([version]).get(version)
+        return record
+
+    def exists(self, version):
+        """Whether ``version`` is stored in the release bucket"""
+        return self.get(version) is not None
+
+    def deployable(self, version):
+        """Catalog record of ``version`` if it has a tenant stack template, else None"""
+        record = self.get(version)
+        return record if record and record['template'] else None
+
+    def rebuild(self, stored=None):
+        """Rescans every version and replaces the catalog
+
+        Parameters
+        ----------
+        stored: dict
+            The version records already read from the table
+
+        Returns
+        ------
+        dict of version to catalog record
+        """
+        names = list_versions(self.s3_client, self.bucket)
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+            scanned = executor.map(
+                lambda version: scan_version(self.s3_client, self.bucket, version), names)
+            records = {record[KEY]: record for record in scanned if record}
+        if stored is None:
+            stored = {record[KEY]: record for record in self.table.scan()}
+        stale = [version for version in stored
+                 if version != BUILD_KEY and version not in records]
+        for record in records.values():
+            self.table.put(record)
+        for version in stale:
+            self.table.delete(version)
+        self.table.put({KEY: BUILD_KEY, 'built': self.clock(), 'built_at': now(),
+                        'count': len(records)})
+        _cache.set(self.bucket, records)
+        print(f'Rebuilt the version catalog of {self.bucket}: {len(records)} versions')
+        return records
+
+    def refresh(self, versions):
+        """Rescans ``versions`` only, e.g. after an upload
+
+        Returns
+        ------
+        dict of version to its new record, or None when it is gone
+        """
+        refreshed = {}
+        for version in versions:
+            record = scan_version(self.s3_client, self.bucket, version)
+            if record is None:
+                self.table.delete(version)
+            else:
+                self.table.put(record)
+            refreshed[version] = record
+        cached = _cache.get(self.bucket)
+        if cached is not None:
+            cached = dict(cached)
+            for version, record in refreshed.items():
+                if record is None:
+                    cached.pop(version, None)
+                else:
+                    cached[version] = record
+            _cache.set(self.bucket, cached)
+        return refreshed
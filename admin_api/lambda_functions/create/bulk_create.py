@@ -0,0 +1,351 @@
+"""Creates many tenants from one request
+
+POST /bulk-create with ``{"tenants": [...]}`` checks every tenant up
+front, prepares the accepted ones and starts a job; GET
+/bulk-create/{job} reports it, with a row per tenant, and PUT
+/bulk-create/{job} with ``{"action": "pause"}``, ``"resume"`` or
+``"cancel"`` controls it. A one minute schedule invokes the function
+with ``{"action": "tick"}`` to move every running job on.
+
+Each tenant entry holds the fields of a POST /tenant request; fields
+given next to ``tenants`` apply to every entry that leaves them out, so
+a district's SMTP settings and version are written once. Where POST
+/tenant repeats the version and base stack checks for every tenant, a
+bulk create looks each version up in the catalog once, resolves the
+base stack once, lists the existing stacks once, creates all the
+secrets from one pool of threads and allocates every listener rule
+priority in one write. The job then runs the provisioning state machine
+of at most ``concurrency`` tenants at a time.
+
+A tenant that fails, or is still waiting when its job is cancelled,
+gives its priority back unless its stack was created, and its secrets
+unless a stage already used them, so it can be requested again.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from common import runtime, teardown
+from common.base_stack import resolve as resolve_base_stack
+from common.fleet_jobs import (FAILED, JOB_CANCELLED, JOB_PAUSED, JOB_RUNNING, PENDING, RUNNING,
+                               SKIPPED, SUCCEEDED, JobStore, job_options, new_job, progress)
+from common.priority_allocator import PriorityAllocator, listener_priorities
+from common.provisioning import FAILED as STAGE_FAILED
+from common.provisioning import SUCCEEDED as STAGE_SUCCEEDED
+from common.provisioning import PIPELINE, ProvisioningLog
+from common.record_store import ConflictError
+from common.tenant_request import (REQUIRED_FIELDS, ensure_secret, invalid, start_provisioning,
+                                   tenant_secrets)
+from common.version_catalog import VersionCatalog
+
+KIND = 'create'
+ACTIONS = {'pause': JOB_PAUSED, 'resume': JOB_RUNNING, 'cancel': JOB_CANCELLED}
+# Keeps the checks and secrets within the API Gateway timeout
+MAX_TENANTS = 100
+SECRET_WORKERS = 10
+# Fields of the bulk request that are not tenant fields
+JOB_FIELDS = ('tenants', 'concurrency', 'canaries', 'max_failure_rate', 'min_samples',
+              'task_timeout')
+
+
+def _response(status_code, body):
+    return {"statusCode": status_code, "body": json.dumps(body)}
+
+
+def tenant_requests(body):
+    """Builds the create request of every tenant entry
+
+    Returns
+    ------
+    tuple of (dict of tenant to its request, dict of rejected tenant to reason)
+    """
+    entries = body.get('tenants')
+    if not entries or not isinstance(entries, list):
+        raise ValueError("Give the tenants to create")
+    if len(entries) > MAX_TENANTS:
+        raise ValueError(f"{len(entries)} tenants given, at most {MAX_TENANTS} are created at once")
+    defaults = {field: value for field, value in body.items() if field not in JOB_FIELDS}
+    requests = {}
+    rejected = {}
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            rejected[f'#{number}'] = 'Not an object'
+            continue
+        data = dict(defaults, **entry)
+        tenant = str(data.get('TENANT', '')).lower()
+        if not tenant:
+            rejected[f'#{number}'] = 'Missing TENANT'
+            continue
+        data['TENANT'] = tenant
+        missing = [field for field in REQUIRED_FIELDS if not data.get(field)]
+        problem = invalid(tenant, str(data.get('EMAIL', ''))) if not missing else None
+        if tenant in requests or tenant in rejected:
+            rejected[tenant] = 'Given more than once'
+            requests.pop(tenant, None)
+        elif missing:
+            rejected[tenant] = f"Missing {', '.join(missing)}"
+        elif problem:
+            rejected[tenant] = problem
+        else:
+            requests[tenant] = data
+    return requests, rejected
+
+
+def existing_stacks(cf_client):
+    """Names of every stack that is not deleted, from one paginated listing"""
+    names = set()
+    for page in cf_client.get_paginator('list_stacks').paginate():
+        names.update(summary['StackName'] for summary in page['StackSummaries']
+                     if summary['StackStatus'] != 'DELETE_COMPLETE')
+    return names
+
+
+def check_tenants(requests, rejected, cf_client):
+    """Rejects tenants whose version is missing or that already exist
+
+    Changes ``requests`` and ``rejected`` in place.
+
+    Returns
+    ------
+    dict of tenant to the stages a resumed provisioning still has to run
+    """
+    catalog = VersionCatalog()
+    versions = {version: catalog.deployable(version)
+                for version in {data['VERSION'] for data in requests.values()}}
+    stacks = existing_stacks(cf_client)
+    log = ProvisioningLog()
+    resumed = {}
+    for tenant, data in list(requests.items()):
+        if not versions[data['VERSION']]:
+            rejected[tenant] = "CMS Version not available"
+        elif tenant in stacks:
+            incomplete = log.incomplete(tenant)
+            if incomplete and len(incomplete) < len(PIPELINE):
+                resumed[tenant] = incomplete
+                continue
+            rejected[tenant] = "Tenant already exists."
+        else:
+            continue
+        del requests[tenant]
+    return resumed
+
+
+def create_secrets(secrets_client, requests):
+    """Creates the secrets of every tenant concurrently
+
+    Returns
+    ------
+    dict of tenant to the error that stopped its secrets from being created
+    """
+    work = [(tenant, secret) for tenant, data in requests.items()
+            for secret in tenant_secrets(tenant, data['SMTPPASSWORD'])]
+
+    def create(item):
+        tenant, (name, value, replace) = item
+        try:
+            ensure_secret(secrets_client, name, value, replace)
+        except Exception as ex:  # pylint: disable=broad-except
+            return tenant, f'{name}: {type(ex).__name__}: {ex}'
+        return tenant, None
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=SECRET_WORKERS) as executor:
+        for tenant, error in executor.map(create, work):
+            if error and tenant not in failed:
+                failed[tenant] = error
+    return failed
+
+
+def create_job(body):
+    """Checks and prepares the tenants of a bulk create request and builds its job
+
+    Whatever was reserved for the tenants is given back when the job
+    cannot be built.
+    """
+    options = job_options(body)
+    requests, rejected = tenant_requests(body)
+    cf_client = runtime.client('cloudformation')
+    base_stack = runtime.setting('base_stack')
+    try:
+        topology = resolve_base_stack(cf_client, base_stack)
+    except Exception as ex:
+        raise Exception("The base stack " + base_stack + " does not exist") from ex
+    resumed = check_tenants(requests, rejected, cf_client)
+
+    failed = create_secrets(runtime.client('secretsmanager'), requests)
+    for tenant, error in failed.items():
+        rejected[tenant] = f'Creating secrets failed: {error}'
+        del requests[tenant]
+    if failed:
+        # Some of their secrets may have been created before one failed
+        release_unused(list(failed))
+    if not requests:
+        raise ValueError(f"No tenant can be created: {json.dumps(rejected)}")
+
+    try:
+        elb_client = runtime.client('elbv2')
+        listener_arn = topology.listener_arn()
+        priorities = PriorityAllocator().allocate_all(
+            sorted(requests), lambda: listener_priorities(elb_client, [listener_arn]))
+
+        # The stages read the SMTP password from its secret, so it is not kept in the job
+        bodies = {tenant: json.dumps({field: value for field, value in data.items()
+                                      if field != 'SMTPPASSWORD'})
+                  for tenant, data in requests.items()}
+        job = new_job(KIND, list(requests), {'requests': bodies}, skipped=rejected, **options)
+        for tenant in requests:
+            job['tasks'][tenant]['priority'] = priorities[tenant]
+            if tenant in resumed:
+                job['tasks'][tenant]['resume_at'] = resumed[tenant]
+    except Exception:
+        release_unused(list(requests))
+        raise
+    return job
+
+
+def release_unused(tenants):
+    """Gives back what the job reserved for tenants that were not created
+
+    The listener rule priority is kept once the tenant's stack exists and
+    the secrets once a stage used them, as a resumed create needs both.
+
+    Returns
+    ------
+    dict of tenant to what was given back
+    """
+    log = ProvisioningLog()
+    secrets_client = runtime.client('secretsmanager')
+    released = {}
+    for tenant in tenants:
+        succeeded = {name for name, record in log.stages(tenant).items()
+                     if record['status'] == STAGE_SUCCEEDED}
+        released[tenant] = []
+        if 'stack' not in succeeded:
+            released[tenant].append('priority')
+        if not succeeded:
+            try:
+                teardown.delete_secrets(secrets_client, teardown.secret_names(tenant),
+                                        force=True)
+            except teardown.Missing:
+                pass
+            released[tenant].append('secrets')
+    PriorityAllocator().release(*[tenant for tenant, kinds in released.items()
+                                  if 'priority' in kinds])
+    return released
+
+
+def start_create(tenant, job):
+    """Starts the provisioning state machine of one tenant"""
+    try:
+        execution = start_provisioning(runtime.client('stepfunctions'),
+                                       runtime.setting('provisioning_state_machine'),
+                                       tenant, job['params']['requests'][tenant])
+    except Exception:
+        release_unused([tenant])
+        raise
+    job['tasks'][tenant]['execution'] = execution['executionArn']
+
+
+def cancel_pending(store, job, attempts=5):
+    """Skips the tenants a cancelled job never started and releases what they held
+
+    Returns
+    ------
+    dict: the saved job
+    """
+    for _ in range(attempts):
+        pending = [tenant for tenant in job['order']
+                   if job['tasks'][tenant]['state'] == PENDING]
+        if not pending:
+            return job
+        for tenant in pending:
+            job['tasks'][tenant].update(state=SKIPPED, error='Job cancelled')
+        try:
+            job = store.save(job)
+        except ConflictError:
+            job = store.get(job['job_id'])
+            continue
+        release_unused(pending)
+        return job
+    raise ConflictError(job['job_id'])
+
+
+def poll_create(tenant, task, job):
+    """Reads the state of one tenant's provisioning and the stages it ran"""
+    execution = runtime.client('stepfunctions').describe_execution(
+        executionArn=task['execution'])
+    stages = ProvisioningLog().stages(tenant)
+    task['stages'] = {name: {'status': record['status'], 'seconds': record.get('seconds')}
+                      for name, record in stages.items()}
+    status = execution['status']
+    if status == 'RUNNING':
+        return RUNNING, None
+    if status == 'SUCCEEDED':
+        return SUCCEEDED, None
+    errors = [f"{name}: {record.get('error')}" for name, record in stages.items()
+              if record['status'] == STAGE_FAILED]
+    release_unused([tenant])
+    return FAILED, '; '.join(errors) or f'Provisioning {status.lower()}'
+
+
+def results(job):
+    """One row per tenant of a job, rejected tenants included"""
+    return {tenant: {field: task[field]
+                     for field in ('state', 'error', 'priority', 'resume_at', 'stages')
+                     if field in task}
+            for tenant, task in sorted(job['tasks'].items())}
+
+
+@runtime.instrumented
+def lambda_handler(event, context):
+    """
+    Parameters
+    ----------
+    event: dict, required
+        API Gateway Lambda Proxy Input Format, or ``{"action": "tick"}``
+        from the schedule
+
+    Returns
+    ------
+    API Gateway Lambda Proxy Output Format: dict
+    """
+
+    store = JobStore()
+    if event.get('action') == 'tick':
+        jobs = [store.step(job, start_create, poll_create) for job in store.active(KIND)]
+        return {'jobs': [progress(job) for job in jobs if job]}
+
+    method = event.get('httpMethod')
+    job_id = (event.get('pathParameters') or {}).get('job')
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return _response(400, {"message": "Body is not valid JSON"})
+
+    if method == 'POST':
+        try:
+            job = create_job(body)
+        except ValueError as ex:
+            return _response(400, {"message": str(ex)})
+        try:
+            store.create(job)
+        except Exception:
+            release_unused(job['order'])
+            raise
+        print(f"Started bulk create {job['job_id']} of {len(job['order'])} tenants")
+        job = store.step(job, start_create, poll_create)
+    elif method == 'PUT':
+        action = body.get('action')
+        if action not in ACTIONS:
+            return _response(400, {"message": "action must be pause, resume or cancel"})
+        reason = 'Paused by request' if action == 'pause' else None
+        job = store.set_status(job_id, ACTIONS[action], reason)
+        if action == 'cancel' and job is not None and job.get('kind') == KIND:
+            job = cancel_pending(store, job)
+    else:
+        job = store.get(job_id)
+    if job is None or job.get('kind') != KIND:
+        return _response(404, {"message": "Job does not exist"})
+    summary = progress(job)
+    summary['tenants'] = results(job)
+    return _response(202 if method == 'POST' else 200, summary)
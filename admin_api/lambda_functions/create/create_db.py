@@ -1,25 +1,33 @@
-def lambda_handler(event, context):
-  import mysql.connector
-  import boto3
-  import json
-  import re
-  from mysql.connector.errors import OperationalError, ProgrammingError
+import json
+import mysql.connector
+from mysql.connector.errors import OperationalError, ProgrammingError
+from common import provisioning
+from common import runtime
+from common.db_template import clone_template, ensure_template
+from common.dump_artifact import load_statements
+from common.parallel_load import compare_with_dump, load_parallel
+from common.secret_store import get_secrets
+from common.sql_import import import_statements
+
 
+@runtime.instrumented
+@provisioning.stage('db')
+def lambda_handler(event, context):
   print("Starting db load")
-  session = boto3.Session()
-  secrets_client = session.client('secretsmanager')
+  secrets_client = runtime.client('secretsmanager')
   version = event['VERSION']
   tenant = event['TENANT'].lower()
   brand = event['BRAND']
-  db_password_secret = secrets_client.get_secret_value(SecretId=tenant + '_db_password')
-  db_password = db_password_secret['SecretString']
+  secrets = get_secrets(secrets_client, [tenant + '_db_password', 'rds_admin_login'])
+  db_password = secrets[tenant + '_db_password']['SecretString']
   db_name = tenant + "_" + brand
   access_hosts = "10.0.0.0/255.255.0.0"
-  rds_secret = secrets_client.get_secret_value(SecretId='rds_admin_login')
-  rds_info = json.loads(rds_secret['SecretString'])
+  rds_info = json.loads(secrets['rds_admin_login']['SecretString'])
   rds_user = rds_info['username']
   rds_password = rds_info['password']
   rds_host = rds_info['host']
+  load_concurrency = runtime.setting('db_load_concurrency', default=1, cast=int)
+  provision_mode = runtime.setting('db_provision_mode', default='replay')
 
   sql_file = "/mnt/efs/version/" + version + "/starter/CMS-Database.sql"
 
@@ -30,9 +38,14 @@ def lambda_handler(event, context):
     password=rds_password
   )
   mycursor = mydb.cursor()
-  create_mysql_user = "CREATE USER %s@%s IDENTIFIED BY %s"
+  ### A retried provisioning finds the user and the database already there
+  create_mysql_user = "CREATE USER IF NOT EXISTS %s@%s IDENTIFIED BY %s"
   mycursor.execute(create_mysql_user, (tenant, access_hosts, db_password))
-  mycursor.execute("CREATE DATABASE {}".format(db_name))
+  mycursor.execute("ALTER USER %s@%s IDENTIFIED BY %s", (tenant, access_hosts, db_password))
+  mycursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = %s",
+                   (db_name,))
+  existing_tables = mycursor.fetchone()[0]
+  mycursor.execute("CREATE DATABASE IF NOT EXISTS {}".format(db_name))
   grant = "GRANT SELECT, INSERT, UPDATE, DELETE, CREATE, DROP, INDEX, ALTER, CREATE TEMPORARY TABLES ON {}.* TO %s@%s"
   mycursor.execute(grant.format(db_name), (tenant, access_hosts))
   mycursor.execute("Flush Privileges")
@@ -40,29 +53,68 @@ def lambda_handler(event, context):
   mydb.close()
 
   ###import db
-  tenantdb = mysql.connector.connect(
-    host=rds_host,
-    user=rds_user,
-    password=rds_password,
-    database=db_name
-  )
-  cursor = tenantdb.cursor()
+  tenantdb_args = {
+    "host": rds_host,
+    "user": rds_user,
+    "password": rds_password,
+    "database": db_name
+  }
+  load_errors = (OperationalError, ProgrammingError)
+  mismatches = {}
+  if existing_tables:
+    tenantdb = mysql.connector.connect(**tenantdb_args)
+    incomplete, grown, unknown = compare_with_dump(tenantdb, db_name, load_statements(sql_file))
+    tenantdb.close()
+    if unknown:
+      print("[WARN] Could not count the rows the dump inserts into " + ", ".join(unknown)
+            + ", only checked that they are not empty")
+    if not incomplete:
+      print('Database ' + db_name + ' already holds version ' + version + ', skipping the import')
+      return { "statusCode": 200 }
+    ### Data written since the load must never be dropped to reload the dump
+    if grown:
+      print("[WARN] Database " + db_name + " is incomplete but holds data beyond the dump, "
+            "leaving it alone: " + str(incomplete))
+      return { "statusCode": 409,
+               "body": json.dumps({"incomplete": incomplete, "beyond_dump": grown})
+             }
+    print("[WARN] Database " + db_name + " is incomplete, reloading it: " + str(incomplete))
+    mydb = mysql.connector.connect(host=rds_host, user=rds_user, password=rds_password)
+    mycursor = mydb.cursor()
+    mycursor.execute("DROP DATABASE IF EXISTS {}".format(db_name))
+    mycursor.execute("CREATE DATABASE {}".format(db_name))
+    mycursor.close()
+    mydb.close()
+  if provision_mode == 'template':
+    server_args = {"host": rds_host, "user": rds_user, "password": rds_password}
+    try:
+      template = ensure_template(server_args, version, sql_file,
+                                 lambda: load_statements(sql_file), load_errors, load_concurrency)
+      clone_template(server_args, template, db_name, load_concurrency)
+      print('Database ' + db_name + ' cloned from template ' + template)
+    except (mysql.connector.Error, ValueError) as e:
+      print("[WARN] Template clone failed, replaying " + sql_file + ": " + str(e))
+      mydb = mysql.connector.connect(**server_args)
+      mycursor = mydb.cursor()
+      mycursor.execute("DROP DATABASE IF EXISTS {}".format(db_name))
+      mycursor.execute("CREATE DATABASE {}".format(db_name))
+      mycursor.close()
+      mydb.close()
+      provision_mode = 'replay'
 
-  statement = ""
-  for line in open(sql_file, "r"):
-    if re.match(r'--', line):  # ignore sql comment lines
-      continue
-    if not re.search(r';$', line):  # keep appending lines that don't end in ';'
-      statement = statement + line
-    else:  # when you get a line ending in ';' then exec statement and reset for next statement
-      statement = statement + line
-      try:
-        cursor.execute(statement)
-      except (OperationalError, ProgrammingError) as e:
-        print("[WARN] MySQLError during execute statement Args: '{}'".format(str(e.args)))
-      statement = ""
-  tenantdb.commit()
-  tenantdb.close()
+  if provision_mode != 'template':
+    statements = load_statements(sql_file)
+    if load_concurrency > 1:
+      stats, mismatches = load_parallel(tenantdb_args, statements, load_errors, load_concurrency)
+    else:
+      tenantdb = mysql.connector.connect(**tenantdb_args)
+      stats = import_statements(tenantdb, statements, load_errors)
+      tenantdb.close()
+    print("Imported " + sql_file + ": " + stats.summary())
+  if mismatches:
+    return { "statusCode": 500,
+             "body": json.dumps({"row_count_mismatches": mismatches})
+           }
   print('Database version ' + version + ' has sucessfully been loaded for ' + tenant)
   return { "statusCode": 200 }
 
@@ -5,7 +5,13 @@ user is mounted to /efs
 
 import json
 import os
-import shutil
+from common import asset_store
+from common import provisioning
+from common import runtime
+from common.efs_io import (clear_directory, parallel_copytree, starter_marker,
+                             write_starter_marker)
+@runtime.instrumented
+@provisioning.stage('files')
 def lambda_handler(event, context):
     """
     Parameters
@@ -26,11 +32,24 @@ def lambda_handler(event, context):
 
     print("Create directories")
     destination = f"/mnt/efs/{tenant}"
-    os.mkdir(f'{destination}/private')
+    os.makedirs(f'{destination}/private', exist_ok=True)
 
     print("Copying public files.")
     files_source = f'/mnt/efs/version/{version}/starter/public'
     files_dest = f'{destination}/public'
-    shutil.copytree(files_source, files_dest)
+    # Kept next to the public directory so the web server never serves it
+    marker = f'{destination}/.public.starter.json'
+    done = starter_marker(marker, version)
+    if done:
+        print(f'Public files of version {version} are already copied')
+        return {'message': 'Files already copied', 'summary': done}
+    # An earlier attempt may have stopped halfway through
+    clear_directory(files_dest)
+    if runtime.setting('shared_starter_assets', default=False, cast=bool):
+        stats = asset_store.populate('public', version, files_source, files_dest)
+    else:
+        stats = parallel_copytree(files_source, files_dest)
+    write_starter_marker(marker, version, stats)
+    print(f'Copied {files_source}: {stats.summary()}')
 
-    return {'message': 'Files sucessfully copied'}
+    return {'message': 'Files sucessfully copied', 'summary': stats.as_dict()}
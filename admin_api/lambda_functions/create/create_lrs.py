@@ -1,9 +1,14 @@
 """Provides handler for creating an LRS via Veracity API
 """
-import boto3
-import requests
+from datetime import date
+from common import provisioning
+from common import runtime
+from common.lrs_client import LRSClient
+from common.secret_store import get_secrets
 
 
+@runtime.instrumented
+@provisioning.stage('lrs')
 def lambda_handler(event, context):
     """Provides handler for creating an LRS via Veracity API
 
@@ -17,89 +22,47 @@ def lambda_handler(event, context):
     API Gateway Lambda Proxy Output Format: dict
     """
 
-    ## Lambda doesn't understand from XXX import YYY at a global
-    ## level from what I can tell. Allow from XXX import YYY
-    from datetime import date # pylint: disable=import-outside-toplevel
-    from decouple import config  # pylint: disable=import-outside-toplevel
-
     print("Starting creation of the lrs")
     toc_date = date.today().strftime("%m/%d/%y")
-    session = boto3.Session()
-    secrets_client = session.client('secretsmanager')
-    lrs_api_key = config('lrs_api_key')
+    secrets_client = runtime.client('secretsmanager')
     tenant = event['TENANT'].lower()
     email = event['EMAIL']
-    admin_uuid = config('admin_uuid')
-    lrs_base_url = config('lrs_base_url')
-    lrs_user_url = f'{lrs_base_url}admin/api/user'
-    lrs_lrs_url = f'{lrs_base_url}admin/api/lrs'
-    lrs_key_url = f'{lrs_base_url}api/{tenant}/xapi-access-keys'
-    user_password_secret = secrets_client.get_secret_value(
-        SecretId=f"{tenant}_user_password")
-    user_password = user_password_secret['SecretString']
-    lrs_key_password_secret = secrets_client.get_secret_value(
-        SecretId=f"{tenant}_lrs_key_password")
-    lrs_key_password = lrs_key_password_secret['SecretString']
+    admin_uuid = runtime.setting('admin_uuid')
+    lrs = LRSClient.from_base_url(runtime.setting('lrs_base_url'), runtime.setting('lrs_api_key'))
+    secrets = get_secrets(secrets_client,
+                          [f"{tenant}_user_password", f"{tenant}_lrs_key_password"])
+    user_password = secrets[f"{tenant}_user_password"]['SecretString']
+    lrs_key_password = secrets[f"{tenant}_lrs_key_password"]['SecretString']
     try:
         # TODO: Create Forwarder if they have an LRS already.
 
-        ### Check for existing user
-        search_query = f'{{"email": "{email}"}}'
-        lrs_user_response = requests.get(f'{lrs_user_url}?search={search_query}',
-            headers={"x-veracity-api-key": lrs_api_key})
-        lrs_user_info = lrs_user_response.json()
-
         ### Create a new user if one doesn't exist
-        if not lrs_user_info:
-            lrs_create_user_json = {
-                "username": email,
-                "email": email,
-                "publicAccount": True,
-                "password": user_password,
-                "acceptsTOS": toc_date,
-                "verifiedEmail": True
-            }
-            lrs_user_response = requests.post(lrs_user_url,
-                json=lrs_create_user_json, headers={"x-veracity-api-key": lrs_api_key})
-            lrs_user_info = lrs_user_response.json()
-        else:
-            ## Select first one in array
-            lrs_user_info = lrs_user_info[0]
+        user = lrs.find_user(email) or lrs.create_user(email, user_password, toc_date)
 
-        ### Create LRS for Tenant
-        ### with given user
-        user_uuid = lrs_user_info['uuid']
-        lrs_create_json = {
-            "owner": admin_uuid,
-            "lrsName": tenant,
-            "active": True,
-            "strict": False,
-            "compatibilityLevel": 0,
-            "verboseLogs": True,
-            "permissions": {
-                user_uuid: ["lrs.edit", "lrs.**.edit",
-                            "lrs.view", "lrs.**.view"]
-            }
-        }
-        requests.post(lrs_lrs_url,
-            json=lrs_create_json, headers={"x-veracity-api-key": lrs_api_key})
+        ### Create LRS for Tenant with given user;
+        ### a retried provisioning finds the LRS already there
+        existing = lrs.find_lrs(tenant)
+        if existing:
+            print(f'The LRS of tenant {tenant} already exists')
+            instance = existing[0]
+        else:
+            instance = lrs.create_lrs(tenant, admin_uuid, {
+                user.uuid: ["lrs.edit", "lrs.**.edit", "lrs.view", "lrs.**.view"]
+            }) or next(iter(lrs.find_lrs(tenant)), None)
+        ### Deleting the tenant looks the LRS up by this id
+        if instance is not None:
+            provisioning.ProvisioningLog().note(tenant, 'lrs', lrs_id=instance.id)
 
         ### Create API Key for LRS
-        lrs_create_key_json = {
-            "name": tenant,
-            "read": True,
-            "write": True,
-            "jwt": False,
-            "enabled": True,
-            "advancedQueries": True,
-            "limitedRead": False,
-            "username": tenant,
-            "password": lrs_key_password
-        }
-        requests.post(lrs_key_url, json=lrs_create_key_json,
-            headers={"x-veracity-api-key": lrs_api_key})
+        if any(key.username == tenant for key in lrs.access_keys(tenant)):
+            print(f'The LRS access key of tenant {tenant} already exists')
+        else:
+            lrs.create_access_key(tenant, tenant, lrs_key_password)
     except Exception as ex:
         print(f'An exception occurred: {ex}')
         raise
+    finally:
+        if lrs.retried:
+            print(f'Retried {lrs.retried} LRS requests')
 
     return {"message": f'The LRS has been successfully created for tenant {tenant}.'}
@@ -1,7 +1,15 @@
-def lambda_handler(event, context):
-  import tarfile
-  import json
+import json
+import os
+from common import asset_store
+from common import provisioning
+from common import runtime
+from common.efs_io import (STARTER_MARKER, clear_directory, extract_archive, find_archive,
+                             starter_marker, write_starter_marker)
+
 
+@runtime.instrumented
+@provisioning.stage('solr')
+def lambda_handler(event, context):
   print("Starting solr fs creation")
   tenant_info = event['body']
   tenant_data = json.loads(tenant_info)
@@ -10,10 +18,21 @@ def lambda_handler(event, context):
 
   print("Copying solr config and index.")
 
-  solr_src="/mnt/efs/version/" + version + "/starter/solr.tar.gz"
+  starter = "/mnt/efs/version/" + version + "/starter"
+  solr_src = find_archive(starter, "solr")
   dest= "/mnt/efs/" + tenant + "/solr"
-  my_tar = tarfile.open(solr_src)
-  my_tar.extractall(dest) 
-  my_tar.close() 
+  marker = os.path.join(dest, STARTER_MARKER)
+  done = starter_marker(marker, version)
+  if done:
+    print("Solr index of version " + version + " is already extracted")
+    return {'statusCode': 200, 'body': json.dumps(done)}
+  ### An earlier attempt may have stopped halfway through
+  clear_directory(dest)
+  if runtime.setting('shared_starter_assets', default=False, cast=bool):
+    stats = asset_store.populate('solr', version, solr_src, dest)
+  else:
+    stats = extract_archive(solr_src, dest)
+  write_starter_marker(marker, version, stats)
+  print("Extracted " + solr_src + ": " + stats.summary())
 
-  return {'statusCode': 200}
\ No newline at end of file
+  return {'statusCode': 200, 'body': json.dumps(stats.as_dict())}
@@ -4,7 +4,22 @@ Triggers jobs to create tenant and dependencies
 
 import os
 import json
-import boto3
+from common import provisioning
+from common import runtime
+from common.base_stack import resolve as resolve_base_stack
+from common.priority_allocator import PriorityAllocator, listener_priorities
+from common.secret_store import get_secrets
+from common.tenant_registry import TenantRegistry
+
+# Stacks whose creation failed and that can only be deleted
+FAILED_CREATE_STATES = ('CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED')
+# Stacks on their way to one of the above or to being gone; the stage is
+# retried by the state machine until they get there
+UNSETTLED_STATES = ('ROLLBACK_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'DELETE_FAILED')
+
+
+@runtime.instrumented
+@provisioning.stage('stack')
 def lambda_handler(event, context):
     """
       Parameters
@@ -17,14 +32,10 @@ def lambda_handler(event, context):
       API Gateway Lambda Proxy Output Format: dict
       """
 
-    from decouple import config  # pylint: disable=import-outside-toplevel
-
     print("Starting stack creation")
-    session = boto3.Session()
-    cf_client = session.client('cloudformation')
-    secrets_client = session.client('secretsmanager')
-    elb_client = session.client('elbv2')
-    lambda_client = session.client('lambda')
+    cf_client = runtime.client('cloudformation')
+    secrets_client = runtime.client('secretsmanager')
+    elb_client = runtime.client('elbv2')
     tenant_data = json.loads(event['body'])
     version = tenant_data['VERSION']
     tenant = tenant_data['TENANT'].lower()
@@ -36,14 +47,14 @@ def lambda_handler(event, context):
     brand = tenant_data['BRAND']
 
     #set vars for later use
-    s3_bucket = config('s3_bucket')
-    project = config('project')
-    snstopic = config('snstopic')
-    base_stack = config('base_stack')
-    cms_base_url = config('cms_base_url')
-    lrs_base_url = config('lrs_base_url')
-    firebase_key= config('firebase_key')
-    firebase_id = config('firebase_id')
+    s3_bucket = runtime.setting('s3_bucket')
+    project = runtime.setting('project')
+    snstopic = runtime.setting('snstopic')
+    base_stack = runtime.setting('base_stack')
+    cms_base_url = runtime.setting('cms_base_url')
+    lrs_base_url = runtime.setting('lrs_base_url')
+    firebase_key= runtime.setting('firebase_key')
+    firebase_id = runtime.setting('firebase_id')
 
     template_url = f'https://{s3_bucket}.s3.amazonaws.com/{version}/code/scripts/tenant.yml'
     lrs_host = f'{lrs_base_url}{tenant}/xapi/'
@@ -52,59 +63,48 @@ def lambda_handler(event, context):
     listener_name = 'PERLSAppLBListener443'
 
     ### Get info from secrets manager
-    db_password_secret = secrets_client.get_secret_value(
-        SecretId=f'{tenant}_db_password')
-    lrs_key_password_secret = secrets_client.get_secret_value(
-        SecretId=f'{tenant}_lrs_key_password')
-    smtp_password_secret = secrets_client.get_secret_value(
-        SecretId=f'{tenant}_smtp_password')
+    secrets = get_secrets(secrets_client, [f'{tenant}_db_password',
+                                           f'{tenant}_lrs_key_password',
+                                           f'{tenant}_smtp_password'])
+    db_password_secret = secrets[f'{tenant}_db_password']
+    lrs_key_password_secret = secrets[f'{tenant}_lrs_key_password']
+    smtp_password_secret = secrets[f'{tenant}_smtp_password']
 
     print("Copying starter content.")
     dirs=os.listdir('/mnt/efs/')
     print(dirs)
     dest = f"/mnt/efs/{tenant}"
-    os.mkdir(dest)
-    os.mkdir(dest + "/solr")
+    os.makedirs(dest + "/solr", exist_ok=True)
+    # The files and solr stages expand their starter content next, through
+    # EFS access points with POSIX uid and gid 1000 and 8983 respectively
 
-    # Run Lambda function to expand public/private files with efs ap where
-    # POSIX uid and gid set to 1000 so solr can access the dir
-    lambda_response = lambda_client.invoke(
-        FunctionName='create_files_directories',
-        InvocationType='Event',
-        LogType='Tail',
-        Payload=json.dumps(event)
-    )
+    ### A retried provisioning reuses the stack an earlier attempt created
+    registry = TenantRegistry()
+    try:
+        stack = cf_client.describe_stacks(StackName=tenant)['Stacks'][0]
+    except cf_client.exceptions.ClientError:
+        stack = None
+    status = stack['StackStatus'] if stack else None
+    if status in FAILED_CREATE_STATES or status == 'DELETE_FAILED':
+        print(f"Removing the {status} stack of {tenant} before creating it again")
+        cf_client.delete_stack(StackName=tenant)
+        # A failed create may have hit a priority the bitmap wrongly had as free
+        provisioning.ProvisioningLog().note(tenant, 'stack', drifted=True)
+        raise provisioning.StageNotReady(f'Stack {tenant} is being deleted')
+    if status in UNSETTLED_STATES:
+        raise provisioning.StageNotReady(f'Stack {tenant} is {status}')
+    if stack:
+        print(f"Stack {tenant} already exists and is {stack['StackStatus']}")
+        registry.lookup(tenant, cf_client)
+        return {'message': 'Stack already exists'}
 
-    # Run Lambda function to expand solr files with efs ap where
-    # POSIX uid and gid set to 8983 so solr can access the dir
-    print(lambda_response)
-    lambda_response = lambda_client.invoke(
-        FunctionName='create_solr_fs',
-        InvocationType='Event',
-        LogType='Tail',
-        Payload=json.dumps(event)
-    )
-    print(lambda_response)
-
-    #Get LB Listener and next priority number info
-    app_listener_info = cf_client.describe_stack_resource(
-        StackName=base_stack, LogicalResourceId=listener_name)
+    #Get LB listeners and the priority of the tenant's rules
     #TODO: Change listerner name for PERLS stack
-    app_listener_arn = app_listener_info['StackResourceDetail']['PhysicalResourceId']
-    listener_rules = elb_client.describe_rules(ListenerArn=app_listener_arn)
-    rules = listener_rules['Rules']
-    priority_int = 0
-    for rule in rules:
-        try:
-            rule_priority = int(rule['Priority'])
-            if rule_priority > priority_int:
-                priority_int = int(rule['Priority'])
-        except (TypeError, NameError, KeyError, ValueError) as ex:
-            print(f'An exception occurred setting rules: {ex}')
-            break
-
-    priority_int += 1
-    priority = str(priority_int)
+    listener_arn = resolve_base_stack(cf_client, base_stack).listener_arn(listener_name)
+    drifted = (provisioning.ProvisioningLog().get(tenant, 'stack') or {}).get('drifted', False)
+    priority = str(PriorityAllocator().allocate(
+        tenant, lambda: listener_priorities(elb_client, [listener_arn]), rebuild=drifted))
+    print(f'Listener rule priority of {tenant} is {priority}')
 
     ### Create Cloudformation tenant stack
     stack_creation_response = cf_client.create_stack(
@@ -199,11 +199,7 @@ def lambda_handler(event, context):
         ]
     )
     print(stack_creation_response)
-    lambda_response = lambda_client.invoke(
-      FunctionName='admin_function',
-      InvocationType='Event',
-      LogType='Tail',
-      Payload=json.dumps(event)
-    )
-    print(lambda_response)
+    registry.register(tenant, version=version, brand=brand, address=address,
+                      stack_status='CREATE_IN_PROGRESS',
+                      stack_id=stack_creation_response['StackId'])
     return {'message': 'Stack creation successful'}
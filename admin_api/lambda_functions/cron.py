@@ -1,23 +1,84 @@
+import time
+import requests
+from common import runtime
+from common.cron_dispatch import cron_url, dispatch, key_rejected
+from common.secret_store import cache_stats, get_secrets, invalidate, secret_string
+from common.tenant_registry import TenantRegistry
+
+
+@runtime.instrumented
 def lambda_handler(event, context):
-    import requests
-    import boto3
-
-    session = boto3.Session()
-    secrets_client = session.client('secretsmanager')
-    cf_client = session.client('cloudformation')
-    tenant = event['tenant']
-    cron_key_secret = secrets_client.get_secret_value(SecretId=tenant + "_cron_key")
-    cron_key = cron_key_secret['SecretString']
-    
-    tenant_stack_info = cf_client.describe_stacks(StackName=tenant)
-    env_vars = tenant_stack_info['Stacks'][0]['Parameters']
-    for var in env_vars:
-      if var['ParameterKey'] == 'ADDRESS':
-        address = var['ParameterValue']
-        full_address = "https://" + address + "/cron/" + cron_key
-    cron_response = requests.get(full_address) 
-    try:
-        cron_response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        return "Error: " + str(e)   
-    return
+    """
+    Runs Drupal cron for the tenant in ``event['tenant']``, or for every
+    tenant with a settled stack when no tenant is given.
+
+    Parameters
+    ----------
+    event: dict, required
+        ``{"tenant": name}`` from the tenant's schedule, or ``{}`` from the
+        fleet-wide schedule
+
+    Returns
+    ------
+    None or an error string for one tenant; for the fleet, a dict with
+    the status and latency of every tenant's cron request
+    """
+    secrets_client = runtime.client('secretsmanager')
+    cf_client = runtime.client('cloudformation')
+    registry = TenantRegistry()
+    timeout = runtime.setting('cron_timeout', 30, float)
+
+    if event.get('tenant'):
+        tenant = event['tenant']
+        address = registry.lookup(tenant, cf_client)['address']
+        cron_key = secret_string(secrets_client, tenant + "_cron_key")
+        cron_response = runtime.http().get(cron_url(address, cron_key), timeout=timeout)
+        if key_rejected(cron_response.status_code):
+            # The cached key may predate a recreated tenant
+            invalidate(tenant + "_cron_key")
+            cron_key = secret_string(secrets_client, tenant + "_cron_key")
+            cron_response = runtime.http().get(cron_url(address, cron_key), timeout=timeout)
+        try:
+            cron_response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            return "Error: " + str(e)
+        return
+
+    start = time.monotonic()
+    records = {record['name']: record for record in registry.tenants()
+               if record.get('stack_status', '').endswith('_COMPLETE')
+               and 'ROLLBACK' not in record['stack_status']}
+
+    cron_keys = get_secrets(secrets_client, [name + "_cron_key" for name in records],
+                            missing_ok=True)
+
+    def resolve_url(tenant):
+        cron_key = cron_keys[tenant + "_cron_key"]['SecretString']
+        return cron_url(records[tenant]['address'], cron_key)
+
+    workers = runtime.setting('cron_workers', 16, int)
+    results = dispatch(sorted(records), resolve_url,
+                       workers=workers,
+                       timeout=timeout,
+                       jitter=runtime.setting('cron_jitter', 5, float),
+                       session=runtime.http())
+
+    ### Keys cached before a tenant was recreated are read again and retried
+    rejected = [result.tenant for result in results if key_rejected(result.status)]
+    if rejected:
+        for tenant in rejected:
+            invalidate(tenant + "_cron_key")
+        cron_keys.update(get_secrets(secrets_client, [name + "_cron_key" for name in rejected],
+                                     missing_ok=True))
+        retried = {result.tenant: result
+                   for result in dispatch(rejected, resolve_url, workers=workers,
+                                          timeout=timeout, jitter=0, session=runtime.http())}
+        results = [retried.get(result.tenant, result) for result in results]
+    failed = [result.tenant for result in results if result.error is not None]
+    print(f'Ran cron for {len(results)} tenants in {time.monotonic() - start:.1f}s, '
+          f'{len(failed)} failed: {failed}, secret cache: {cache_stats()}')
+    return {
+        'tenants': len(results),
+        'failed': len(failed),
+        'results': [result.as_dict() for result in results]
+    }
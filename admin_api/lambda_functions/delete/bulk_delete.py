@@ -0,0 +1,294 @@
+"""Deletes many tenants in one pass
+
+POST /bulk-delete with ``{"tenants": [...]}`` or a ``selector`` over the
+tenant registry starts a job and GET /bulk-delete/{job} reports it. The
+job runs in chunks of at most ``CHUNK_SIZE`` tenants, each in its own
+asynchronous invocation of this function with ``{"action": "run",
+"job_id": ...}`` that starts the next one. A chunk holds a lease on the
+job for longer than the function may run; a one minute schedule invokes
+the function with ``{"action": "tick"}`` to carry on with jobs whose
+chain broke and to fail the tenants of a chunk that timed out.
+
+Where DELETE /tenant/{tenant} spends its own LRS lookup, RDS connection
+and Secrets Manager calls on every tenant, each chunk reads the LRS
+listing at most once, for the tenants without a stored LRS id, drops
+every database on one admin connection, deletes all the secrets from one
+pool of threads and moves every EFS directory to the trash, which a
+single purge then empties several trees at a time.
+"""
+
+import json
+import time
+
+import mysql.connector
+
+from common import runtime
+from common import secret_store
+from common import teardown
+from common.fleet_jobs import (FAILED, JOB_RUNNING, PENDING, RUNNING, SUCCEEDED, JobStore,
+                               finish_task, new_job, progress)
+from common.lrs_client import LRSClient
+from common.priority_allocator import PriorityAllocator
+from common.provisioning import ProvisioningLog
+from common.record_store import ConflictError
+from common.tenant_registry import TenantRegistry, now
+
+KIND = 'delete'
+# Keeps a job record below the 400 KB DynamoDB item size limit
+MAX_TENANTS = 500
+# Tenants deleted by one invocation, so the serial database drops fit its timeout
+CHUNK_SIZE = 50
+# Longer than the 900 s function timeout
+CHUNK_LEASE = 960
+SELECTOR_FIELDS = ('prefix', 'brand', 'version', 'stack_status', 'created_before')
+
+
+def _response(status_code, body):
+    return {"statusCode": status_code, "body": json.dumps(body)}
+
+
+def matches(record, selector):
+    """Whether a registry record fits every field of ``selector``"""
+    if 'prefix' in selector and not record['name'].startswith(selector['prefix']):
+        return False
+    if 'created_before' in selector and record.get('created_at', '') >= selector['created_before']:
+        return False
+    return all(record.get(field) == selector[field]
+               for field in ('brand', 'version', 'stack_status') if field in selector)
+
+
+def select_tenants(records, names=None, selector=None):
+    """Picks the tenants to delete from registry records
+
+    Returns
+    ------
+    tuple of (list of tenant records, dict of skipped tenant to reason)
+    """
+    if names:
+        wanted = {name.lower() for name in names}
+        known = {record['name']: record for record in records if record['name'] in wanted}
+        return ([known[name] for name in sorted(known)],
+                {name: 'Unknown tenant' for name in sorted(wanted - set(known))})
+    if not selector:
+        raise ValueError("Give tenants or a selector")
+    unknown = set(selector) - set(SELECTOR_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown selector fields {sorted(unknown)}")
+    return [record for record in records if matches(record, selector)], {}
+
+
+def create_job(body):
+    """Validates a bulk delete request and builds its job"""
+    registry = TenantRegistry()
+    records = registry.tenants()
+    names = body.get('tenants')
+    if names:
+        # Tenants from before the registry are still found by their stack
+        cf_client = runtime.client('cloudformation')
+        known = {record['name'] for record in records}
+        for name in {name.lower() for name in names} - known:
+            try:
+                records.append(registry.lookup(name, cf_client))
+            except KeyError:
+                continue
+    targets, skipped = select_tenants(records, names, body.get('selector'))
+    if not targets:
+        raise ValueError("No tenant matches")
+    if len(targets) > MAX_TENANTS:
+        raise ValueError(f"{len(targets)} tenants match, at most {MAX_TENANTS} are deleted at once")
+    return new_job(KIND, [record['name'] for record in targets],
+                   {'brands': {record['name']: record.get('brand') for record in targets}},
+                   concurrency=len(targets), skipped=skipped)
+
+
+def teardown_tenants(tenants, brands):
+    """Deletes the resources of every tenant, one batch per kind of resource
+
+    Returns
+    ------
+    tuple of (dict of tenant to a dict of resource name to StepResult,
+    dict of resource name to the seconds its batch took)
+    """
+    cf_client = runtime.client('cloudformation')
+    secrets_client = runtime.client('secretsmanager')
+    lrs = LRSClient(runtime.setting('lrs_url'), runtime.setting('lrs_api_key'))
+
+    def delete_lrs(targets):
+        # Ids stored at provisioning; one paged listing finds the others
+        log = ProvisioningLog()
+        stored = {tenant: (log.get(tenant, 'lrs') or {}).get('lrs_id') for tenant in targets}
+        unknown = [tenant for tenant in targets if not stored[tenant]]
+        index = teardown.lrs_index(lrs, unknown) if unknown else {}
+
+        def delete(tenant):
+            if stored[tenant]:
+                return teardown.delete_tenant_lrs(lrs, tenant, stored[tenant])
+            return teardown.delete_lrs(lrs, index.get(tenant))
+
+        return teardown.run_each('lrs', targets, delete)
+
+    def delete_secrets(targets):
+        return teardown.run_each('secrets', targets, lambda tenant: teardown.delete_secrets(
+            secrets_client, teardown.secret_names(tenant), workers=1))
+
+    def drop_databases(targets):
+        def drop(tenant):
+            if not brands.get(tenant):
+                # The database may well exist, so the tenant must not look deleted
+                raise ValueError('Brand unknown, no database name')
+            return teardown.drop_database(connection, tenant, tenant + "_" + brands[tenant])
+
+        rds_info = json.loads(secret_store.secret_string(secrets_client, 'rds_admin_login'))
+        connection = mysql.connector.connect(
+            host=rds_info['host'],
+            user=rds_info['username'],
+            password=rds_info['password']
+        )
+        try:
+            return teardown.run_each('database', targets, drop, workers=1)
+        finally:
+            connection.close()
+
+    def delete_stacks(targets):
+        results = teardown.run_each(
+            'stack', targets, lambda tenant: teardown.delete_stack(cf_client, tenant))
+        # One conditional write gives every priority back
+        PriorityAllocator().release(*[tenant for tenant in targets
+                                      if results[tenant].status != teardown.FAILED])
+        return results
+
+    return teardown.run_batches(tenants, {
+        'lrs': delete_lrs,
+        'secrets': delete_secrets,
+        'efs': lambda targets: teardown.run_each('efs', targets, teardown.move_to_trash),
+        'stack': delete_stacks,
+        'database': drop_databases,
+    })
+
+
+def _fail_abandoned(job, registry):
+    # Tenants still running once the lease is over were left by an
+    # invocation that timed out; their records stay for another delete
+    for tenant in job['order']:
+        if job['tasks'][tenant]['state'] == RUNNING:
+            if registry.get(tenant) is not None:
+                registry.update(tenant, teardown_failed=['timeout'])
+            finish_task(job, tenant, FAILED, 'The deleting invocation timed out')
+
+
+def run_job(store, job_id, clock=time.time):
+    """Deletes the next chunk of the tenants of a job and records each outcome"""
+    job = store.get(job_id)
+    if job is None or job['status'] != JOB_RUNNING:
+        return job
+    if job.get('lease_until', 0) > clock():
+        # Another invocation is deleting a chunk
+        return job
+    registry = TenantRegistry()
+    _fail_abandoned(job, registry)
+    tenants = [target for target in job['order']
+               if job['tasks'][target]['state'] == PENDING][:CHUNK_SIZE]
+    # A redelivered invocation finds the lease taken and leaves the chunk alone
+    for tenant in tenants:
+        job['tasks'][tenant].update(state=RUNNING, started_at=now())
+    job['lease_until'] = clock() + CHUNK_LEASE if tenants else 0
+    try:
+        job = store.save(job)
+    except ConflictError:
+        return store.get(job_id)
+    if not tenants:
+        return job
+
+    results, seconds = teardown_tenants(tenants, job['params']['brands'])
+    log = ProvisioningLog()
+    for tenant in tenants:
+        summary = teardown.report(results[tenant])
+        resources = {resource: {'status': result.status, 'seconds': round(result.seconds, 3)}
+                     for resource, result in results[tenant].items()}
+        secret_store.invalidate(tenant + "_cron_key")
+        if summary['failed']:
+            ### Keep the record so the tenant can be deleted again
+            if registry.get(tenant) is not None:
+                registry.update(tenant, teardown_failed=summary['failed'])
+            error = '; '.join(f"{resource}: {results[tenant][resource].error}"
+                              for resource in summary['failed'])
+            finish_task(job, tenant, FAILED, error, resources=resources)
+        else:
+            registry.remove(tenant)
+            log.forget(tenant)
+            finish_task(job, tenant, SUCCEEDED, resources=resources)
+    job['seconds'] = {resource: round(job.get('seconds', {}).get(resource, 0) + spent, 3)
+                      for resource, spent in seconds.items()}
+    job['lease_until'] = 0
+    print(json.dumps({'job_id': job_id, 'seconds': seconds,
+                      'tenants': {tenant: teardown.report(results[tenant])
+                                  for tenant in tenants}}))
+
+    if any(results[tenant]['efs'].status == teardown.DELETED for tenant in tenants):
+        runtime.client('lambda').invoke(
+            FunctionName='delete_tenant',
+            InvocationType='Event',
+            Payload=json.dumps({'action': 'purge'})
+        )
+    job = store.save(job)
+    if job['status'] == JOB_RUNNING:
+        start_chunk(job_id)
+    return job
+
+
+def start_chunk(job_id):
+    """Deletes the next chunk of a job in a new invocation"""
+    runtime.client('lambda').invoke(
+        FunctionName='bulk_delete',
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'run', 'job_id': job_id})
+    )
+
+
+@runtime.instrumented
+def lambda_handler(event, context):
+    """
+    Parameters
+    ----------
+    event: dict, required
+        API Gateway Lambda Proxy Input Format, ``{"action": "run",
+        "job_id": ...}`` for the next chunk of a job, or ``{"action":
+        "tick"}`` from the schedule
+
+    Returns
+    ------
+    API Gateway Lambda Proxy Output Format: dict
+    """
+
+    store = JobStore()
+    if event.get('action') == 'run':
+        job = run_job(store, event['job_id'])
+        return progress(job) if job else None
+    if event.get('action') == 'tick':
+        jobs = [run_job(store, job['job_id']) for job in store.active(KIND)]
+        return {'jobs': [progress(job) for job in jobs if job]}
+
+    method = event.get('httpMethod')
+    if method == 'POST':
+        try:
+            body = json.loads(event.get('body') or '{}')
+        except ValueError:
+            return _response(400, {"message": "Body is not valid JSON"})
+        try:
+            job = create_job(body)
+        except ValueError as ex:
+            return _response(400, {"message": str(ex)})
+        store.create(job)
+        print(f"Started bulk delete {job['job_id']} of {len(job['order'])} tenants")
+        start_chunk(job['job_id'])
+        return _response(202, progress(job))
+
+    job = store.get((event.get('pathParameters') or {}).get('job'))
+    if job is None or job.get('kind') != KIND:
+        return _response(404, {"message": "Job does not exist"})
+    body = progress(job)
+    body['tenants'] = {target: job['tasks'][target].get('resources')
+                       for target in job['order']}
+    if job.get('seconds'):
+        body['seconds'] = job['seconds']
+    return _response(200, body)
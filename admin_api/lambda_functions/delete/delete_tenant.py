@@ -1,63 +1,104 @@
+import json
+import time
+import mysql.connector
+from common import asset_store
+from common import runtime
+from common import secret_store
+from common import teardown
+from common.lrs_client import LRSClient
+from common.priority_allocator import PriorityAllocator
+from common.provisioning import ProvisioningLog
+from common.tenant_registry import TenantRegistry
+
+# Seconds of an invocation kept free after a purge pass
+PURGE_MARGIN = 30
+
+
+def purge(context):
+  """Empties the EFS trash, handing what is left to a fresh invocation"""
+  deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - PURGE_MARGIN
+  purged, complete = teardown.purge_trash(deadline=deadline)
+  print(json.dumps({'purged': purged, 'complete': complete}))
+  if not complete:
+    runtime.client('lambda').invoke(
+        FunctionName='delete_tenant',
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'purge'})
+    )
+    return { "statusCode": 202 }
+
+  # Starter objects lose a link with every removed tenant; the store is
+  # scanned at most once per asset_store.PRUNE_INTERVAL
+  for namespace in ('public', 'solr'):
+    try:
+      pruned = asset_store.maybe_prune(namespace)
+      if pruned is not None:
+        print("Pruned " + str(pruned) + " unreferenced " + namespace + " starter objects")
+    except OSError as e:
+      print("[WARN] Could not prune " + namespace + " starter objects: " + str(e))
+  return { "statusCode": 200 }
+
+
+@runtime.instrumented
 def lambda_handler(event, context):
-  import shutil
-  import requests
-  import boto3
-  import json
-  from decouple import config
-  import mysql.connector
-
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
-  secrets_client = session.client('secretsmanager')
-  rds_secret = secrets_client.get_secret_value(SecretId='rds_admin_login')
-  rds_info = json.loads(rds_secret['SecretString'])
-  rds_user = rds_info['username']
-  rds_password = rds_info['password']
-  rds_host = rds_info['host']
-  lrs_api_key = config('lrs_api_key')
-  lrs_url = config('lrs_url')
+  if event.get('action') == 'purge':
+    return purge(context)
+
+  cf_client = runtime.client('cloudformation')
+  secrets_client = runtime.client('secretsmanager')
+  lrs = LRSClient(runtime.setting('lrs_url'), runtime.setting('lrs_api_key'))
+  rds_info = json.loads(secret_store.secret_string(secrets_client, 'rds_admin_login'))
   path_parameters = event['pathParameters']
   tenant = path_parameters['tenant'].lower()
 
-  get_lrs = requests.get(lrs_url + 'lrs?limit=0', headers = {"Content-Type": "application/json", "x-veracity-api-key": lrs_api_key })
-  lrs_info = get_lrs.json()
-  for lrs in lrs_info:
-    if lrs['lrsName'] == tenant:
-      lrs_id = lrs['_id']
-      requests.delete(lrs_url + 'lrs/' + lrs_id, headers = {"Content-Type": "application/json", "x-veracity-api-key": lrs_api_key })
-
-  stack = cf_client.describe_stacks(StackName=tenant)
-
-  secrets_client.delete_secret(SecretId=tenant + "_db_password")
-  secrets_client.delete_secret(SecretId=tenant + "_user_password")
-  secrets_client.delete_secret(SecretId=tenant + "_lrs_key_password")
-  secrets_client.delete_secret(SecretId=tenant + "_cron_key")
-  secrets_client.delete_secret(SecretId=tenant + "_smtp_password")
-
-  # Remove files in EFS
-  if(not (tenant and not tenant.isspace())):
-    print('Tenant is empty. Please remove files from EFS.')
-  else:
-    dest = "/mnt/efs/" + tenant
-    shutil.rmtree(dest)
-
-  parameters = stack['Stacks'][0]['Parameters']
-  for parameter in parameters:
-    if 'BRAND' in parameter['ParameterKey']:
-        brand = parameter['ParameterValue']
-        db_name = tenant + "_" + brand
-
-  cf_client.delete_stack(StackName=tenant)
-
-  mydb = mysql.connector.connect(
-    host=rds_host,
-    user=rds_user,
-    password=rds_password
-  )
-  mycursor = mydb.cursor()
-  mycursor.execute("DROP DATABASE {}".format(db_name))
-  mycursor.execute("DROP USER {}@'10.0.0.0/255.255.0.0'".format(tenant))
-  mycursor.close()
-  mydb.close()
+  registry = TenantRegistry()
+  try:
+    brand = registry.lookup(tenant, cf_client)['brand']
+  except KeyError:
+    brand = None
 
-  return { "statusCode": 200 }
+  def delete_lrs():
+    stage = ProvisioningLog().get(tenant, 'lrs') or {}
+    return teardown.delete_tenant_lrs(lrs, tenant, stage.get('lrs_id'))
+
+  def drop_database():
+    if brand is None:
+      raise teardown.Missing('Brand unknown, no database name')
+    connection = mysql.connector.connect(
+      host=rds_info['host'],
+      user=rds_info['username'],
+      password=rds_info['password']
+    )
+    try:
+      return teardown.drop_database(connection, tenant, tenant + "_" + brand)
+    finally:
+      connection.close()
+
+  ### Every resource is deleted concurrently; one failing does not stop the others
+  results = teardown.run_steps({
+    'lrs': delete_lrs,
+    'secrets': lambda: teardown.delete_secrets(secrets_client, teardown.secret_names(tenant)),
+    'efs': lambda: teardown.move_to_trash(tenant),
+    'stack': lambda: teardown.delete_stack(cf_client, tenant, PriorityAllocator()),
+    'database': drop_database,
+  })
+  secret_store.invalidate(tenant + "_cron_key")
+  summary = teardown.report(results)
+  print(json.dumps(dict(summary, tenant=tenant)))
+
+  if results['efs'].status == teardown.DELETED:
+    runtime.client('lambda').invoke(
+        FunctionName='delete_tenant',
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'purge'})
+    )
+
+  if summary['failed']:
+    ### Keep the record so the delete can be retried
+    if registry.get(tenant) is not None:
+      registry.update(tenant, teardown_failed=summary['failed'])
+    return { "statusCode": 500, "body": json.dumps(summary) }
+
+  registry.remove(tenant)
+  ProvisioningLog().forget(tenant)
+  return { "statusCode": 200, "body": json.dumps(summary) }
@@ -1,21 +1,24 @@
-def lambda_handler(event, context):
-  import boto3
-  import json
+import json
+from common import runtime
+from common.tenant_registry import TenantRegistry
+
 
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
-  lambda_client = session.client('lambda')
+@runtime.instrumented
+def lambda_handler(event, context):
+  cf_client = runtime.client('cloudformation')
+  lambda_client = runtime.client('lambda')
   path_parameters = event['pathParameters']
   tenant = path_parameters['tenant'].lower()
 
-  ###check if tenant exists
+  ###check if tenant exists; a failed delete may have removed the stack already
   try:
     cf_client.describe_stack_resources(StackName=tenant)
   except:
-    return {
-      "statusCode": 404,
-      "body": "Tenant does not exist"
-    }
+    if TenantRegistry().get(tenant) is None:
+      return {
+        "statusCode": 404,
+        "body": "Tenant does not exist"
+      }
   us_response = lambda_client.invoke(
       FunctionName='delete_tenant',
       InvocationType='Event',
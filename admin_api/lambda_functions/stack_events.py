@@ -0,0 +1,76 @@
+"""Follows the CloudFormation status of tenant stacks
+
+EventBridge delivers every status change of a tenant stack here, so the
+tenant registry holds the current status without polling CloudFormation.
+A settled stack whose tenant has a pending CMS deploy gets it started,
+and a scheduled sweep settles what a missed event left behind.
+"""
+
+from common import runtime
+from common.tenant_deploy import is_terminal, settle, sweep
+from common.tenant_registry import TenantRegistry, record_from_stack
+
+
+def stack_name(stack_id):
+    """Stack name from a stack ARN (``arn:...:stack/<name>/<uuid>``)"""
+    return stack_id.split(':stack/', 1)[-1].split('/', 1)[0]
+
+
+def _clients():
+    return {
+        'cloudformation': runtime.client('cloudformation'),
+        'ecs': runtime.client('ecs'),
+        'lambda': runtime.client('lambda'),
+        'secretsmanager': runtime.client('secretsmanager'),
+    }
+
+
+@runtime.instrumented
+def lambda_handler(event, context):
+    """
+    Keeps tenant stack statuses in the registry current and starts the
+    pending CMS deploy of a tenant once its stack has settled.
+
+    Parameters
+    ----------
+    event: dict, required
+        EventBridge ``CloudFormation Stack Status Change`` event, or
+        ``{"action": "sweep"}`` from the schedule that catches missed
+        events and stuck stacks
+
+    Returns
+    ------
+    dict: what was done for each tenant
+    """
+    registry = TenantRegistry()
+    base_stack = runtime.setting('base_stack')
+
+    if event.get('action') == 'sweep':
+        timeout = runtime.setting('stack_timeout', 5400, int)
+        outcomes = sweep(registry, _clients(), base_stack, timeout)
+        print(f'Swept {len(outcomes)} pending deploys: {outcomes}')
+        return outcomes
+
+    detail = event['detail']
+    tenant = stack_name(detail['stack-id'])
+    status = detail['status-details']['status']
+    record = registry.get(tenant)
+    if record is None:
+        # Base stacks and other stacks in the account are not tenants
+        return {}
+    if event.get('time', '') < record.get('status_time', ''):
+        print(f'Ignoring {status} of {tenant} from {event["time"]}, already have a later status')
+        return {}
+
+    fields = {'stack_status': status, 'status_time': event.get('time', '')}
+    if is_terminal(status) and 'ROLLBACK' in status:
+        # A rollback also restores the previous VERSION parameter
+        stack = runtime.client('cloudformation').describe_stacks(StackName=tenant)['Stacks'][0]
+        fields['version'] = (record_from_stack(stack) or record).get('version')
+    record = registry.update(tenant, **fields)
+
+    outcome = 'waiting'
+    if is_terminal(status):
+        outcome = settle(registry, record, status, _clients(), base_stack)
+    print(f'{tenant} is {status}: {outcome}')
+    return {tenant: outcome}
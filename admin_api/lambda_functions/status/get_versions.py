@@ -1,19 +1,26 @@
+import json
+from common import runtime
+from common.version_catalog import VersionCatalog, changed_versions
+
+
+@runtime.instrumented
 def lambda_handler(event, context):
+  catalog = VersionCatalog()
 
-  from decouple import config
-  import json
-  import boto3
+  ### S3 upload and delete events of the release bucket refresh the catalog
+  if event.get('source') == 'aws.s3' or 'Records' in event:
+    versions = changed_versions(event)
+    catalog.refresh(versions)
+    print("Refreshed versions " + ", ".join(versions))
+    return {"refreshed": versions}
 
-  session = boto3.Session()
-  s3_client = session.client('s3')
-  s3_bucket = config('s3_bucket')
-  versions = s3_client.list_objects_v2(Bucket=s3_bucket, Delimiter='/')['CommonPrefixes']
-  version_list=[]
-  for v in versions:
-    version = v.get('Prefix')
-    version_list.append(version.strip('/'))
-  response = {"versions": version_list}
+  records = catalog.versions()
+  names = sorted(records)
+  if (event.get('queryStringParameters') or {}).get('details') == 'true':
+    response = {"versions": [records[name] for name in names]}
+  else:
+    response = {"versions": names}
   return {
     "statusCode": 200,
     "body": json.dumps(response)
-  }
\ No newline at end of file
+  }
@@ -1,32 +1,98 @@
+"""Lists tenants with their stack status and CMS version
+
+The tenant index is read from the tenant registry and kept for a short
+time, so dashboards polling the endpoint do not scan the registry on
+every request. Until ``tenant_registry_complete`` is set, stacks created
+before the registry existed are backfilled from describe_stacks.
+
+Query parameters: ``status``, ``version``, ``limit`` and ``cursor``.
+"""
+
+import base64
+import json
+from decouple import config
+from common import runtime
+from common.cache import TTLCache
+from common.tenant_registry import TenantRegistry
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+_tenant_index = TTLCache(ttl=config('tenant_list_ttl', default=30, cast=int), maxsize=1)
+
+
+def build_tenant_index(registry, cf_client):
+    """Returns every tenant as a compact dict, sorted by name"""
+    if config('tenant_registry_complete', default=False, cast=bool):
+        records = registry.tenants()
+    else:
+        records = registry.backfill(cf_client)
+    return [{"name": record['name'], "status": record['stack_status'],
+             "version": record['version']} for record in records]
+
+
+def encode_cursor(name):
+    """Opaque cursor pointing after tenant ``name``"""
+    return base64.urlsafe_b64encode(name.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Tenant name a cursor points after"""
+    return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+
+
+def select_tenants(tenants, status=None, version=None, limit=DEFAULT_LIMIT, after=None):
+    """Filters and pages the tenant index
+
+    Returns
+    ------
+    tuple of (page of tenants, name of the last tenant or None when done)
+    """
+    statuses = {value.strip().upper() for value in status.split(',')} if status else None
+    page = []
+    for tenant in tenants:
+        if after is not None and tenant['name'] <= after:
+            continue
+        if statuses and tenant['status'] not in statuses:
+            continue
+        if version and tenant['version'] != version:
+            continue
+        if len(page) == limit:
+            return page, page[-1]['name']
+        page.append(tenant)
+    return page, None
+
+
+@runtime.instrumented
 def lambda_handler(event, context):
-  import boto3
-  import json
-  from dateutil.tz import tzutc
-
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
-  stacks = cf_client.describe_stacks()['Stacks']
-  response = []
-  for stack in stacks:
-    try:    
-      if stack['Tags'][0]['Key'] == 'Tenant':
-        tenant = stack['Tags'][0]['Value']
-        stack_status = stack['StackStatus']
-    except:
-      continue
-    parameters = stack['Parameters']
-    for parameter in parameters:
-      if 'VERSION' in parameter['ParameterKey']:
-        version = parameter['ParameterValue']
-
-    tenant_status = {
-      "name": tenant,
-      "status": stack_status,
-      "version": version
+    """
+    Parameters
+    ----------
+    event: dict, required
+        API Gateway Lambda Proxy Input Format
+
+    Returns
+    ------
+    API Gateway Lambda Proxy Output Format: dict
+    """
+
+    query = event.get('queryStringParameters') or {}
+    try:
+        limit = min(max(int(query.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT)
+        after = decode_cursor(query['cursor']) if query.get('cursor') else None
+    except ValueError:
+        return {"statusCode": 400, "body": "Invalid limit or cursor"}
+
+    tenants = _tenant_index.get('tenants')
+    if tenants is None:
+        tenants = build_tenant_index(TenantRegistry(), runtime.client('cloudformation'))
+        _tenant_index.set('tenants', tenants)
+
+    page, last = select_tenants(tenants, query.get('status'), query.get('version'), limit, after)
+    response_body = {"tenants": page}
+    if last is not None:
+        response_body["cursor"] = encode_cursor(last)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(response_body, separators=(',', ':'))
     }
-    response.append(tenant_status)
-    response_body={"tenants": response}
-  return {
-    "statusCode": 200,
-    "body": json.dumps(response_body)
-  }
\ No newline at end of file
@@ -1,30 +1,33 @@
-def lambda_handler(event, context):
-  import boto3
-  import json
-  from decouple import config
-  from dateutil.tz import tzutc
+import json
+from common import runtime
+from common.provisioning import PIPELINE, ProvisioningLog, critical_path
+from common.tenant_registry import TenantRegistry
+
 
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
+@runtime.instrumented
+def lambda_handler(event, context):
+  cf_client = runtime.client('cloudformation')
   pathParameters = event['pathParameters']
   tenant = pathParameters['tenant'].lower()
   try:
-    stack = cf_client.describe_stacks(StackName=tenant)
-  except:
+    registry = TenantRegistry()
+    record = registry.refresh_status(registry.lookup(tenant, cf_client), cf_client)
+  except KeyError:
     raise Exception("The tenant " + tenant + " does not exist.")
 
-  parameters = stack['Stacks'][0]['Parameters']
-  for parameter in parameters:
-    if 'VERSION' in parameter['ParameterKey']:
-      version = parameter['ParameterValue']
-
-  stack_status = stack['Stacks'][0]['StackStatus']
-
   response_body = {
     "name": tenant,
-    "status": stack_status,
-    "version": version
+    "status": record['stack_status'],
+    "version": record['version']
   }
+  stages = ProvisioningLog().stages(tenant)
+  if stages:
+    response_body["provisioning"] = {
+      name: {key: stage.get(key) for key in ('status', 'started_at', 'seconds', 'error')}
+      for name, stage in stages.items()
+    }
+    path, seconds = critical_path(PIPELINE, {name: stage.get('seconds') for name, stage in stages.items()})
+    response_body["critical_path"] = {"stages": path, "seconds": seconds}
 
   return {
     "statusCode": 200,
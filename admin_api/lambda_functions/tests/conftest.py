@@ -0,0 +1,21 @@
+"""Shared fixtures of the Lambda function tests
+
+The tests import the functions the way Lambda does, from the
+``lambda_functions`` directory, and keep every record table in a
+throwaway SQLite file instead of DynamoDB.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def record_store(tmp_path, monkeypatch):
+    """Points the record tables at a SQLite file of this test"""
+    monkeypatch.setenv('record_store', f'sqlite://{tmp_path}/records.db')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    return tmp_path / 'records.db'
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from common import asset_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_store, 'STORE_ROOT', str(tmp_path / 'store'))
+    monkeypatch.setattr(asset_store, '_manifests', {})
+    return tmp_path
+
+
+def starter(root, files):
+    for relative, content in files.items():
+        path = root / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+        path.chmod(0o644)
+    return str(root)
+
+
+def test_public_files_are_private_copies(store):
+    source = starter(store / 'starter', {'styles/site.css': 'body {}'})
+    for tenant in ('acme', 'globex'):
+        asset_store.populate('public', '1.0', source, str(store / tenant))
+    copy = store / 'acme' / 'styles' / 'site.css'
+    assert os.stat(copy).st_nlink == 1
+    copy.write_text('changed')
+    assert (store / 'globex' / 'styles' / 'site.css').read_text() == 'body {}'
+
+
+def test_solr_index_files_are_linked(store):
+    source = starter(store / 'starter', {'data/index/_0.cfs': 'segment',
+                                         'conf/managed-schema': 'schema'})
+    asset_store.populate('solr', '1.0', source, str(store / 'acme'))
+    assert os.stat(store / 'acme' / 'data' / 'index' / '_0.cfs').st_nlink == 2
+    config = store / 'acme' / 'conf' / 'managed-schema'
+    assert os.stat(config).st_nlink == 1
+    config.write_text('edited')
+
+
+@pytest.mark.parametrize('namespace, relative, expected', [
+    ('solr', 'data/index/segments_1', True),
+    ('solr', 'data/index.20240101/_0.si', True),
+    ('solr', 'conf/solrconfig.xml', False),
+    ('solr', 'index', False),
+    ('public', 'index/page.html', False),
+])
+def test_is_write_once(namespace, relative, expected):
+    assert asset_store.is_write_once(namespace, relative) is expected
@@ -0,0 +1,76 @@
+import pytest
+
+import cron
+from common import runtime, secret_store
+from common.tenant_registry import TenantRegistry
+
+
+class FakeSecrets:
+    def __init__(self, keys):
+        self.keys = keys
+        self.reads = 0
+
+    def get_secret_value(self, SecretId):  # pylint: disable=invalid-name
+        self.reads += 1
+        return {'ARN': SecretId, 'Name': SecretId, 'SecretString': self.keys[SecretId]}
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise cron.requests.exceptions.HTTPError(str(self.status_code))
+
+
+class FakeSite:
+    def __init__(self, keys):
+        self.keys = keys
+        self.requests = []
+
+    def get(self, url, timeout):
+        self.requests.append(url)
+        address, key = url[len('https://'):].split('/cron/')
+        return FakeResponse(200 if self.keys[address] == key else 403)
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    secrets = FakeSecrets({'acme_cron_key': 'old', 'globex_cron_key': 'g'})
+    site = FakeSite({'acme.example.com': 'old', 'globex.example.com': 'g'})
+    monkeypatch.setattr(secret_store, '_batch_supported', False)
+    monkeypatch.setattr(runtime, 'client', lambda service: secrets)
+    monkeypatch.setattr(runtime, 'http', lambda: site)
+    monkeypatch.setenv('cron_jitter', '0')
+    secret_store.invalidate()
+    registry = TenantRegistry()
+    for name in ('acme', 'globex'):
+        registry.register(name, address=f'{name}.example.com', stack_status='CREATE_COMPLETE')
+    return secrets, site
+
+
+def recreate_acme(secrets, site):
+    # The tenant was deleted and created again with a new key
+    secrets.keys['acme_cron_key'] = 'new'
+    site.keys['acme.example.com'] = 'new'
+
+
+def test_rejected_key_is_read_again(fleet):
+    secrets, site = fleet
+    assert cron.lambda_handler({'tenant': 'acme'}, None) is None
+    recreate_acme(secrets, site)
+    assert cron.lambda_handler({'tenant': 'acme'}, None) is None
+    assert site.requests[-2:] == ['https://acme.example.com/cron/old',
+                                  'https://acme.example.com/cron/new']
+
+
+def test_fleet_retries_rejected_keys(fleet):
+    secrets, site = fleet
+    cron.lambda_handler({}, None)
+    recreate_acme(secrets, site)
+    reads = secrets.reads
+    outcome = cron.lambda_handler({}, None)
+    assert outcome['failed'] == 0
+    assert [result['status'] for result in outcome['results']] == [200, 200]
+    assert secrets.reads == reads + 1
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from common.efs_io import copy_file_data
+
+DATA = bytes(range(256)) * 4096
+
+
+@pytest.fixture
+def files(tmp_path):
+    source = tmp_path / 'source'
+    source.write_bytes(DATA)
+    src_fd = os.open(source, os.O_RDONLY)
+    dst_fd = os.open(tmp_path / 'copy', os.O_WRONLY | os.O_CREAT)
+    yield src_fd, dst_fd, tmp_path / 'copy'
+    os.close(src_fd)
+    os.close(dst_fd)
+
+
+def stalling(copy, calls=2):
+    # Copies a little for a few calls, then reports no progress
+    made = []
+    size_at = 2 if copy is os.copy_file_range else 3
+
+    def partial(*args):
+        made.append(1)
+        if len(made) > calls:
+            return 0
+        args = list(args)
+        args[size_at] = 1000
+        return copy(*args)
+    return partial
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason='needs copy_file_range')
+def test_stalled_kernel_copy_is_finished(files, monkeypatch):
+    src_fd, dst_fd, copy = files
+    monkeypatch.setattr(os, 'copy_file_range', stalling(os.copy_file_range))
+    monkeypatch.setattr(os, 'sendfile', stalling(os.sendfile))
+    copy_file_data(src_fd, dst_fd, len(DATA))
+    assert copy.read_bytes() == DATA
+
+
+def test_short_source_raises(files):
+    src_fd, dst_fd, _ = files
+    with pytest.raises(OSError):
+        copy_file_data(src_fd, dst_fd, len(DATA) + 10)
@@ -0,0 +1,119 @@
+import pytest
+
+from common.fleet_jobs import (FAILED, JOB_CANCELLED, JOB_COMPLETED, JOB_PAUSED, JOB_RUNNING,
+                               PENDING, RUNNING, SUCCEEDED, JobStore, new_job)
+
+
+class Fleet:
+    """Tasks that finish on the poll after they were started"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.started = []
+
+    def start(self, target, job):
+        self.started.append(target)
+
+    def poll(self, target, task, job):
+        return (FAILED, 'broken') if target in self.failing else (SUCCEEDED, None)
+
+
+@pytest.fixture
+def store():
+    return JobStore()
+
+
+def created(store, targets, **options):
+    return store.create(new_job('upgrade', targets, {'version': '2.0'}, **options))
+
+
+def run(store, job, fleet, steps=10):
+    for _ in range(steps):
+        job = store.step(store.get(job['job_id']), fleet.start, fleet.poll)
+        if job['status'] != JOB_RUNNING:
+            break
+    return job
+
+
+def states(job):
+    return {target: task['state'] for target, task in job['tasks'].items()}
+
+
+def test_job_runs_to_completion_within_the_window(store):
+    fleet = Fleet()
+    job = created(store, ['a', 'b', 'c'], concurrency=2)
+    job = store.step(job, fleet.start, fleet.poll)
+    assert states(job) == {'a': RUNNING, 'b': RUNNING, 'c': PENDING}
+    job = run(store, job, fleet)
+    assert job['status'] == JOB_COMPLETED
+    assert set(states(job).values()) == {SUCCEEDED}
+    assert job['lease_until'] == 0
+
+
+def test_canary_failure_pauses_until_resumed(store):
+    fleet = Fleet(failing={'c'})
+    job = run(store, created(store, ['a', 'b', 'c'], canaries=['c']), fleet)
+    assert job['status'] == JOB_PAUSED
+    assert fleet.started == ['c']
+    store.set_status(job['job_id'], JOB_RUNNING)
+    job = run(store, job, fleet)
+    assert job['status'] == JOB_COMPLETED
+    assert states(job) == {'a': SUCCEEDED, 'b': SUCCEEDED, 'c': FAILED}
+
+
+def test_failure_rate_pauses_the_job(store):
+    fleet = Fleet(failing={'a', 'b'})
+    job = run(store, created(store, list('abcdef'), concurrency=3, min_samples=3,
+                             max_failure_rate=0.5), fleet)
+    assert job['status'] == JOB_PAUSED
+    assert job['paused_reason'] == '2 of 3 tenants failed'
+
+
+def test_leased_job_is_left_alone(store):
+    fleet = Fleet()
+    job = created(store, ['a'])
+    stale = store.get(job['job_id'])
+
+    def start(target, job):
+        # A second scheduler with an older copy of the job steps too
+        assert store.step(stale, fleet.start, fleet.poll)['lease_until'] > 0
+        fleet.start(target, job)
+    store.step(job, start, fleet.poll)
+    assert fleet.started == ['a']
+
+
+def test_stale_copy_does_not_take_the_lease(store):
+    fleet = Fleet()
+    job = created(store, ['a'])
+    stale = store.get(job['job_id'])
+    store.set_status(job['job_id'], JOB_RUNNING, reason=None)
+    assert store.step(stale, fleet.start, fleet.poll)['revision'] == 1
+    assert not fleet.started
+
+
+@pytest.mark.parametrize('status', [JOB_PAUSED, JOB_CANCELLED])
+def test_status_change_during_a_step_is_kept(store, status):
+    fleet = Fleet()
+    job = created(store, ['a', 'b'], concurrency=1)
+
+    def start(target, job):
+        store.set_status(job['job_id'], status, reason='operator')
+        fleet.start(target, job)
+    job = store.step(job, start, fleet.poll)
+    assert job['status'] == status
+    assert states(job)['a'] == RUNNING
+    assert store.get(job['job_id'])['lease_until'] == 0
+
+
+def test_running_task_times_out(store):
+    clock = [1000.0]
+    fleet = Fleet()
+
+    def step(job):
+        return store.step(job, fleet.start, lambda target, task, job: (RUNNING, None),
+                          clock=lambda: clock[0])
+    job = step(created(store, ['a'], task_timeout=60))
+    clock[0] += 61
+    job = step(job)
+    assert job['tasks']['a']['error'] == 'Timed out after 60s'
+    assert job['status'] == JOB_COMPLETED
@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+import requests
+
+from common.lrs_client import LRSClient, LRSError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', '..', 'scripts'))
+import fake_lrs  # pylint: disable=wrong-import-position
+
+fake_lrs.QUIET = True
+
+
+@pytest.fixture
+def lrs_server(request):
+    options = getattr(request, 'param', {})
+    lrs = fake_lrs.FakeLRS(**options)
+    server = fake_lrs.serve(lrs, 0)
+    yield lrs, f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+def client_for(base_url, api_key=fake_lrs.API_KEY, **kwargs):
+    sleeps = []
+    client = LRSClient.from_base_url(base_url, api_key, session=requests.Session(),
+                                     sleep=sleeps.append, **kwargs)
+    client.sleeps = sleeps
+    return client
+
+
+def provision(client, name):
+    user = client.find_user(f'{name}@example.com') or client.create_user(
+        f'{name}@example.com', 'secret', '01/01/30')
+    if not client.find_lrs(name):
+        client.create_lrs(name, 'admin', {user.uuid: ['lrs.view']})
+    if not any(key.username == name for key in client.access_keys(name)):
+        client.create_access_key(name, name, 'secret')
+
+
+@pytest.mark.parametrize('lrs_server', [{'throttle': 3}, {'unavailable': 4},
+                                        {'throttle': 3, 'unavailable': 5}], indirect=True)
+def test_rejected_requests_are_retried_without_duplicates(lrs_server):
+    lrs, base_url = lrs_server
+    client = client_for(base_url)
+    for number in range(5):
+        provision(client, f'tenant{number}')
+    assert client.retried == lrs.rejected > 0
+    names = sorted(record['lrsName'] for record in lrs.lrs.values())
+    assert names == [f'tenant{number}' for number in range(5)]
+    assert all(len(keys) == 1 for keys in lrs.keys.values())
+
+
+@pytest.mark.parametrize('lrs_server', [{'throttle': 1}], indirect=True)
+def test_retries_are_bounded(lrs_server):
+    lrs, base_url = lrs_server
+    client = client_for(base_url, retries=2)
+    with pytest.raises(LRSError) as raised:
+        client.find_lrs('tenant')
+    assert raised.value.status == 429
+    assert lrs.requests == 3
+    # Retry-After: 0 from the fake is honoured instead of the backoff
+    assert client.sleeps == [0.0, 0.0]
+
+
+def test_client_errors_are_not_retried(lrs_server):
+    lrs, base_url = lrs_server
+    client = client_for(base_url, api_key='wrong')
+    with pytest.raises(LRSError) as raised:
+        client.find_lrs('tenant')
+    assert raised.value.status == 401
+    assert lrs.requests == 1
+
+
+def test_unreachable_lrs_raises_after_retries():
+    client = client_for('http://127.0.0.1:9/', retries=2, backoff=0.01)
+    with pytest.raises(LRSError):
+        client.find_lrs('tenant')
+    assert client.retried == 2
+
+
+@pytest.mark.parametrize('lrs_server', [{'ignore_search': True}], indirect=True)
+def test_find_lrs_pages_when_search_is_ignored(lrs_server):
+    _, base_url = lrs_server
+    client = client_for(base_url)
+    for number in range(3):
+        client.create_lrs(f'tenant{number}', 'admin', {})
+    assert [instance.name for instance in client.find_lrs('tenant1')] == ['tenant1']
+
+
+def test_deleting_a_missing_lrs_is_not_an_error(lrs_server):
+    _, base_url = lrs_server
+    client = client_for(base_url)
+    created = client.create_lrs('tenant', 'admin', {})
+    assert client.delete_lrs(created.id)
+    assert not client.delete_lrs(created.id)
@@ -0,0 +1,76 @@
+from common.parallel_load import LoadPlan, compare_with_dump
+from common.sql_import import iter_statements
+
+DUMP = b"""
+DROP TABLE IF EXISTS `node`;
+CREATE TABLE `node` (`nid` int);
+INSERT INTO `node` VALUES (1),(2),(3);
+DROP TABLE IF EXISTS `cache`;
+CREATE TABLE `cache` (`cid` varchar(255));
+DROP TABLE IF EXISTS `users`;
+CREATE TABLE `users` (`uid` int);
+INSERT INTO `users` VALUES (1) ON DUPLICATE KEY UPDATE `uid` = `uid`;
+CREATE TABLE `recent` (`nid` int);
+DROP TABLE IF EXISTS `recent`;
+/*!50001 CREATE VIEW `recent` AS SELECT `nid` FROM `node` */;
+"""
+
+
+class FakeConnection:
+    def __init__(self, tables):
+        self.tables = tables
+        self.result = None
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        if 'information_schema' in sql:
+            self.result = [(table,) for table in self.tables]
+        else:
+            self.result = [(self.tables[sql.split('`')[1]],)]
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result[0]
+
+    def close(self):
+        pass
+
+
+def compare(tables):
+    return compare_with_dump(FakeConnection(tables), 'tenant', iter_statements(DUMP.splitlines(True)))
+
+
+def test_view_stand_ins_are_not_created_tables():
+    plan = LoadPlan(iter_statements(DUMP.splitlines(True)))
+    assert plan.created_tables() == {'node', 'cache', 'users'}
+
+
+def test_loaded_database_matches():
+    assert compare({'node': 3, 'cache': 0, 'users': 1}) == ({}, {}, {'users': 1})
+
+
+def test_table_without_inserts_is_reported_missing():
+    incomplete, grown, _ = compare({'node': 3, 'users': 1})
+    assert incomplete == {'cache': (0, None)}
+    assert not grown
+
+
+def test_uncountable_table_is_not_grown():
+    incomplete, grown, unknown = compare({'node': 3, 'cache': 0, 'users': 40})
+    assert not incomplete and not grown
+    assert unknown == {'users': 40}
+
+
+def test_empty_uncountable_table_is_incomplete():
+    incomplete, _, _ = compare({'node': 3, 'cache': 0, 'users': 0})
+    assert incomplete == {'users': (None, 0)}
+
+
+def test_cms_data_is_grown():
+    incomplete, grown, _ = compare({'node': 2, 'cache': 5, 'users': 1, 'sessions': 1})
+    assert incomplete == {'node': (3, 2)}
+    assert grown == {'cache': (0, 5), 'sessions': (0, 1)}
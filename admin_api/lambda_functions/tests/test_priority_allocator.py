@@ -0,0 +1,113 @@
+import pytest
+
+from common.priority_allocator import (KEY, TABLE_NAME, PrioritiesExhausted, PriorityAllocator,
+                                       listener_priorities)
+from common.record_store import open_table
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RacingTable:
+    """A table where another allocator writes between our read and our write"""
+
+    def __init__(self, table, interfere):
+        self.table = table
+        self.interfere = interfere
+
+    def get(self, key):
+        return self.table.get(key)
+
+    def put_if(self, item, field, expected):
+        if self.interfere:
+            interfere, self.interfere = self.interfere, None
+            interfere()
+        return self.table.put_if(item, field, expected)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def allocator(clock):
+    return PriorityAllocator(max_priority=20, quarantine=60, clock=clock)
+
+
+def no_rules():
+    return {}
+
+
+def test_lowest_free_priority_is_taken(allocator):
+    allocator.rebuild({1: 'acme', 3: None})
+    assert allocator.allocate_all(['globex', 'initech'], no_rules) == {'globex': 2, 'initech': 4}
+    assert allocator.allocate('globex', no_rules) == 2
+
+
+def test_concurrent_allocations_get_different_priorities(allocator, clock):
+    allocator.rebuild({})
+    table = open_table(TABLE_NAME, KEY)
+    other = PriorityAllocator(max_priority=20, clock=clock)
+    racing = RacingTable(table, lambda: other.allocate('acme', no_rules))
+    mine = PriorityAllocator(table=racing, max_priority=20, clock=clock)
+    assert mine.allocate('globex', no_rules) == 2
+    assert allocator.priority_of('acme') == 1
+
+
+def test_released_priority_is_quarantined(allocator, clock):
+    allocator.rebuild({})
+    allocator.allocate_all(['acme', 'globex'], no_rules)
+    assert allocator.release('acme', 'unknown') == [1]
+    assert allocator.allocate('initech', no_rules) == 3
+    clock.now += 61
+    assert allocator.allocate('umbrella', no_rules) == 1
+
+
+def test_rebuild_keeps_priorities_of_stacks_without_rules(allocator):
+    allocator.rebuild({})
+    allocator.allocate_all(['acme', 'globex'], no_rules)
+    # globex's rule is not there yet and another rule took acme's priority
+    allocator.rebuild({1: 'stranger'})
+    assert allocator.priority_of('globex') == 2
+    assert allocator.priority_of('acme') is None
+    assert allocator.allocate('acme', no_rules) == 3
+
+
+def test_missing_record_is_built_from_the_listeners(allocator):
+    assert allocator.allocate('acme', lambda: {1: 'globex', 2: None}) == 3
+    assert allocator.priority_of('globex') == 1
+
+
+def test_exhausted_pool_raises(allocator):
+    allocator.rebuild({priority: None for priority in range(1, 21)})
+    with pytest.raises(PrioritiesExhausted):
+        allocator.allocate('acme', no_rules)
+
+
+class PagedRules:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def describe_rules(self, ListenerArn, PageSize, Marker=None):  # pylint: disable=invalid-name
+        index = int(Marker or 0)
+        page = {'Rules': self.pages[index]}
+        if index + 1 < len(self.pages):
+            page['NextMarker'] = str(index + 1)
+        return page
+
+
+def rule(priority, host):
+    return {'Priority': priority, 'Conditions': [
+        {'Field': 'host-header', 'HostHeaderConfig': {'Values': [host]}}]}
+
+
+def test_listener_priorities_follow_every_page():
+    rules = PagedRules([[rule('1', 'acme.example.com'), {'Priority': 'default'}],
+                        [rule('7', 'globex.example.com'), {'Priority': '9', 'Conditions': []}]])
+    assert listener_priorities(rules, ['listener']) == {1: 'acme', 7: 'globex', 9: None}
@@ -0,0 +1,112 @@
+import re
+
+import pytest
+
+from common.provisioning import FAILED, PIPELINE, SKIPPED, SUCCEEDED, run_pipeline, state_machine
+
+FUNCTIONS = {step.function: step.name for step in PIPELINE}
+
+
+class StatesError(Exception):
+    pass
+
+
+def _merge(expression, results):
+    # Evaluates the nested States.JsonMerge of a Parallel ResultSelector
+    match = re.fullmatch(r'States\.JsonMerge\((.*), \$\[(\d+)\], false\)', expression)
+    if match:
+        return dict(_merge(match.group(1), results), **results[int(match.group(2))])
+    return results[int(re.fullmatch(r'\$\[(\d+)\]', expression).group(1))]
+
+
+def _set(state, path, value):
+    if path is None:
+        return state
+    return dict(state, **{path[len('$.'):]: value})
+
+
+def _matches(condition, state):
+    if 'Or' in condition:
+        return any(_matches(part, state) for part in condition['Or'])
+    return (condition['Variable'][len('$.'):] in state) == condition['IsPresent']
+
+
+def execute(definition, state, invoke):
+    """Runs the subset of the States language that state_machine emits"""
+    name = definition['StartAt']
+    while True:
+        current = definition['States'][name]
+        kind = current['Type']
+        following = current.get('Next')
+        if kind == 'Task':
+            try:
+                invoke(current['Parameters']['FunctionName'])
+            except Exception as ex:  # pylint: disable=broad-except
+                catcher = current['Catch'][0]
+                state = _set(state, catcher['ResultPath'], {'Error': type(ex).__name__})
+                following = catcher['Next']
+        elif kind == 'Pass':
+            if 'Result' in current:
+                state = _set(state, current['ResultPath'], current['Result'])
+        elif kind == 'Choice':
+            following = next((choice['Next'] for choice in current['Choices']
+                              if _matches(choice, state)), current['Default'])
+        elif kind == 'Parallel':
+            results = [execute(branch, state, invoke) for branch in current['Branches']]
+            state = _merge(current['ResultSelector']['state.$'], results)
+        elif kind == 'Fail':
+            raise StatesError(current['Error'])
+        elif kind == 'Succeed':
+            return state
+        if current.get('End'):
+            return state
+        name = following
+
+
+def local_statuses(failing):
+    def run_stage(step):
+        if step.name in failing:
+            raise RuntimeError(step.name)
+    return {name: timing['status'] for name, timing in run_pipeline(PIPELINE, run_stage).items()}
+
+
+def machine_statuses(failing):
+    ran = []
+
+    def invoke(function):
+        ran.append(FUNCTIONS[function])
+        if FUNCTIONS[function] in failing:
+            raise RuntimeError(function)
+
+    try:
+        final = execute(state_machine(), {'httpMethod': 'POST', 'body': '{}'}, invoke)
+        failed = False
+    except StatesError:
+        final, failed = None, True
+    statuses = {}
+    for step in PIPELINE:
+        if step.name not in ran:
+            statuses[step.name] = SKIPPED
+        else:
+            statuses[step.name] = FAILED if step.name in failing else SUCCEEDED
+    return statuses, failed, final
+
+
+@pytest.mark.parametrize('failing', [()] + [(step.name,) for step in PIPELINE]
+                         + [('db', 'lrs'), ('files', 'solr')])
+def test_state_machine_matches_run_pipeline(failing):
+    statuses, failed, _ = machine_statuses(failing)
+    assert statuses == local_statuses(failing)
+    assert failed == bool(failing)
+
+
+def test_failed_lrs_does_not_stop_the_deploy():
+    statuses, failed, _ = machine_statuses(('lrs',))
+    assert statuses['deploy'] == SUCCEEDED
+    assert statuses['lrs'] == FAILED
+    assert failed
+
+
+def test_stages_get_the_execution_input():
+    _, _, final = machine_statuses(())
+    assert final == {'httpMethod': 'POST', 'body': '{}'}
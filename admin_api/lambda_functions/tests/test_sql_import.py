@@ -0,0 +1,83 @@
+import pytest
+
+from common.sql_import import Statement, count_rows, iter_batches, iter_statements
+
+
+def split(dump):
+    return [statement.sql for statement in iter_statements(dump.splitlines(True))]
+
+
+def test_statements_end_at_the_delimiter():
+    assert split(b'SET NAMES utf8mb4;\nSELECT 1; SELECT 2;\nSELECT\n  3;\n') == [
+        'SET NAMES utf8mb4', 'SELECT 1', 'SELECT 2', 'SELECT\n  3']
+
+
+@pytest.mark.parametrize('value', [
+    b"'a;b'", b"'it''s; fine'", b"'back\\\\slash;'", b"'escaped \\' quote;'",
+    b'"double; quoted"', b"'multi\nline;\nvalue'",
+])
+def test_delimiters_in_strings_are_kept(value):
+    dump = b'INSERT INTO `t` VALUES (' + value + b');\nSELECT 1;\n'
+    assert split(dump) == ['INSERT INTO `t` VALUES (' + value.decode() + ')', 'SELECT 1']
+
+
+def test_quoted_identifiers_may_hold_delimiters():
+    assert split(b'CREATE TABLE `odd;name` (`a` int);\n') == [
+        'CREATE TABLE `odd;name` (`a` int)']
+
+
+def test_comments_are_dropped_but_executable_comments_kept():
+    dump = (b'-- mysqldump header; with a delimiter\n'
+            b'# another comment;\n'
+            b'/* plain; comment */\n'
+            b'/*!40101 SET NAMES utf8 */;\n'
+            b'SELECT 1 /* inline */ + 1;\n')
+    assert split(dump) == ['/*!40101 SET NAMES utf8 */', 'SELECT 1   + 1']
+
+
+def test_custom_delimiter_marks_statements_standalone():
+    dump = (b'DELIMITER ;;\n'
+            b'CREATE TRIGGER `t` BEFORE INSERT ON `n` FOR EACH ROW BEGIN SET @a = 1; END ;;\n'
+            b'DELIMITER ;\n'
+            b'SELECT 1;\n')
+    statements = list(iter_statements(dump.splitlines(True)))
+    assert [statement.standalone for statement in statements] == [True, False]
+    assert statements[0].sql.endswith('SET @a = 1; END')
+
+
+def test_last_statement_needs_no_delimiter():
+    assert split(b'SELECT 1;\nSELECT 2\n') == ['SELECT 1', 'SELECT 2']
+
+
+@pytest.mark.parametrize('sql, kind, table', [
+    ('INSERT INTO `node` VALUES (1)', 'insert', 'node'),
+    ('INSERT IGNORE INTO node VALUES (1)', 'insert', 'node'),
+    ('CREATE TABLE IF NOT EXISTS `cache` (a int)', 'create', 'cache'),
+    ('DROP TABLE IF EXISTS `cache`', 'drop', 'cache'),
+    ('LOCK TABLES `node` WRITE', 'lock', 'node'),
+    ('/*!40000 ALTER TABLE `node` DISABLE KEYS */', 'alter', 'node'),
+    ('SET NAMES utf8', 'set', None),
+])
+def test_statements_are_classified(sql, kind, table):
+    statement = Statement.parse(sql)
+    assert (statement.kind, statement.table) == (kind, table)
+
+
+@pytest.mark.parametrize('sql, rows', [
+    ("INSERT INTO `t` VALUES (1,'a'),(2,'(b)'),(3,')')", 3),
+    ("INSERT INTO `t` VALUES (1,POINT(0,0))", 1),
+    ("INSERT INTO `t` (`a`) VALUES (1)", 1),
+    ("INSERT INTO `t` SELECT * FROM `u`", None),
+    ("INSERT INTO `t` VALUES (1) ON DUPLICATE KEY UPDATE a = 1", None),
+])
+def test_count_rows(sql, rows):
+    assert count_rows(sql) == rows
+
+
+def test_batches_respect_size_and_standalone_statements():
+    statements = [Statement('a', 'set', size=40), Statement('b', 'set', size=40),
+                  Statement('c', 'create', standalone=True, size=10),
+                  Statement('d', 'set', size=40)]
+    batches = [[statement.sql for statement in batch]
+               for batch in iter_batches(statements, batch_bytes=64)]
+    assert batches == [['a'], ['b'], ['c'], ['d']]
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from common import tenant_deploy
+from common.tenant_deploy import SYNC_TIMEOUT, UPDATE, finish_sync, request_deploy, settle
+from common.tenant_registry import TenantRegistry
+
+
+class FakeLambda:
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):  # pylint: disable=invalid-name
+        assert (FunctionName, InvocationType) == ('sync_files', 'Event')
+        self.payloads.append(json.loads(Payload))
+
+
+@pytest.fixture
+def deploys(monkeypatch):
+    started = []
+    monkeypatch.setattr(tenant_deploy, 'run_tenant_task',
+                        lambda cf, ecs, base, tenant, command: started.append((tenant, command)))
+    return started
+
+
+@pytest.fixture
+def clients():
+    return {'cloudformation': None, 'ecs': None, 'lambda': FakeLambda(), 'secretsmanager': None}
+
+
+def updated(versions=('1.0', '2.0')):
+    registry = TenantRegistry()
+    registry.register('acme', version=versions[0])
+    request_deploy(registry, 'acme', UPDATE, {'VERSION': versions[1], 'FROM_VERSION': versions[0]})
+    return registry, registry.update('acme', stack_status='UPDATE_COMPLETE')
+
+
+def test_files_are_synced_before_the_deploy(deploys, clients):
+    registry, record = updated()
+    assert settle(registry, record, 'UPDATE_COMPLETE', clients, 'base') == \
+        'syncing starter files before the deploy'
+    assert not deploys
+    payload, = clients['lambda'].payloads
+    assert (payload['from_version'], payload['to_version']) == ('1.0', '2.0')
+
+    # A repeated status event while the sync runs changes nothing
+    record = registry.get('acme')
+    assert settle(registry, record, 'UPDATE_COMPLETE', clients, 'base') == \
+        'waiting for the starter file sync'
+
+    assert finish_sync(registry, 'acme', payload['token'], None, clients, 'base') == \
+        'update deploy started'
+    assert deploys == [('acme', ['drush', 'deploy'])]
+    assert finish_sync(registry, 'acme', payload['token'], None, clients, 'base') == \
+        'claimed elsewhere'
+    assert len(deploys) == 1
+
+
+def test_rolled_back_update_does_not_sync(deploys, clients):
+    registry, record = updated()
+    settle(registry, record, 'UPDATE_ROLLBACK_COMPLETE', clients, 'base')
+    assert not clients['lambda'].payloads
+    assert not deploys
+    assert registry.get('acme')['pending_deploy'] is None
+
+
+def test_same_version_deploys_without_sync(deploys, clients):
+    registry, record = updated(('2.0', '2.0'))
+    assert settle(registry, record, 'UPDATE_COMPLETE', clients, 'base') == 'update deploy started'
+    assert not clients['lambda'].payloads
+    assert len(deploys) == 1
+
+
+def test_lost_sync_deploys_after_timeout(deploys, clients):
+    registry, record = updated()
+    settle(registry, record, 'UPDATE_COMPLETE', clients, 'base', clock=lambda: 1000)
+    record = registry.get('acme')
+    later = 1000 + SYNC_TIMEOUT + 1
+    assert settle(registry, record, 'UPDATE_COMPLETE', clients, 'base', clock=lambda: later) == \
+        'update deploy started'
+    assert registry.get('acme')['sync_error'] == 'Timed out'
@@ -0,0 +1,171 @@
+"""Upgrades many tenants to one CMS version
+
+POST /bulk-update starts a job, GET /bulk-update/{job} reports its
+progress and PUT /bulk-update/{job} with ``{"action": "pause"}``,
+``"resume"`` or ``"cancel"`` controls it. A one minute schedule invokes
+the function with ``{"action": "tick"}`` to move every running job on.
+
+Each tenant goes through the same pipeline as PATCH /tenant/{tenant}:
+update_stack, which runs config_export, updates the stack and starts
+admin_function.
+"""
+
+import json
+import time
+
+from common import runtime
+from common.fleet_jobs import (DEFAULT_CONCURRENCY, DEFAULT_MAX_FAILURE_RATE,
+                               DEFAULT_MIN_SAMPLES, DEFAULT_TASK_TIMEOUT, FAILED,
+                               JOB_CANCELLED, JOB_PAUSED, JOB_RUNNING, RUNNING, SUCCEEDED,
+                               JobStore, new_job, progress)
+from common.tenant_registry import TenantRegistry
+from common.version_catalog import VersionCatalog
+
+KIND = 'upgrade'
+ACTIONS = {'pause': JOB_PAUSED, 'resume': JOB_RUNNING, 'cancel': JOB_CANCELLED}
+# Seconds update_stack gets to record the update before the tenant fails
+START_TIMEOUT = 900
+
+
+def _response(status_code, body):
+    return {"statusCode": status_code, "body": json.dumps(body)}
+
+
+def select_tenants(records, version, names=None, from_version=None):
+    """Splits registry records into tenants to upgrade and skipped tenants
+
+    Returns
+    ------
+    tuple of (list of tenant names, dict of skipped tenant to reason)
+    """
+    wanted = set(names) if names else None
+    targets = []
+    skipped = {}
+    for record in records:
+        name = record['name']
+        if wanted is not None and name not in wanted:
+            continue
+        status = record.get('stack_status', '')
+        if from_version and record.get('version') != from_version:
+            continue
+        if record.get('version') == version:
+            skipped[name] = f'Already on version {version}'
+        elif not status.endswith('_COMPLETE') or status.startswith('DELETE'):
+            skipped[name] = f'Stack is {status}'
+        else:
+            targets.append(name)
+    if wanted is not None:
+        for name in wanted - set(targets) - set(skipped):
+            skipped[name] = 'Unknown tenant'
+    return targets, skipped
+
+
+def start_upgrade(tenant, job):
+    """Starts the update pipeline of one tenant"""
+    runtime.client('lambda').invoke(
+        FunctionName='update_stack',
+        InvocationType='Event',
+        Payload=json.dumps({
+            "httpMethod": "PATCH",
+            "pathParameters": {"tenant": tenant},
+            "body": json.dumps({"VERSION": job['params']['version']})
+        })
+    )
+
+
+def poll_upgrade(tenant, task, job):
+    """Reads the outcome of one tenant's update from the registry
+
+    A tenant is upgraded once its stack is updated and the deploy task
+    that follows has run; a failed deploy fails the tenant.
+    """
+    registry = TenantRegistry()
+    record = registry.get(tenant)
+    if record is None:
+        return FAILED, 'Tenant is no longer registered'
+    record = registry.refresh_status(record, runtime.client('cloudformation'))
+    status = record.get('stack_status', '')
+    if record.get('updated_at', '') < task['started_at']:
+        if time.time() - task['started'] > START_TIMEOUT:
+            return FAILED, 'The stack update was not started'
+        return RUNNING, None
+    if 'ROLLBACK' in status or status.endswith('FAILED'):
+        return FAILED, f'Stack is {status}'
+    if record.get('pending_deploy'):
+        return RUNNING, None
+    if record.get('deploy_error'):
+        return FAILED, f"Deploy failed: {record['deploy_error']}"
+    # The CMS counts as upgraded once the deploy task ran after the stack update
+    if (status == 'UPDATE_COMPLETE' and record.get('version') == job['params']['version']
+            and record.get('deployed_at', '') >= task['started_at']):
+        return SUCCEEDED, None
+    return RUNNING, None
+
+
+def create_job(body):
+    """Validates a bulk update request and builds its job"""
+    version = body['VERSION']
+    if not VersionCatalog().deployable(version):
+        raise ValueError("Version does not exist")
+    targets, skipped = select_tenants(TenantRegistry().tenants(), version,
+                                      body.get('tenants'), body.get('from_version'))
+    canaries = body.get('canaries') or targets[:int(body.get('canary_count', 1))]
+    return new_job(KIND, targets, {'version': version},
+                   concurrency=body.get('concurrency', DEFAULT_CONCURRENCY),
+                   canaries=canaries,
+                   max_failure_rate=body.get('max_failure_rate', DEFAULT_MAX_FAILURE_RATE),
+                   min_samples=body.get('min_samples', DEFAULT_MIN_SAMPLES),
+                   task_timeout=body.get('task_timeout', DEFAULT_TASK_TIMEOUT),
+                   skipped=skipped)
+
+
+@runtime.instrumented
+def lambda_handler(event, context):
+    """
+    Parameters
+    ----------
+    event: dict, required
+        API Gateway Lambda Proxy Input Format, or ``{"action": "tick"}``
+        from the schedule
+
+    Returns
+    ------
+    API Gateway Lambda Proxy Output Format: dict
+    """
+
+    store = JobStore()
+    if event.get('action') == 'tick':
+        jobs = [store.step(job, start_upgrade, poll_upgrade) for job in store.active(KIND)]
+        return {'jobs': [progress(job) for job in jobs if job]}
+
+    method = event.get('httpMethod')
+    job_id = (event.get('pathParameters') or {}).get('job')
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return _response(400, {"message": "Body is not valid JSON"})
+
+    if method == 'POST':
+        try:
+            job = create_job(body)
+        except KeyError as ex:
+            return _response(400, {"message": f"Missing {ex.args[0]}"})
+        except ValueError as ex:
+            return _response(400, {"message": str(ex)})
+        store.create(job)
+        print(f"Started bulk update {job['job_id']} of {len(job['order'])} tenants "
+              f"to {job['params']['version']}")
+        job = store.step(job, start_upgrade, poll_upgrade)
+        return _response(202, progress(job))
+
+    if method == 'PUT':
+        action = body.get('action')
+        if action not in ACTIONS:
+            return _response(400, {"message": "action must be pause, resume or cancel"})
+        reason = 'Paused by request' if action == 'pause' else None
+        job = store.set_status(job_id, ACTIONS[action], reason)
+    else:
+        job = store.get(job_id)
+    if job is None or job.get('kind') != KIND:
+        return _response(404, {"message": "Job does not exist"})
+    return _response(200, progress(job))
@@ -1,48 +1,15 @@
-def lambda_handler(event, context):
-  import boto3
-  from decouple import config
+from common import runtime
+from common.base_stack import run_tenant_task
+
 
+@runtime.instrumented
+def lambda_handler(event, context):
   print("Starting Admin container")
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
-  ecs_client = session.client('ecs')
+  cf_client = runtime.client('cloudformation')
+  ecs_client = runtime.client('ecs')
   tenant = event['tenant'].lower()
-  base_stack = config('base_stack')
-  base_stack_info = cf_client.describe_stacks(StackName=base_stack)
-  task_definition = tenant + '-php-admin-task'
-
-  outputs = base_stack_info['Stacks'][0]['Outputs']
-  subnets=[]
-  for output in outputs:
-    if 'PrivateSubnet' in output['OutputKey']:
-        subnets.append(output['OutputValue'])
-    if 'ECSCluster' in output['OutputKey']:
-      ecs_cluster = output['OutputValue']
-    if 'SGECS' in output['OutputKey']:
-      ecs_security_group = output['OutputValue']
+  base_stack = runtime.setting('base_stack')
 
-  ecs_client.run_task(
-    cluster=ecs_cluster,
-    launchType='FARGATE',
-    taskDefinition=task_definition,
-    count=1,
-    platformVersion='1.4.0',
-    networkConfiguration={
-        'awsvpcConfiguration': {
-            'subnets': subnets,
-            'securityGroups': [
-                ecs_security_group,
-            ],
-            'assignPublicIp': 'ENABLED'
-        }
-    },
-    overrides={ 'containerOverrides': [
-      {
-        'name': tenant + '-php',
-        'command': [
-            "sh", "/var/www/html/admin_api/config_export.sh", tenant
-        ]
-      }
-    ]
-    }
-  )
+  run_tenant_task(cf_client, ecs_client, base_stack, tenant, [
+      "sh", "/var/www/html/admin_api/config_export.sh", tenant
+  ])
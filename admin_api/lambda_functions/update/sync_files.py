@@ -0,0 +1,61 @@
+"""Refreshes a tenant's starter public files after a version change
+Runs with the same EFS access point as create_files_directories so the
+copied files belong to the web server user. stack_events invokes it
+once an update has completed, and it starts the waiting CMS deploy
+when the files are in place.
+"""
+
+from common import runtime
+from common.starter_sync import sync_tenant
+from common.tenant_deploy import finish_sync
+from common.tenant_registry import TenantRegistry
+
+
+def _clients():
+    return {
+        'cloudformation': runtime.client('cloudformation'),
+        'ecs': runtime.client('ecs'),
+        'lambda': runtime.client('lambda'),
+        'secretsmanager': runtime.client('secretsmanager'),
+    }
+
+
+@runtime.instrumented
+def lambda_handler(event, context):
+    """
+    Parameters
+    ----------
+    event: dict, required
+        tenant, from_version and to_version of the upgrade, and the
+        token of the pending deploy that waits for the sync
+
+    Returns
+    ------
+    dict: copy summary plus skipped and removed paths
+    """
+
+    tenant = event['tenant'].lower()
+    from_version = event['from_version']
+    to_version = event['to_version']
+    result = {'message': f'{tenant} is already on version {to_version}'}
+    error = None
+    if from_version != to_version:
+        print(f'Syncing starter files of {tenant} from {from_version} to {to_version}')
+        try:
+            stats, details = sync_tenant(f'/mnt/efs/{tenant}/public', from_version, to_version)
+        except Exception as ex:  # pylint: disable=broad-except
+            # The deploy still runs, the files can be synced again by hand
+            error = f'{type(ex).__name__}: {ex}'
+            print(f'[WARN] Could not sync the starter files of {tenant}: {error}')
+            result = {'message': 'Starter files not synced', 'error': error}
+        else:
+            print(f'Synced starter files: {stats.summary()}, '
+                  f'{len(details["skipped"])} locally modified files skipped')
+            result = {'message': 'Starter files synced', 'summary': stats.as_dict(), **details}
+
+    if 'token' in event:
+        outcome = finish_sync(TenantRegistry(), tenant, event['token'], error, _clients(),
+                              runtime.setting('base_stack'))
+        print(f'{tenant} deploy: {outcome}')
+        result['deploy'] = outcome
+    return result
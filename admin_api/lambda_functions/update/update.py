@@ -1,22 +1,19 @@
-def lambda_handler(event, context):
-  import boto3
-  import json
-  from decouple import config
+import json
+from common import runtime
+from common.version_catalog import VersionCatalog
+
 
+@runtime.instrumented
+def lambda_handler(event, context):
   tenant_info = json.loads(event['body'])
-  session = boto3.Session()
-  s3_client = session.client('s3')
-  s3_bucket = config('s3_bucket')
   version = tenant_info['VERSION']
-  cf_client = session.client('cloudformation')
-  lambda_client = session.client('lambda')
+  cf_client = runtime.client('cloudformation')
+  lambda_client = runtime.client('lambda')
   pathParameters = event['pathParameters']
   tenant = pathParameters['tenant'].lower()
 
   ###check if version is available
-  version_check = s3_client.list_objects_v2(Bucket=s3_bucket,Prefix=version)
-
-  if version_check['KeyCount'] == 0 :
+  if not VersionCatalog().deployable(version):
     return { "statusCode": 400,
         "body": "Version does not exist" 
         }
@@ -1,22 +1,27 @@
-def lambda_handler(event, context):
-  import boto3
-  import json
-  from decouple import config
+import json
+from common import runtime
+from common.tenant_registry import TenantRegistry
+
 
-  session = boto3.Session()
-  cf_client = session.client('cloudformation')
-  lambda_client = session.client('lambda')
+@runtime.instrumented
+def lambda_handler(event, context):
+  cf_client = runtime.client('cloudformation')
+  lambda_client = runtime.client('lambda')
   tenant_info = event['body']
   tenant_data = json.loads(tenant_info)
   path_parameters = event['pathParameters']
   tenant = path_parameters['tenant'].lower()
   tenant_data['TENANT'] = tenant
-  event['body'] = json.dumps(tenant_data)
-  s3_bucket = config('s3_bucket')
+  s3_bucket = runtime.setting('s3_bucket')
   version = tenant_data['VERSION']
   template_url = 'https://' + s3_bucket + '.s3.amazonaws.com/' + version + '/code/scripts/tenant.yml'
   ce_payload = {"tenant": tenant}
 
+  registry = TenantRegistry()
+  ### sync_files runs from stack_events once the update is complete
+  tenant_data['FROM_VERSION'] = registry.lookup(tenant, cf_client)['version']
+  event['body'] = json.dumps(tenant_data)
+
   ce_response = lambda_client.invoke(
       FunctionName='config_export',
       InvocationType='RequestResponse',
@@ -124,6 +129,8 @@ def lambda_handler(event, context):
       ]
   )
   print(stack_update_response)
+  registry.update(tenant, version=version, stack_status='UPDATE_IN_PROGRESS',
+                  deploy_error=None)
   admin_response = lambda_client.invoke(
       FunctionName='admin_function',
       InvocationType='Event',
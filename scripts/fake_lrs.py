@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Serves a fake Veracity LRS admin API for local runs of the LRS client
+
+Implements the endpoints common/lrs_client.py calls, keeping users, LRS
+instances and access keys in memory. Rate limiting and outages can be
+injected so the retry behaviour can be watched:
+
+``--throttle N``
+    every Nth request is answered 429 with ``Retry-After: 0``
+``--unavailable N``
+    every Nth request is answered 503
+``--latency MS``
+    every answer is delayed by MS milliseconds
+``--ignore-search``
+    the LRS listing ignores ``search`` like an older Veracity would, so
+    the client has to page through it
+
+``--check`` starts the server in-process and provisions and deletes a
+few tenants through LRSClient against it, then prints how many requests
+were retried and whether every record ended up created exactly once.
+
+Examples::
+
+    python3 scripts/fake_lrs.py --port 8090 --throttle 3
+    python3 scripts/fake_lrs.py --check --throttle 3 --unavailable 7
+    python3 scripts/fake_lrs.py --check --ignore-search --tenants 500
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_KEY = 'fake-api-key'
+# Silences the access log in --check runs
+QUIET = False
+
+
+class FakeLRS:
+    """In-memory state of the fake LRS and its injected faults"""
+
+    def __init__(self, api_key=API_KEY, throttle=0, unavailable=0, latency=0.0,
+                 ignore_search=False):
+        self.api_key = api_key
+        self.throttle = throttle
+        self.unavailable = unavailable
+        self.latency = latency
+        self.ignore_search = ignore_search
+        self.listed = 0
+        self.users = {}
+        self.lrs = {}
+        self.keys = {}
+        self.requests = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+
+    def fault(self):
+        """Status to answer instead of serving the request, or None"""
+        with self.lock:
+            self.requests += 1
+            number = next(self.counter)
+            status = None
+            if self.throttle and number % self.throttle == 0:
+                status = 429
+            elif self.unavailable and number % self.unavailable == 0:
+                status = 503
+            if status:
+                self.rejected += 1
+            return status
+
+    def handle(self, method, path, query, body):
+        """Serves one request, returning (status, JSON document)"""
+        parts = [part for part in path.split('/') if part]
+        with self.lock:
+            if parts == ['admin', 'api', 'user'] and method == 'GET':
+                search = json.loads(query.get('search', ['{}'])[0])
+                return 200, [user for user in self.users.values()
+                             if all(user.get(field) == value for field, value in search.items())]
+            if parts == ['admin', 'api', 'user'] and method == 'POST':
+                user = dict(body, uuid=str(uuid.uuid4()))
+                user.pop('password', None)
+                self.users[user['uuid']] = user
+                return 201, user
+            if parts == ['admin', 'api', 'lrs'] and method == 'GET':
+                search = {} if self.ignore_search else json.loads(query.get('search', ['{}'])[0])
+                found = [lrs for lrs in self.lrs.values()
+                         if all(lrs.get(field) == value for field, value in search.items())]
+                skip = int(query.get('skip', ['0'])[0])
+                limit = int(query.get('limit', ['0'])[0])
+                page = found[skip:skip + limit] if limit else found[skip:]
+                self.listed += len(page)
+                return 200, page
+            if parts == ['admin', 'api', 'lrs'] and method == 'POST':
+                lrs = dict(body, _id=uuid.uuid4().hex)
+                self.lrs[lrs['_id']] = lrs
+                self.keys.setdefault(lrs['lrsName'], [])
+                return 201, lrs
+            if parts[:3] == ['admin', 'api', 'lrs'] and len(parts) == 4 and method == 'DELETE':
+                lrs = self.lrs.pop(parts[3], None)
+                if lrs is None:
+                    return 404, {'message': 'Not found'}
+                self.keys.pop(lrs['lrsName'], None)
+                return 200, {}
+            if len(parts) == 3 and parts[0] == 'api' and parts[2] == 'xapi-access-keys':
+                if parts[1] not in self.keys:
+                    return 404, {'message': 'No such LRS'}
+                if method == 'GET':
+                    return 200, [{k: v for k, v in key.items() if k != 'password'}
+                                 for key in self.keys[parts[1]]]
+                if method == 'POST':
+                    self.keys[parts[1]].append(body)
+                    return 201, {'username': body['username']}
+        return 404, {'message': f'No route {method} {path}'}
+
+
+def make_handler(lrs):
+    """Request handler class serving ``lrs``"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _serve(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+            if lrs.latency:
+                time.sleep(lrs.latency)
+            status = lrs.fault()
+            if status:
+                document = {'message': 'Injected fault'}
+            elif self.headers.get('x-veracity-api-key') != lrs.api_key:
+                status, document = 401, {'message': 'Bad API key'}
+            else:
+                url = urlparse(self.path)
+                status, document = lrs.handle(self.command, url.path, parse_qs(url.query), body)
+            payload = json.dumps(document).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_DELETE = _serve
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            if not QUIET:
+                super().log_message(format, *args)
+
+    return Handler
+
+
+def serve(lrs, port):
+    """Starts the fake LRS on ``port`` in a daemon thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(lrs))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(lrs, server, tenants):
+    """Provisions and deletes tenants through LRSClient against the fake"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'admin_api', 'lambda_functions'))
+    from common.lrs_client import LRSClient  # pylint: disable=import-outside-toplevel
+    from common.runtime import pooled_session  # pylint: disable=import-outside-toplevel
+
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/'
+    client = LRSClient.from_base_url(base_url, lrs.api_key, session=pooled_session(),
+                                     backoff=0.01)
+    start = time.monotonic()
+    names = [f'tenant{number}' for number in range(tenants)]
+    for name in names:
+        email = f'{name}@example.com'
+        user = client.find_user(email) or client.create_user(email, 'secret', '01/01/30')
+        if not client.find_lrs(name):
+            client.create_lrs(name, 'admin', {user.uuid: ['lrs.view']})
+        if not any(key.username == name for key in client.access_keys(name)):
+            client.create_access_key(name, name, 'secret')
+    created = {name: sum(1 for lrs_record in lrs.lrs.values() if lrs_record['lrsName'] == name)
+               for name in names}
+    keys = {name: len(lrs.keys.get(name, [])) for name in names}
+    provisioned = time.monotonic()
+    listed = lrs.listed
+    for name in reversed(names):
+        for instance in client.find_lrs(name):
+            client.delete_lrs(instance.id)
+    print(json.dumps({
+        'seconds': round(provisioned - start, 3),
+        'delete_seconds': round(time.monotonic() - provisioned, 3),
+        'lrs_records_read_by_delete': lrs.listed - listed,
+        'requests': lrs.requests,
+        'injected_faults': lrs.rejected,
+        'retried': client.retried,
+        'created_once': all(count == 1 for count in created.values()),
+        'keys_once': all(count == 1 for count in keys.values()),
+        'left_after_delete': len(lrs.lrs),
+    }, indent=2))
+
+
+def main():
+    global QUIET  # pylint: disable=global-statement
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--api-key', default=API_KEY)
+    parser.add_argument('--throttle', type=int, default=0)
+    parser.add_argument('--unavailable', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds')
+    parser.add_argument('--ignore-search', action='store_true')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--tenants', type=int, default=5, help='tenants provisioned by --check')
+    arguments = parser.parse_args()
+
+    lrs = FakeLRS(arguments.api_key, arguments.throttle, arguments.unavailable,
+                  arguments.latency / 1000, arguments.ignore_search)
+    if arguments.check:
+        QUIET = True
+        server = serve(lrs, 0)
+        check(lrs, server, arguments.tenants)
+        server.shutdown()
+        return
+    server = serve(lrs, arguments.port)
+    print(f'Fake LRS on http://127.0.0.1:{arguments.port}/ with API key {arguments.api_key}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Measures cold and warm start cost of the tenant administration Lambdas
+
+Two modes:
+
+``imports``
+    Imports every handler module in a fresh interpreter several times and
+    reports the median import time, which is most of a cold start. Run it
+    from the repository root with the packaging venv active.
+
+``invoke``
+    Invokes a deployed function and reads the REPORT line Lambda returns
+    with ``LogType=Tail``. Cold starts are forced by changing an
+    environment variable before each cold sample; the original variables
+    are put back at the end. Reports p50 and p99 of the billed duration
+    for cold and warm invocations and of the init duration.
+
+Examples::
+
+    python3 scripts/measure_lambdas.py imports --runs 5
+    python3 scripts/measure_lambdas.py invoke tenant_list \\
+        --payload '{"queryStringParameters": {"limit": "10"}}' --cold 3 --warm 50
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import uuid
+
+FUNCTIONS_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'admin_api', 'lambda_functions')
+sys.path.insert(0, FUNCTIONS_ROOT)
+
+from common.runtime import percentile  # noqa: E402 pylint: disable=wrong-import-position
+
+HANDLER_DIRS = ['.', 'create', 'delete', 'status', 'update']
+REPORT_FIELDS = re.compile(r'(Init Duration|Duration): ([\d.]+) ms')
+IMPORT_TIMER = ('import importlib, sys, time; start = time.perf_counter(); '
+                'importlib.import_module(sys.argv[1]); '
+                'print((time.perf_counter() - start) * 1000)')
+
+
+def summary(samples):
+    """p50 and p99 of a list of milliseconds, as a printable string"""
+    if not samples:
+        return 'no samples'
+    return (f'n={len(samples)} p50={percentile(samples, 0.5):.1f}ms '
+            f'p99={percentile(samples, 0.99):.1f}ms')
+
+
+def handler_modules():
+    """Yields (directory, module name) of every handler file"""
+    for directory in HANDLER_DIRS:
+        path = os.path.join(FUNCTIONS_ROOT, directory)
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.py') and name != '__init__.py':
+                yield path, name[:-len('.py')]
+
+
+def measure_imports(runs):
+    """Prints the median import time of every handler module"""
+    for directory, module in handler_modules():
+        paths = [directory, FUNCTIONS_ROOT, os.environ.get('PYTHONPATH', '')]
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, paths)))
+        samples = []
+        for _ in range(runs):
+            result = subprocess.run([sys.executable, '-c', IMPORT_TIMER, module],
+                                    cwd=directory, env=environment,
+                                    capture_output=True, text=True, check=False)
+            if result.returncode != 0:
+                print(f'{module:28} import failed: {result.stderr.strip().splitlines()[-1]}')
+                break
+            samples.append(float(result.stdout))
+        else:
+            print(f'{module:28} median {statistics.median(samples):8.1f}ms '
+                  f'max {max(samples):8.1f}ms')
+
+
+def parse_report(log_result):
+    """Duration and init duration from the base64 log tail of an invocation"""
+    log = base64.b64decode(log_result).decode('utf8', 'replace')
+    report = next((line for line in log.splitlines() if line.startswith('REPORT')), '')
+    fields = dict(REPORT_FIELDS.findall(report))
+    return (float(fields['Duration']) if 'Duration' in fields else None,
+            float(fields['Init Duration']) if 'Init Duration' in fields else None)
+
+
+def original_variables(lambda_client, function):
+    """Environment variables of the function before any cold start was forced"""
+    configuration = lambda_client.get_function_configuration(FunctionName=function)
+    return configuration.get('Environment', {}).get('Variables', {})
+
+
+def set_variables(lambda_client, function, variables):
+    """Replaces the environment variables of the function and waits for the update"""
+    lambda_client.update_function_configuration(FunctionName=function,
+                                                Environment={'Variables': variables})
+    lambda_client.get_waiter('function_updated').wait(FunctionName=function)
+
+
+def force_cold_start(lambda_client, function, variables):
+    """Changes the function configuration so the next call gets a new environment"""
+    set_variables(lambda_client, function,
+                  dict(variables, MEASURE_COLD_START=uuid.uuid4().hex))
+
+
+def measure_invocations(function, payload, cold, warm):
+    """Prints cold, warm and init latency percentiles of a deployed function"""
+    import boto3  # pylint: disable=import-outside-toplevel
+
+    lambda_client = boto3.Session().client('lambda')
+    samples = {'cold': [], 'warm': [], 'init': []}
+
+    def invoke():
+        response = lambda_client.invoke(FunctionName=function, LogType='Tail',
+                                        Payload=payload.encode('utf8'))
+        if 'FunctionError' in response:
+            print(f'Function error: {response["Payload"].read().decode("utf8")}')
+        return parse_report(response['LogResult'])
+
+    # The forced variable is removed again once the warm calls are done too
+    variables = original_variables(lambda_client, function)
+    try:
+        for _ in range(cold):
+            force_cold_start(lambda_client, function, variables)
+            duration, init = invoke()
+            samples['cold'].append(duration)
+            if init is not None:
+                samples['init'].append(init)
+        for _ in range(warm):
+            duration, init = invoke()
+            samples['cold' if init is not None else 'warm'].append(duration)
+            if init is not None:
+                samples['init'].append(init)
+    finally:
+        if cold:
+            set_variables(lambda_client, function, variables)
+
+    for kind in ('init', 'cold', 'warm'):
+        print(f'{function} {kind:5} {summary([value for value in samples[kind] if value])}')
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    imports = commands.add_parser('imports', help='time handler module imports locally')
+    imports.add_argument('--runs', type=int, default=5)
+    invoke = commands.add_parser('invoke', help='time invocations of a deployed function')
+    invoke.add_argument('function')
+    invoke.add_argument('--payload', default='{}', help='JSON event, or @file')
+    invoke.add_argument('--cold', type=int, default=3, help='forced cold starts')
+    invoke.add_argument('--warm', type=int, default=20, help='warm invocations')
+    arguments = parser.parse_args()
+
+    if arguments.command == 'imports':
+        measure_imports(arguments.runs)
+    else:
+        payload = arguments.payload
+        if payload.startswith('@'):
+            with open(payload[1:]) as source:
+                payload = source.read()
+        json.loads(payload)
+        measure_invocations(arguments.function, payload, arguments.cold, arguments.warm)
+
+
+if __name__ == '__main__':
+    main()
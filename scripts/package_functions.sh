@@ -15,32 +15,50 @@
 cp ../../functions/lambda_package.zip ../../functions/create_stack.zip
 cp ../../functions/lambda_package.zip ../../functions/create_lrs.zip
 cp ../../functions/lambda_package.zip ../../functions/create_solr_fs.zip
+cp ../../functions/lambda_package.zip ../../functions/create_files_directories.zip
+cp ../../functions/lambda_package.zip ../../functions/bulk_create.zip
 cp ../../functions/lambda_package.zip ../../functions/admin_container.zip
 cp ../../functions/lambda_package.zip ../../functions/update_stack.zip
 cp ../../functions/lambda_package.zip ../../functions/update.zip
+cp ../../functions/lambda_package.zip ../../functions/bulk_update.zip
 cp ../../functions/lambda_package.zip ../../functions/config_export.zip
 cp ../../functions/lambda_package.zip ../../functions/invoke_delete.zip
 cp ../../functions/lambda_package.zip ../../functions/delete_tenant.zip
+cp ../../functions/lambda_package.zip ../../functions/bulk_delete.zip
 cp ../../functions/lambda_package.zip ../../functions/tenant_status.zip
 cp ../../functions/lambda_package.zip ../../functions/tenant_list.zip
 cp ../../functions/lambda_package.zip ../../functions/cron.zip
+cp ../../functions/lambda_package.zip ../../functions/stack_events.zip
 cp ../../functions/lambda_package.zip ../../functions/get_versions.zip
+cp ../../functions/lambda_package.zip ../../functions/sync_files.zip
 zip -g ../../functions/create_db.zip create_db.py
 zip -g ../../functions/create_passwords.zip create_passwords.py
 zip -g ../../functions/create_stack.zip create_stack.py
 zip -g ../../functions/create_lrs.zip create_lrs.py
 zip -g ../../functions/create_solr_fs.zip create_solr_fs.py
+zip -g ../../functions/create_files_directories.zip create_files_directories.py
+zip -g ../../functions/bulk_create.zip bulk_create.py
 cd ../
 zip -g ../functions/admin_container.zip admin_container.py
+zip -g ../functions/stack_events.zip stack_events.py
+zip -g ../functions/cron.zip cron.py
 cd update
 zip -g ../../functions/update_stack.zip update_stack.py
 zip -g ../../functions/update.zip update.py
+zip -g ../../functions/bulk_update.zip bulk_update.py
 zip -g ../../functions/config_export.zip config_export.py
+zip -g ../../functions/sync_files.zip sync_files.py
 cd ../delete
+zip -g ../../functions/invoke_delete.zip invoke_delete.py
 zip -g ../../functions/delete_tenant.zip delete_tenant.py
+zip -g ../../functions/bulk_delete.zip bulk_delete.py
 cd ../status
 zip -g ../../functions/tenant_status.zip tenant_status.py
 zip -g ../../functions/tenant_list.zip tenant_list.py
 zip -g ../../functions/get_versions.zip get_versions.py
-cd ../../
+cd ../
+for package in ../functions/*.zip; do
+  zip -g -r "$package" common -x '*__pycache__*'
+done
+cd ../
 aws s3 cp functions s3://$1/functions --recursive --profile $2
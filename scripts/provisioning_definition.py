@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""Prints the Step Functions definition of the tenant provisioning pipeline
+
+The ``ProvisioningStateMachine`` DefinitionString in
+PERLS-lambda-gateway.yml is this output; regenerate it after changing
+``PIPELINE`` in common/provisioning.py::
+
+    python3 scripts/provisioning_definition.py
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'admin_api', 'lambda_functions'))
+
+from common.provisioning import state_machine  # noqa: E402 pylint: disable=wrong-import-position
+
+
+if __name__ == '__main__':
+    print(json.dumps(state_machine(), indent=2))